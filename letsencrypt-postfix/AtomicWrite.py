@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Replace files so that readers only ever see the old or the new version."""
+import contextlib
+import errno
+import os
+import tempfile
+
+
+def fsync_directory(directory):
+    """Make a rename in directory durable."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file_attributes(source_path, target_path):
+    """Give target_path the permissions and, if allowed, owner of source_path.
+
+    Without a source the target gets the mode a plain open() would have used.
+    """
+    try:
+        st = os.stat(source_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(target_path, 0666 & ~umask)
+        return
+    os.chmod(target_path, st.st_mode & 07777)
+    try:
+        os.chown(target_path, st.st_uid, st.st_gid)
+    except OSError as e:
+        # Only root may give files away; keep our own ownership then.
+        if e.errno != errno.EPERM:
+            raise
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', fsync=True):
+    """Open a temporary file next to path and rename it over path on success.
+
+    The temporary file lives in the same directory so the final rename is
+    atomic.  It is flushed and fsynced before the rename, and the existing
+    file's permissions and ownership are carried over.  If the with block
+    raises, the temporary file is removed and path is left untouched.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        copy_file_attributes(path, tmp_path)
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if fsync:
+        fsync_directory(directory)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Time and memory benchmarks for Config and PostfixConfigGenerator.
+
+Each step runs in its own forked process against a synthetic policy from
+SyntheticPolicy, so the reported peak RSS belongs to that step's process
+(loading the policy it needs included).  Results are compared against a
+stored baseline and the exit status is 1 if any step regressed.
+
+With --startup the command line entry points are also timed from process
+start to exit (printing their usage), minus bare interpreter startup.
+
+Usage:
+  ./Benchmark.py --sizes 1k,10k,100k
+  ./Benchmark.py --sizes 1k,10k --startup --save-baseline
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import Config
+import PostfixConfigGenerator
+import SyntheticPolicy
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark-baseline.json')
+# (script relative to the repository root, arguments that make it exit early)
+ENTRY_POINTS = [
+    ('letsencrypt-postfix/PostfixConfigGenerator.py', ['--help']),
+    ('letsencrypt-postfix/PostfixLogSummary.py', ['--help']),
+    ('letsencrypt-postfix/PolicyFetcher.py', ['--help']),
+    ('tools/CheckSTARTTLS.py', []),
+]
+MAIN_CF = """myhostname = mail.example.com
+smtpd_use_tls = yes
+"""
+
+
+def load_config(policy_file):
+    config = Config.Config()
+    config.load_from_json_file(policy_file)
+    return config
+
+
+def step_load_from_json_file(policy_file, work_dir):
+    return lambda: load_config(policy_file)
+
+
+def step_is_valid(policy_file, work_dir):
+    config = load_config(policy_file)
+    return config.is_valid
+
+
+def step_get_mx_to_domain_policy_map(policy_file, work_dir):
+    config = load_config(policy_file)
+    return config.get_mx_to_domain_policy_map
+
+
+def step_to_json(policy_file, work_dir):
+    config = load_config(policy_file)
+    return config.to_json
+
+
+def step_set_domainwise_tls_policies(policy_file, work_dir):
+    config = load_config(policy_file)
+    with open(os.path.join(work_dir, 'main.cf'), 'w') as f:
+        f.write(MAIN_CF)
+
+    def run():
+        generator = PostfixConfigGenerator.PostfixConfigGenerator(
+            config, work_dir, version=(3, 1, 0))
+        # time a full rebuild, not the no-op after the first repeat
+        manifest = (generator.policy_file +
+                    PostfixConfigGenerator.MANIFEST_SUFFIX)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        generator.set_domainwise_tls_policies()
+    return run
+
+
+# (name, setup function returning the callable to time)
+STEPS = [
+    ('load_from_json_file', step_load_from_json_file),
+    ('is_valid', step_is_valid),
+    ('get_mx_to_domain_policy_map', step_get_mx_to_domain_policy_map),
+    ('to_json', step_to_json),
+    ('set_domainwise_tls_policies', step_set_domainwise_tls_policies),
+]
+
+
+def max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_step(setup, policy_file, work_dir, repeat):
+    """Best wall clock time of `repeat` runs of a step, in seconds."""
+    run = setup(policy_file, work_dir)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_forked(setup, policy_file, work_dir, repeat):
+    """Run one step in a child process and return its measurements."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            seconds = time_step(setup, policy_file, work_dir, repeat)
+            result = {'seconds': seconds, 'max_rss_kb': max_rss_kb()}
+        except Exception as e:
+            result = {'error': repr(e)}
+        os.write(write_fd, json.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+
+def time_command(args, repeat):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call(args, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def run_startup(repeat=5):
+    """Time each entry point from exec to exit, net of interpreter startup.
+
+    Returns:
+      {script: {'seconds': float}}
+    """
+    interpreter = time_command([sys.executable, '-c', 'pass'], repeat)
+    root = os.path.dirname(HERE)
+    return dict(
+        (script, {'seconds': max(0.0, time_command(
+            [sys.executable, os.path.join(root, script)] + args, repeat) -
+            interpreter)})
+        for script, args in ENTRY_POINTS)
+
+
+def run_suite(sizes, repeat=3, seed=0, steps=STEPS):
+    """Benchmark every step at every size.
+
+    Returns:
+      {size: {step name: {'seconds': float, 'max_rss_kb': int}}}
+      with sizes as strings so the result round-trips through JSON.
+    """
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='starttls-benchmark-')
+    try:
+        for size in sizes:
+            policy_file = os.path.join(work_dir, 'policy-%d.json' % size)
+            with open(policy_file, 'w') as f:
+                json.dump(SyntheticPolicy.generate_policy(size, seed), f)
+            results[str(size)] = dict(
+                (name, run_forked(setup, policy_file, work_dir, repeat))
+                for name, setup in steps)
+            os.remove(policy_file)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of human readable regressions against the baseline."""
+    regressions = []
+    for size, steps in sorted(results.items()):
+        for name, measured in sorted(steps.items()):
+            expected = baseline.get(size, {}).get(name)
+            if not expected or 'error' in measured:
+                continue
+            for metric in ('seconds', 'max_rss_kb'):
+                if metric not in expected:
+                    continue
+                limit = expected[metric] * (1 + tolerance)
+                if measured[metric] > limit:
+                    regressions.append('%s @ %s domains: %s %.3f > %.3f' % (
+                        name, size, metric, measured[metric], limit))
+    return regressions
+
+
+def print_results(results, baseline):
+    print '%-30s %9s %10s %10s %12s' % ('step', 'domains', 'seconds',
+                                        'baseline', 'max rss kb')
+    sizes = sorted((size for size in results if size != 'startup'), key=int)
+    for size in sizes:
+        steps = results[size]
+        for name, _setup in STEPS:
+            measured = steps.get(name)
+            if measured is None:
+                continue
+            if 'error' in measured:
+                print '%-30s %9s %s' % (name, size, measured['error'])
+                continue
+            expected = baseline.get(size, {}).get(name, {})
+            print '%-30s %9s %10.3f %10s %12d' % (
+                name, size, measured['seconds'],
+                '%.3f' % expected['seconds'] if expected else '-',
+                measured['max_rss_kb'])
+    for script, measured in sorted(results.get('startup', {}).items()):
+        expected = baseline.get('startup', {}).get(script, {})
+        print '%-46s %10.3f %10s' % (
+            script, measured['seconds'],
+            '%.3f' % expected['seconds'] if expected else '-')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark policy loading and Postfix config generation')
+    arg_parser.add_argument('--sizes', default='1k,10k',
+                            help='comma separated domain counts, e.g. 1k,1M')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    arg_parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='allowed slowdown/growth over the baseline')
+    arg_parser.add_argument('--startup', action='store_true',
+                            help='also time start up of the entry points')
+    arg_parser.add_argument('--save-baseline', action='store_true',
+                            help='store these results as the new baseline')
+    args = arg_parser.parse_args()
+
+    # The generators warn about every multi-MX domain; keep the output usable.
+    logging.disable(logging.WARNING)
+    sizes = [SyntheticPolicy.parse_size(s) for s in args.sizes.split(',')]
+    results = run_suite(sizes, args.repeat, args.seed)
+    if args.startup:
+        results['startup'] = run_startup()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print 'Baseline saved to', args.baseline
+    else:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION:', regression
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Build the CA bundle (and optionally a hashed CA directory) for Postfix.
+
+Certificates are read from the configured sources in-process, deduplicated
+by SHA-256 fingerprint and written atomically, and only when the result
+differs from what is already on disk.  The bundle can be cut down to the
+roots that actually issued certificates observed for the policy's mail
+domains (see tools/CheckSTARTTLS.py, which saves those chains).
+"""
+import base64
+import binascii
+import collections
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import textwrap
+
+import AtomicWrite
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+DEFAULT_CA_SOURCES = ("/usr/share/ca-certificates/mozilla",)
+CERTIFICATE_SUFFIXES = (".crt", ".pem")
+PEM_RE = re.compile(r"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----",
+                    re.DOTALL)
+# <subject hash>.N, the links OpenSSL looks CA certificates up by
+HASH_LINK_RE = re.compile(r"^([0-9a-f]{8})\.(\d+)$")
+
+
+def der_header(der, pos):
+    """Return (tag, start of contents, end) of the DER element at pos."""
+    tag = ord(der[pos])
+    length = ord(der[pos + 1])
+    pos += 2
+    if length & 0x80:
+        num_bytes = length & 0x7f
+        length = int(binascii.hexlify(der[pos:pos + num_bytes]), 16)
+        pos += num_bytes
+    return tag, pos, pos + length
+
+
+def issuer_and_subject(der):
+    """Return the raw DER issuer and subject names of a certificate."""
+    _, pos, _ = der_header(der, 0)         # Certificate
+    _, pos, _ = der_header(der, pos)       # TBSCertificate
+    tag, _, end = der_header(der, pos)
+    if tag == 0xa0:                        # explicit version
+        pos = end
+    fields = []
+    # serialNumber, signature, issuer, validity, subject
+    for _ in range(5):
+        _, _, end = der_header(der, pos)
+        fields.append(der[pos:end])
+        pos = end
+    return fields[2], fields[4]
+
+
+class Certificate(collections.namedtuple('Certificate',
+                                         ['der', 'fingerprint', 'issuer',
+                                          'subject'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_der(cls, der):
+        issuer, subject = issuer_and_subject(der)
+        return cls(der, hashlib.sha256(der).hexdigest(), issuer, subject)
+
+    def to_pem(self):
+        body = "\n".join(textwrap.wrap(base64.b64encode(self.der), 64))
+        return ("-----BEGIN CERTIFICATE-----\n" + body +
+                "\n-----END CERTIFICATE-----\n")
+
+
+def parse_pem_certificates(text):
+    """Return the Certificates in PEM text, skipping unparsable ones."""
+    certs = []
+    for body in PEM_RE.findall(text):
+        try:
+            certs.append(Certificate.from_der(base64.b64decode(body)))
+        except (TypeError, ValueError, IndexError):
+            logger.warn('Skipping malformed certificate')
+    return certs
+
+
+def source_files(sources):
+    """Certificate files in sources (files or directories), sorted."""
+    for source in sources:
+        if not os.path.isdir(source):
+            yield source
+            continue
+        for name in sorted(os.listdir(source)):
+            if name.endswith(CERTIFICATE_SUFFIXES):
+                yield os.path.join(source, name)
+
+
+def read_certificates(sources=DEFAULT_CA_SOURCES):
+    """Read and deduplicate the certificates in sources, in source order."""
+    seen = set()
+    certs = []
+    for path in source_files(sources):
+        with open(path) as f:
+            for cert in parse_pem_certificates(f.read()):
+                if cert.fingerprint not in seen:
+                    seen.add(cert.fingerprint)
+                    certs.append(cert)
+    return certs
+
+
+def observed_issuers(certs_observed, mail_domains):
+    """
+    Issuer names from the chains saved under certs_observed/<mail domain>/.
+
+    Returns:
+      (set of raw DER issuer names, number of mail domains without chains)
+    """
+    issuers = set()
+    unobserved = 0
+    for mail_domain in mail_domains:
+        directory = os.path.join(certs_observed, mail_domain)
+        if not os.path.isdir(directory):
+            unobserved += 1
+            continue
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name)) as f:
+                issuers.update(cert.issuer
+                               for cert in parse_pem_certificates(f.read()))
+    return issuers, unobserved
+
+
+def used_roots(certs, issuers):
+    """The certs that issued one of the observed certificates."""
+    return [cert for cert in certs if cert.subject in issuers]
+
+
+def write_bundle(path, certs):
+    """Atomically write certs as a PEM bundle if it changed; True if so."""
+    bundle = "".join(cert.to_pem() for cert in certs)
+    try:
+        with open(path) as f:
+            if f.read() == bundle:
+                return False
+    except IOError:
+        pass
+    with AtomicWrite.atomic_write(path) as f:
+        f.write(bundle)
+    return True
+
+
+def write_ca_path(directory, certs):
+    """
+    Make directory hold exactly certs, one file each plus OpenSSL's hash
+    links, for use as smtp_tls_CApath.  Returns True if anything changed.
+
+    Files are named by fingerprint, so a file that exists is up to date and
+    only missing or stale ones are touched.  Postfix may be reading the
+    directory meanwhile, so new files and their links are added before
+    anything is removed, and only the links of removed files are changed.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    wanted = dict((cert.fingerprint + ".pem", cert) for cert in certs)
+    existing = set(name for name in os.listdir(directory)
+                   if name.endswith(".pem"))
+    changed = False
+    for name in sorted(set(wanted) - existing):
+        with AtomicWrite.atomic_write(os.path.join(directory, name)) as f:
+            f.write(wanted[name].to_pem())
+        changed = True
+    links = hash_links(directory)
+    linked = set(target for numbered in links.values()
+                 for target in numbered.values())
+    for name in sorted(set(wanted) - linked):
+        subject = subject_hash(os.path.join(directory, name))
+        numbered = links.setdefault(subject, {})
+        n = 0
+        while n in numbered:
+            n += 1
+        os.symlink(name, os.path.join(directory, "%s.%d" % (subject, n)))
+        numbered[n] = name
+        changed = True
+    for subject, numbered in links.items():
+        changed |= drop_hash_links(directory, subject, numbered, wanted)
+    for name in existing - set(wanted):
+        os.remove(os.path.join(directory, name))
+        changed = True
+    return changed
+
+
+def hash_links(directory):
+    """The hash links in directory, as {subject hash: {n: target}}."""
+    links = {}
+    for name in os.listdir(directory):
+        match = HASH_LINK_RE.match(name)
+        path = os.path.join(directory, name)
+        if match and os.path.islink(path):
+            links.setdefault(match.group(1), {})[int(match.group(2))] = \
+                os.readlink(path)
+    return links
+
+
+def drop_hash_links(directory, subject, numbered, wanted):
+    """
+    Remove the links of one subject hash to files not in wanted.  OpenSSL
+    stops at the first missing number, so a link that goes is replaced by
+    the last one instead of leaving a gap.  Returns True if any went.
+    """
+    dropped = False
+    while True:
+        stale = [n for n, target in numbered.items() if target not in wanted]
+        if not stale:
+            return dropped
+        n = min(stale)
+        last = max(numbered)
+        path = os.path.join(directory, "%s.%d" % (subject, n))
+        if last == n:
+            os.remove(path)
+        else:
+            os.rename(os.path.join(directory, "%s.%d" % (subject, last)),
+                      path)
+            numbered[n] = numbered[last]
+        del numbered[last]
+        dropped = True
+
+
+def subject_hash(path):
+    """OpenSSL's hash of the subject of the certificate in path."""
+    with open(os.devnull, "w") as devnull:
+        cmd = subprocess.Popen(["openssl", "x509", "-noout", "-subject_hash",
+                                "-in", path],
+                               stdout=subprocess.PIPE, stderr=devnull)
+        out, _ = cmd.communicate()
+    if cmd.returncode != 0:
+        raise Exception("PluginError: could not hash CA certificate %s"
+                        % path)
+    return out.strip()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Minimal reader and writer for D. J. Bernstein's constant database format.
+
+Postfix opens cdb: lookup tables directly, without parsing them into
+memory, which makes them much cheaper than texthash: for large maps used by
+many smtp processes.  See https://cr.yp.to/cdb/cdb.txt for the format.
+"""
+import struct
+
+HEADER_SIZE = 256 * 8
+_pair = struct.Struct('<LL')
+
+
+def cdb_hash(key):
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) ^ ord(c)) & 0xffffffff
+    return h
+
+
+def write_cdb(f, items):
+    """Write (key, value) string pairs to the seekable binary file f."""
+    f.seek(0)
+    f.write('\0' * HEADER_SIZE)
+    pos = HEADER_SIZE
+    # per table: list of (hash, record position)
+    tables = [[] for _ in range(256)]
+    for key, value in items:
+        f.write(_pair.pack(len(key), len(value)))
+        f.write(key)
+        f.write(value)
+        h = cdb_hash(key)
+        tables[h & 0xff].append((h, pos))
+        pos += 8 + len(key) + len(value)
+
+    header = []
+    for table in tables:
+        num_slots = 2 * len(table)
+        header.append(_pair.pack(pos, num_slots))
+        slots = [(0, 0)] * num_slots
+        for h, record_pos in table:
+            slot = (h >> 8) % num_slots
+            while slots[slot][1]:
+                slot = (slot + 1) % num_slots
+            slots[slot] = (h, record_pos)
+        f.write(''.join(_pair.pack(h, p) for h, p in slots))
+        pos += 8 * num_slots
+    f.seek(0)
+    f.write(''.join(header))
+    f.seek(pos)
+
+
+def cdb_get(data, key):
+    """Look up key in the cdb file contents data, None if absent."""
+    h = cdb_hash(key)
+    table_pos, num_slots = _pair.unpack_from(data, (h & 0xff) * 8)
+    if not num_slots:
+        return None
+    slot = (h >> 8) % num_slots
+    for _ in range(num_slots):
+        slot_hash, record_pos = _pair.unpack_from(data, table_pos + slot * 8)
+        if not record_pos:
+            return None
+        if slot_hash == h:
+            key_len, value_len = _pair.unpack_from(data, record_pos)
+            start = record_pos + 8
+            if data[start:start + key_len] == key:
+                return data[start + key_len:start + key_len + value_len]
+        slot = (slot + 1) % num_slots
+    return None
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Checkpoints of the files the generator changes, so changes can be undone.
+
+A checkpoint records what each file it covers looked like before it was
+changed.  File contents are stored once as blobs named by their SHA-256
+digest, so a checkpoint costs one small JSON manifest plus a blob for each
+file version not seen before, and unchanged files cost nothing at all.
+
+Layout of the store directory:
+  blobs/<sha256>           file contents
+  checkpoints/<n>.json     finalized checkpoints, oldest first; only the
+                           newest keep of them are kept
+  in_progress.json         changes saved without a title yet
+  temporary.json           changes that recovery_routine() will revert
+Manifests look like {"title": ..., "timestamp": ..., "files": {path: digest}}
+with a null digest for files that did not exist.
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import AtomicWrite
+
+
+IN_PROGRESS = "in_progress"
+TEMPORARY = "temporary"
+# finalized checkpoints kept, and so how far back rollback() can go
+KEEP_CHECKPOINTS = 20
+
+
+class CheckpointError(Exception): pass
+
+
+class CheckpointStore(object):
+
+    def __init__(self, directory, keep=KEEP_CHECKPOINTS):
+        self.directory = directory
+        self.keep = keep
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.checkpoint_dir = os.path.join(directory, "checkpoints")
+
+    def makedirs(self):
+        for directory in (self.blob_dir, self.checkpoint_dir):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def store_blob(self, path):
+        """Store the current contents of path; returns its digest or None
+        if path does not exist."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        digest = hashlib.sha256(data).hexdigest()
+        blob = os.path.join(self.blob_dir, digest)
+        if not os.path.exists(blob):
+            self.makedirs()
+            with AtomicWrite.atomic_write(blob, "wb") as f:
+                f.write(data)
+        return digest
+
+    def manifest_path(self, kind):
+        return os.path.join(self.directory, kind + ".json")
+
+    def load_manifest(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        except ValueError as e:
+            raise CheckpointError("Corrupt checkpoint %s: %s" % (path, e))
+
+    def save_manifest(self, path, manifest):
+        self.makedirs()
+        with AtomicWrite.atomic_write(path) as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def add(self, originals, kind=IN_PROGRESS):
+        """
+        Record {path: digest of its original contents} in the in progress
+        or temporary checkpoint.  A path already recorded in either keeps
+        its earlier (older) original, so recover() can revert the two in
+        any order.
+        """
+        other_kind = TEMPORARY if kind == IN_PROGRESS else IN_PROGRESS
+        other = self.load_manifest(self.manifest_path(other_kind))
+        recorded = other["files"] if other else {}
+        originals = dict((file_path, digest)
+                         for file_path, digest in originals.items()
+                         if file_path not in recorded)
+        if not originals:
+            return
+        path = self.manifest_path(kind)
+        manifest = self.load_manifest(path) or {"files": {}}
+        for file_path, digest in originals.items():
+            manifest["files"].setdefault(file_path, digest)
+        self.save_manifest(path, manifest)
+
+    def checkpoint_names(self):
+        """Finalized checkpoint file names, oldest first."""
+        try:
+            names = os.listdir(self.checkpoint_dir)
+        except OSError:
+            return []
+        return sorted(name for name in names if name.endswith(".json"))
+
+    def finalize(self, title):
+        """
+        Turn the in progress checkpoint into a permanent one, dropping the
+        oldest beyond keep.
+        """
+        in_progress = self.manifest_path(IN_PROGRESS)
+        manifest = self.load_manifest(in_progress)
+        if manifest is None:
+            return None
+        manifest["title"] = title
+        manifest["timestamp"] = time.time()
+        names = self.checkpoint_names()
+        number = int(names[-1].split(".")[0]) + 1 if names else 1
+        path = os.path.join(self.checkpoint_dir, "%08d.json" % number)
+        self.save_manifest(path, manifest)
+        os.remove(in_progress)
+        self.prune()
+        return path
+
+    def prune(self):
+        """Remove the oldest finalized checkpoints beyond keep."""
+        names = self.checkpoint_names()
+        for name in names[:max(0, len(names) - self.keep)]:
+            os.remove(os.path.join(self.checkpoint_dir, name))
+        self.collect_garbage()
+
+    def restore(self, files):
+        """
+        Put files back as recorded: {path: digest or None}.  A None path
+        was created after the checkpoint, as a regular file; anything else
+        found there now is not ours to remove and is left alone.
+        """
+        for path, digest in sorted(files.items()):
+            if digest is None:
+                if os.path.isfile(path) and not os.path.islink(path):
+                    os.remove(path)
+                continue
+            blob = os.path.join(self.blob_dir, digest)
+            if not os.path.exists(blob):
+                raise CheckpointError("Missing blob %s for %s" % (digest, path))
+            with open(blob, "rb") as source:
+                with AtomicWrite.atomic_write(path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+
+    def revert(self, kind):
+        """Undo the temporary or in progress changes; returns their paths."""
+        path = self.manifest_path(kind)
+        manifest = self.load_manifest(path)
+        if manifest is None:
+            return []
+        self.restore(manifest["files"])
+        os.remove(path)
+        return list(manifest["files"])
+
+    def recover(self):
+        """Undo everything not in a finalized checkpoint."""
+        restored = self.revert(TEMPORARY) + self.revert(IN_PROGRESS)
+        self.collect_garbage()
+        return restored
+
+    def rollback(self, count=1):
+        """Undo the count most recent finalized checkpoints, newest first."""
+        names = self.checkpoint_names()
+        if count > len(names):
+            raise CheckpointError("Only %d checkpoints to roll back"
+                                  % len(names))
+        restored = self.revert(TEMPORARY) + self.revert(IN_PROGRESS)
+        for name in reversed(names[len(names) - count:]):
+            path = os.path.join(self.checkpoint_dir, name)
+            files = self.load_manifest(path)["files"]
+            self.restore(files)
+            os.remove(path)
+            restored.extend(files)
+        self.collect_garbage()
+        return restored
+
+    def checkpoints(self):
+        """Finalized checkpoint manifests, oldest first."""
+        return [self.load_manifest(os.path.join(self.checkpoint_dir, name))
+                for name in self.checkpoint_names()]
+
+    def collect_garbage(self):
+        """Remove blobs no manifest refers to any more."""
+        manifests = self.checkpoints() + [
+            self.load_manifest(self.manifest_path(kind))
+            for kind in (IN_PROGRESS, TEMPORARY)]
+        referenced = set()
+        for manifest in manifests:
+            if manifest is not None:
+                referenced.update(manifest["files"].values())
+        try:
+            blobs = os.listdir(self.blob_dir)
+        except OSError:
+            return
+        for digest in blobs:
+            if digest not in referenced:
+                os.remove(os.path.join(self.blob_dir, digest))
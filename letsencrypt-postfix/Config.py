@@ -1,10 +1,15 @@
 #!/usr/bin/env python
-from datetime import datetime
-from dateutil import parser as dateutil_parser
+from datetime import datetime, timedelta, tzinfo
+import calendar
 import collections
 import json
 import logging
 import pprint
+import re
+import time
+import weakref
+
+import AtomicWrite
 
 
 """Idea here being to start with something that is decomposed so it's easier to
@@ -28,6 +33,50 @@ def parse_bool_from_json(value, attr_name):
     return bool_value
 
 
+class FixedOffset(tzinfo):
+    """Timezone with a fixed UTC offset, for ISO-8601 timestamps."""
+
+    def __init__(self, minutes):
+        self._offset = timedelta(minutes=minutes)
+
+    def __repr__(self):
+        return 'FixedOffset(%d)' % (self._offset.total_seconds() // 60)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+
+ISO_8601_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d\d(?::?\d\d)?)?$')
+
+
+def parse_iso_8601(value):
+    """Parse the ISO-8601 forms used in policies, None for anything else."""
+    match = ISO_8601_RE.match(value)
+    if not match:
+        return None
+    (year, month, day, hour, minute, second, fraction,
+     offset) = match.groups()
+    tz = None
+    if offset == 'Z':
+        tz = FixedOffset(0)
+    elif offset:
+        sign = -1 if offset[0] == '-' else 1
+        digits = offset[1:].replace(':', '')
+        tz = FixedOffset(sign * (int(digits[:2]) * 60 + int(digits[2:] or 0)))
+    return datetime(int(year), int(month), int(day), int(hour or 0),
+                    int(minute or 0), int(second or 0),
+                    int((fraction or '0').ljust(6, '0')), tz)
+
+
 def parse_timestamp(value, attr_name):
     if isinstance(value, datetime):
         return value
@@ -37,6 +86,11 @@ def parse_timestamp(value, attr_name):
     except (TypeError, ValueError):
         pass
     try:
+        parsed = parse_iso_8601(value)
+        if parsed is not None:
+            return parsed
+        # Only odd formats need dateutil, which is slow to import.
+        from dateutil import parser as dateutil_parser
         return dateutil_parser.parse(value)
     except (TypeError, ValueError):
         raise ConfigError('Config value %s is an invalid date or timestamp.' % attr_name)
@@ -58,6 +112,55 @@ def verify_string(value, attr_name, max_length=200):
     return value
 
 
+def epoch_seconds(value):
+    """Seconds since the epoch for a naive (local) or timezone aware datetime."""
+    if value.tzinfo is not None:
+        return calendar.timegm(value.utctimetuple())
+    return time.mktime(value.timetuple())
+
+
+def suffix_labels(domain_suffix):
+    """Reversed DNS labels of a suffix, '.mail.google.com' -> ('com', 'google', 'mail').
+
+    Leading '*.' or '.' wildcard markers are ignored so both spellings used in
+    policy files index to the same place.
+    """
+    domain_suffix = domain_suffix.lower().lstrip('*').lstrip('.')
+    return tuple(reversed(domain_suffix.split('.')))
+
+
+_TRIE_END = None
+
+
+def find_overlapping_suffixes(domain_suffixes):
+    """Find suffixes that fall under (or duplicate) another suffix.
+
+    Builds a trie keyed on reversed labels once, then walks each suffix's path
+    through it, so the cost is linear in the total number of labels rather
+    than quadratic in the number of suffixes.
+
+    Returns:
+      A list of (suffix, covering_suffix) tuples.
+    """
+    trie = {}
+    overlaps = []
+    for domain_suffix in domain_suffixes:
+        node = trie
+        for label in suffix_labels(domain_suffix):
+            node = node.setdefault(label, {})
+        if _TRIE_END in node:
+            overlaps.append((domain_suffix, node[_TRIE_END]))
+        else:
+            node[_TRIE_END] = domain_suffix
+    for domain_suffix in domain_suffixes:
+        node = trie
+        for label in suffix_labels(domain_suffix)[:-1]:
+            node = node[label]
+            if _TRIE_END in node:
+                overlaps.append((domain_suffix, node[_TRIE_END]))
+    return overlaps
+
+
 def to_dict(config_dict):
     """Cleans up BaseConfig children to be serialized."""
     d = {}
@@ -66,13 +169,192 @@ def to_dict(config_dict):
             d[key] = to_dict(val._data)
         elif isinstance(val, datetime):
             d[key] = val.strftime('%Y-%m-%dT%H:%M:%S%z')
-        elif isinstance(val, dict):
+        elif isinstance(val, (dict, LayeredDict)):
             d[key] = to_dict(val)
         else:
             d[key] = val
     return d
 
 
+JSON_INDENT = '  '
+
+
+def scalar_json(value):
+    """JSON for a string, number, boolean or None, skipping json.dumps overhead."""
+    encode = SCALAR_ENCODERS.get(type(value))
+    if encode is not None:
+        return encode(value)
+    return json.dumps(value)
+
+
+def _bool_json(value):
+    return 'true' if value else 'false'
+
+
+# type -> function giving the JSON for a scalar of exactly that type; looked
+# up by type() since isinstance() chains dominate serialization time.
+SCALAR_ENCODERS = {
+    str: json.encoder.encode_basestring_ascii,
+    unicode: json.encoder.encode_basestring_ascii,
+    bool: _bool_json,
+    int: str,
+    long: str,
+    float: json.dumps,
+    type(None): lambda value: 'null',
+}
+
+
+def write_json(value, write, level=0):
+    """Write canonical JSON text for a config value without building a copy.
+
+    Pieces are passed to write() as they are produced.  The output has
+    sorted keys and two space indentation, identical to
+    json.dumps(to_dict(...), sort_keys=True, indent=2, separators=(',', ': ')),
+    but only small strings are held in memory at any time.  Interned
+    policy bodies are serialized once and their text reused.
+    """
+    scalar_encoder = SCALAR_ENCODERS.get
+    encode = scalar_encoder(type(value))
+    if encode is not None:
+        write(encode(value))
+        return
+    if isinstance(value, BaseConfig):
+        if value._body is not None:
+            write(value._body.json_text(level))
+            return
+        value = value._data
+    if isinstance(value, list):
+        items = value
+        keys = None
+        opening, closing = '[', ']'
+    elif isinstance(value, datetime):
+        write(scalar_json(value.strftime('%Y-%m-%dT%H:%M:%S%z')))
+        return
+    elif isinstance(value, dict) or type(value) is LayeredDict:
+        keys = sorted(value)
+        items = [value[key] for key in keys]
+        opening, closing = '{', '}'
+    else:
+        write(json.dumps(value))
+        return
+    if not items:
+        write(opening + closing)
+        return
+    inner_indent = JSON_INDENT * (level + 1)
+    separator = opening + '\n' + inner_indent
+    encode_key = json.encoder.encode_basestring_ascii
+    for n, item in enumerate(items):
+        if keys is None:
+            prefix = separator
+        else:
+            prefix = separator + encode_key(keys[n]) + ': '
+        encode = scalar_encoder(type(item))
+        if encode is not None:
+            write(prefix + encode(item))
+        else:
+            write(prefix)
+            write_json(item, write, level + 1)
+        separator = ',\n' + inner_indent
+    write('\n' + JSON_INDENT * level + closing)
+
+
+def content_key(value):
+    """Hashable canonical form of a config value, used for cheap comparisons."""
+    if isinstance(value, BaseConfig):
+        if value._body is not None:
+            return value._body.key
+        value = value._data
+    if isinstance(value, (dict, LayeredDict)):
+        return tuple(sorted((key, content_key(val))
+                            for key, val in value.iteritems()))
+    elif isinstance(value, list):
+        return tuple(content_key(val) for val in value)
+    return value
+
+
+def merge_join(old_dict, new_dict):
+    """Walk two dicts in one pass over their sorted keys.
+
+    Yields (key, old_value, new_value) with None standing in for a value
+    missing on either side.
+    """
+    old_keys = sorted(old_dict)
+    new_keys = sorted(new_dict)
+    i = j = 0
+    while i < len(old_keys) or j < len(new_keys):
+        if j == len(new_keys) or (i < len(old_keys) and
+                                  old_keys[i] < new_keys[j]):
+            yield old_keys[i], old_dict[old_keys[i]], None
+            i += 1
+        elif i == len(old_keys) or new_keys[j] < old_keys[i]:
+            yield new_keys[j], None, new_dict[new_keys[j]]
+            j += 1
+        else:
+            yield old_keys[i], old_dict[old_keys[i]], new_dict[new_keys[j]]
+            i += 1
+            j += 1
+
+
+class LayeredDict(collections.MutableMapping):
+    """A dict of changes layered over a shared base mapping, like ChainMap.
+
+    Lookups try the changes first, then the base; keys removed from the
+    base are remembered rather than deleted from it.  The base is never
+    modified, so one upstream policy section can underlie any number of
+    locally overridden configs at a cost proportional to the overrides.
+    Layering over another LayeredDict reuses its base, so lookups never
+    go more than one level deep.
+    """
+
+    def __init__(self, base):
+        if isinstance(base, LayeredDict):
+            self.base = base.base
+            self.changes = dict(base.changes)
+            self.removed = set(base.removed)
+        else:
+            self.base = base
+            self.changes = {}
+            self.removed = set()
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key in self.changes or (key not in self.removed and
+                                       key in self.base)
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.changes.pop(key, None)
+        if key in self.base:
+            self.removed.add(key)
+
+    def __iter__(self):
+        for key in self.changes:
+            yield key
+        for key in self.base:
+            if key not in self.changes and key not in self.removed:
+                yield key
+
+    def __len__(self):
+        # counted from the base each time, as its owner may still change it
+        return (len(self.base) +
+                sum(1 for key in self.changes if key not in self.base) -
+                sum(1 for key in self.removed if key in self.base))
+
+    def __repr__(self):
+        return 'LayeredDict(%r)' % dict(self.iteritems())
+
+
 class BaseConfig(object):
     """Top level config class for common methods.
     
@@ -86,6 +368,8 @@ class BaseConfig(object):
     """
 
     config_properties = []
+    # the interned PolicyBody that _data currently is, see intern_tls_policy()
+    _body = None
 
     def __init__(self):
         # container for validated properties with JSON names
@@ -130,10 +414,7 @@ class BaseConfig(object):
             raise ConfigError('Attempting to update a %s with a %s' % (
                 self.__class__,
                 newer_config.__class__))
-        for prop_name in self.config_properties:
-            # get the specified property off of the current class
-            prop = self.__class__.__dict__.get(prop_name)
-            assert prop
+        for prop in self.config_property_objects():
             new_value = prop.fget(newer_config)
             old_value = prop.fget(self)
             if new_value is not None:
@@ -142,6 +423,19 @@ class BaseConfig(object):
                 prop.fset(fresh_config, old_value)
         return fresh_config
 
+    @classmethod
+    def config_property_objects(cls):
+        """The property objects named in 'config_properties', looked up once.
+
+        Cached on the class itself (not inherited) so subclasses get their own.
+        """
+        props = cls.__dict__.get('_config_property_objects')
+        if props is None:
+            props = [getattr(cls, prop_name)
+                     for prop_name in cls.config_properties]
+            cls._config_property_objects = props
+        return props
+
     def merge(self, newer_config, **kwargs):
         """Combines configs and keeps old values if they are not overridden.
 
@@ -158,17 +452,30 @@ class BaseConfig(object):
         logger.debug('from parent merge: %s' % kwargs)
         return self.update(newer_config, **kwargs)
 
+    def write_json(self, write):
+        """Pass canonical JSON for this config to write() piece by piece."""
+        write_json(self._data, write)
+
     def to_json(self):
-        d = to_dict(self._data)
-        return json.dumps(d)
+        chunks = []
+        self.write_json(chunks.append)
+        return ''.join(chunks)
 
-    def write_to_json_file(self, json_filename, f_open=open):
-        data = self.to_json()
-        try:
+    def write_to_json_file(self, json_filename, f_open=None):
+        """Stream canonical JSON to json_filename and swap it in atomically.
+
+        Readers of json_filename never see a partially written file. If
+        f_open is given the JSON is streamed to f_open(json_filename, 'w')
+        instead, without the atomic replacement (used by tests).
+        """
+        if f_open is not None:
             with f_open(json_filename, 'w') as f:
-                f.write(data)
-        except IOError:
-            raise
+                self.write_json(f.write)
+                f.write('\n')
+            return
+        with AtomicWrite.atomic_write(json_filename) as f:
+            self.write_json(f.write)
+            f.write('\n')
 
     def load_from_json_file(self, json_filename, f_open=open):
         try:
@@ -196,21 +503,99 @@ class Config(BaseConfig):
     object keys, albeit with dashes replaced with underscores.
     """
 
+    config_properties = ['author', 'comment', 'expires', 'timestamp']
+
     def __init__(self):
         super(self.__class__, self).__init__()
         self._data['tls-policies'] = {}
         self._data['acceptable-mxs'] = {}
 
     def __add__(self, other_config):
-        """Allow addition but not really of *full* configs, need to flesh that out."""
-        #TODO add this
-        raise NotImplemented
+        """Overlay another config on this one, see merge."""
+        return self.merge(other_config)
+
+    def update(self, newer_config, merge=False):
+        """Combine this config with a newer one into a fresh Config.
+
+        Top level properties follow the BaseConfig update/merge rules. For the
+        policy sections an update takes the newer config's entries wholesale,
+        while a merge overlays them on ours entry by entry, the way a site
+        applies local overrides on top of the upstream policy.
+
+        Policy objects are shared with the inputs rather than copied.  An
+        update copies the newer config's sections; a merge layers them over
+        ours in LayeredDicts holding only the newer config's entries.
+        Only entries present in both configs with differing content are
+        merged into new objects, so time and memory are proportional to the
+        size of the newer config in a merge.  The result is not validated,
+        call validate() on it when that is wanted.
+        """
+        fresh_config = super(Config, self).update(newer_config, merge=merge)
+        for section in ('tls-policies', 'acceptable-mxs'):
+            newer_section = newer_config._data[section]
+            if not merge:
+                fresh_config._data[section] = dict(newer_section)
+                continue
+            fresh_section = LayeredDict(self._data[section])
+            for key, newer_policy in newer_section.iteritems():
+                older_policy = fresh_section.get(key)
+                if older_policy is None:
+                    fresh_section[key] = newer_policy
+                elif (older_policy is not newer_policy and
+                      content_key(older_policy) != content_key(newer_policy)):
+                    fresh_section[key] = older_policy.merge(newer_policy)
+                    if section == 'tls-policies':
+                        fresh_section[key] = intern_tls_policy(
+                            fresh_section[key])
+            fresh_config._data[section] = fresh_section
+        return fresh_config
 
-    def update(self, other_config):
-        """Update properties of config from a 'newer' config and force verification."""
-        #TODO add this
-        new_config = Config()
-        raise NotImplemented
+    def apply_change_set(self, change_set):
+        """Return a fresh Config with a ConfigDiff.to_json_dict() change set applied.
+
+        Like a merge, untouched policy objects are shared with this config,
+        so applying a small delta to a large policy is cheap.
+        """
+        fresh_config = Config()
+        fresh_config._data.update(self._data)
+        for key, value in change_set.get('properties', {}).iteritems():
+            if key.replace('-', '_') not in self.config_properties:
+                raise ConfigError('Unknown property in change set: %s' % key)
+            if value is None:
+                fresh_config._data.pop(key, None)
+            else:
+                setattr(fresh_config, key.replace('-', '_'), value)
+        for section, make_section in (
+                ('tls-policies', fresh_config.make_tls_policy_dict),
+                ('acceptable-mxs', fresh_config.make_acceptable_mxs_dict)):
+            section_changes = change_set.get(section, {})
+            fresh_section = LayeredDict(self._data[section])
+            for key in section_changes.get('remove', []):
+                fresh_section.pop(key, None)
+            fresh_config._data[section] = fresh_section
+            make_section(section_changes.get('set', {}))
+        return fresh_config
+
+    def diff(self, newer_config):
+        """Compute what changed between this config and a newer one.
+
+        Both policy sections are compared with a single merge-join over
+        their sorted keys, so the cost is dominated by the sort.
+
+        Returns:
+          A ConfigDiff.
+        """
+        properties = {}
+        for prop_name in self.config_properties:
+            old_value = getattr(self, prop_name)
+            new_value = getattr(newer_config, prop_name)
+            # compare serialized so naive and aware datetimes don't clash
+            if to_dict({'v': old_value}) != to_dict({'v': new_value}):
+                properties[prop_name] = (old_value, new_value)
+        return ConfigDiff(
+            properties,
+            diff_sections(self.tls_policies, newer_config.tls_policies),
+            diff_sections(self.acceptable_mxs, newer_config.acceptable_mxs))
 
     def from_json_dict(self, json_dict):
         """Assign JSON data to Config properties and declare sub-objects.
@@ -276,14 +661,36 @@ class Config(BaseConfig):
         return self._data.get('acceptable-mxs')
 
     def make_tls_policy_dict(self, policy_dict):
-        tls_policy_dict = self.tls_policies
+        """Parse TLS policies, sharing one interned body between identical ones.
+
+        Every domain suffix gets its own TLSPolicy; identical raw bodies are
+        only parsed once.
+        """
+        parsed = {}
         for domain_suffix, settings in policy_dict.iteritems():
+            try:
+                raw_key = tuple(sorted(settings.iteritems()))
+                hash(raw_key)
+            except (AttributeError, TypeError):
+                raw_key = None
+            if raw_key in parsed:
+                self.set_tls_policy(domain_suffix,
+                                    parsed[raw_key].copy(domain_suffix))
+                continue
             new_domain_policy = TLSPolicy(domain_suffix)
             try:
                 new_domain_policy.from_json_dict(settings)
             except ConfigError as e:
                 raise
-            tls_policy_dict[domain_suffix] = new_domain_policy
+            self.set_tls_policy(domain_suffix, new_domain_policy)
+            if raw_key is not None:
+                parsed[raw_key] = new_domain_policy
+
+    def set_tls_policy(self, domain_suffix, policy):
+        """Store policy under domain_suffix with its body interned; returns it."""
+        intern_tls_policy(policy)
+        self.tls_policies[domain_suffix] = policy
+        return policy
 
     def get_tls_policy(self, mx_domain):
         return self.tls_policies.get(mx_domain)
@@ -355,30 +762,157 @@ class Config(BaseConfig):
         return all_mx_items
 
     def get_all_mx_hosts(self):
-        all_mx_hosts = []
-        [ all_mx_hosts.extend(domain_policy.acceptable_mxs)
-          for domain_policy in self.acceptable_mxs.values() ]
+        """Set of every MX domain suffix referenced by an acceptable-mxs entry."""
+        all_mx_hosts = set()
+        for domain_policy in self.acceptable_mxs.values():
+            all_mx_hosts.update(domain_policy.accept_mx_domains)
         return all_mx_hosts
 
-    def is_valid(self):
-        #TODO implement checks to make sure domains don't overlap
-        #TODO add debug logging for troubleshooting sake
-        for mx_config in self.acceptable_mxs.values():
+    def validate(self, now=None):
+        """Check the whole config and report every problem found.
+
+        The MX suffix set and the TLS policy suffix trie are built once, so
+        this runs in time roughly linear in the size of the config.
+
+        Args:
+          now: datetime to check expiry against, defaults to the current time.
+
+        Returns:
+          A list of ValidationError tuples, empty when the config is valid.
+        """
+        errors = []
+        tls_policies = self.tls_policies
+        for domain, mx_config in sorted(self.acceptable_mxs.iteritems()):
             if not mx_config.is_valid():
-                return False
+                errors.append(ValidationError(
+                    'invalid-acceptable-mx', domain,
+                    'Acceptable MX entry for %s must list exactly one MX '
+                    'domain suffix.' % domain))
             for domain_suffix in mx_config.accept_mx_domains:
                 # check to make sure every accepted MX has a TLS policy
-                if not domain_suffix in self.tls_policies:
-                    return False
+                if domain_suffix not in tls_policies:
+                    errors.append(ValidationError(
+                        'missing-tls-policy', domain,
+                        'MX domain suffix %s accepted for %s has no TLS '
+                        'policy.' % (domain_suffix, domain)))
+
         all_mx_hosts = self.get_all_mx_hosts()
-        for domain_suffix, tls_config in self.tls_policies.iteritems():
+        for domain_suffix, tls_config in sorted(tls_policies.iteritems()):
             if not tls_config.is_valid():
-                return False
+                errors.append(ValidationError(
+                    'incomplete-tls-policy', domain_suffix,
+                    'TLS policy for %s is missing required values.' %
+                    domain_suffix))
             # make sure no unclaimed TLS policies have made their way in
             if domain_suffix not in all_mx_hosts:
-                return False
-        return True
-        
+                errors.append(ValidationError(
+                    'orphaned-tls-policy', domain_suffix,
+                    'TLS policy for %s is not used by any acceptable MX '
+                    'entry.' % domain_suffix))
+
+        for domain_suffix, covering_suffix in find_overlapping_suffixes(
+                sorted(tls_policies)):
+            errors.append(ValidationError(
+                'overlapping-tls-policy', domain_suffix,
+                'TLS policy for %s overlaps the policy for %s.' % (
+                    domain_suffix, covering_suffix)))
+
+        errors.extend(self._validate_dates(now))
+        for error in errors:
+            logger.debug('Config validation: %s' % error.message)
+        return errors
+
+    def _validate_dates(self, now=None):
+        errors = []
+        if self.expires is None:
+            return errors
+        if now is None:
+            now_seconds = time.time()
+        else:
+            now_seconds = epoch_seconds(now)
+        expires_seconds = epoch_seconds(self.expires)
+        if expires_seconds <= now_seconds:
+            errors.append(ValidationError(
+                'expired', 'expires',
+                'Config expired at %s.' % self.expires.isoformat()))
+        if (self.timestamp is not None and
+                epoch_seconds(self.timestamp) > expires_seconds):
+            errors.append(ValidationError(
+                'expires-before-timestamp', 'expires',
+                'Config expires before its own timestamp.'))
+        return errors
+
+    def is_valid(self):
+        """Check the MX entries and TLS policies are complete and consistent.
+
+        Expiry and overlapping policies are only reported by validate().
+        """
+        return not any(error.code in INVALID_CONFIG_ERRORS
+                       for error in self.validate())
+
+
+class SectionDiff(collections.namedtuple('SectionDiff',
+                                          ['added', 'removed', 'changed'])):
+    """Changes to one keyed section ('tls-policies' or 'acceptable-mxs').
+
+    'added' and 'removed' map keys to the new and old policy objects,
+    'changed' maps keys to (old, new) policy pairs.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
+def diff_sections(old_section, new_section):
+    added, removed, changed = {}, {}, {}
+    for key, old, new in merge_join(old_section, new_section):
+        if old is None:
+            added[key] = new
+        elif new is None:
+            removed[key] = old
+        elif old is not new and content_key(old) != content_key(new):
+            changed[key] = (old, new)
+    return SectionDiff(added, removed, changed)
+
+
+class ConfigDiff(object):
+    """Change set between two Configs, as returned by Config.diff().
+
+    The policy objects are shared with the compared configs, not copied.
+    to_json_dict() gives a compact form for shipping the change to others.
+    """
+
+    def __init__(self, properties, tls_policies, acceptable_mxs):
+        # property name -> (old value, new value)
+        self.properties = properties
+        self.tls_policies = tls_policies
+        self.acceptable_mxs = acceptable_mxs
+
+    def __len__(self):
+        return (len(self.properties) + len(self.tls_policies) +
+                len(self.acceptable_mxs))
+
+    def __repr__(self):
+        return '< %s properties=%s tls-policies=%d acceptable-mxs=%d >' % (
+            self.__class__.__name__, sorted(self.properties),
+            len(self.tls_policies), len(self.acceptable_mxs))
+
+    def to_json_dict(self):
+        """Serializable change set; 'set' entries replace, 'remove' delete."""
+        new_properties = dict((name.replace('_', '-'), new)
+                              for name, (_old, new) in
+                              self.properties.iteritems())
+        d = {'properties': to_dict(new_properties)}
+        for name, section in (('tls-policies', self.tls_policies),
+                              ('acceptable-mxs', self.acceptable_mxs)):
+            updated = dict(section.added)
+            updated.update((key, new) for key, (_old, new) in
+                           section.changed.iteritems())
+            d[name] = {'set': to_dict(updated),
+                       'remove': sorted(section.removed)}
+        return d
+
 
 class TLSPolicy(BaseConfig):
 
@@ -395,6 +929,23 @@ class TLSPolicy(BaseConfig):
         # self._data['accept-spki-hashs'] = None
         # self._data['error-notification'] = None
 
+    def copy(self, domain_suffix=None):
+        """Return a copy, sharing the interned body if there is one."""
+        policy = TLSPolicy(domain_suffix or self.domain_suffix)
+        if self._body is not None:
+            policy._data = self._data
+            policy._body = self._body
+        else:
+            policy._data = dict(self._data)
+        return policy
+
+    def _writable_data(self):
+        """_data, first made a private copy if it is an interned body."""
+        if self._body is not None:
+            self._data = dict(self._data)
+            self._body = None
+        return self._data
+
     def from_json_dict(self, json_dict):
         for key, val in json_dict.iteritems():
             if key == 'comment':
@@ -445,7 +996,7 @@ class TLSPolicy(BaseConfig):
 
     @comment.setter
     def comment(self, value):
-        self._data['comment'] = verify_string(value, 'comment')
+        self._writable_data()['comment'] = verify_string(value, 'comment')
 
     @property
     def enforce_mode(self):
@@ -453,7 +1004,7 @@ class TLSPolicy(BaseConfig):
 
     @enforce_mode.setter
     def enforce_mode(self, value):
-        self._data['enforce-mode'] = verify_member_of(value, self.ENFORCE_MODES, 'enforce-mode')
+        self._writable_data()['enforce-mode'] = verify_member_of(value, self.ENFORCE_MODES, 'enforce-mode')
 
     @property
     def min_tls_version(self):
@@ -464,7 +1015,7 @@ class TLSPolicy(BaseConfig):
         """TODO: Should this be dealing only with strings processed by map ... lower()?"""
         tls_versions = [ver.lower() for ver in self.TLS_VERSIONS]
         tls_versions.extend(self.TLS_VERSIONS)
-        self._data['min-tls-version'] = verify_member_of(value, tls_versions, 'min-tls-version')
+        self._writable_data()['min-tls-version'] = verify_member_of(value, tls_versions, 'min-tls-version')
         
     @property
     def require_tls(self):
@@ -472,7 +1023,7 @@ class TLSPolicy(BaseConfig):
 
     @require_tls.setter
     def require_tls(self, value):
-        self._data['require-tls'] = parse_bool_from_json(value, 'require-tls')
+        self._writable_data()['require-tls'] = parse_bool_from_json(value, 'require-tls')
 
     @property
     def require_valid_certificate(self):
@@ -480,7 +1031,53 @@ class TLSPolicy(BaseConfig):
 
     @require_valid_certificate.setter
     def require_valid_certificate(self, value):
-        self._data['require-valid-certificate'] = parse_bool_from_json(value, 'require-valid-certificate')
+        self._writable_data()['require-valid-certificate'] = parse_bool_from_json(value, 'require-valid-certificate')
+
+
+class PolicyBody(object):
+    """The immutable content of a TLS policy, shared by every TLSPolicy
+    with the same settings (see intern_tls_policy()).
+
+    Its data dict is never changed; TLSPolicy setters copy it first.
+    """
+    __slots__ = ('data', 'key', '_json_text', '__weakref__')
+
+    def __init__(self, data, key):
+        self.data = data
+        self.key = key
+        self._json_text = {}
+
+    def json_text(self, level):
+        """JSON text of the body at an indent level, built once."""
+        if level not in self._json_text:
+            chunks = []
+            write_json(self.data, chunks.append, level)
+            self._json_text[level] = ''.join(chunks)
+        return self._json_text[level]
+
+
+# content key -> shared PolicyBody, entries go away with their last user
+_tls_policy_bodies = weakref.WeakValueDictionary()
+
+
+def intern_tls_policy(policy):
+    """Make policy share the PolicyBody of every policy with its content.
+
+    Most policies in a real config have identical bodies, so they keep one
+    body between them and compare by its precomputed content key.  The
+    TLSPolicy itself stays mutable and keeps its domain_suffix; changing
+    it gives it a private copy of the data again.  Returns policy.
+    """
+    if policy._body is not None:
+        return policy
+    key = content_key(policy._data)
+    body = _tls_policy_bodies.get(key)
+    if body is None:
+        body = PolicyBody(dict(policy._data), key)
+        _tls_policy_bodies[key] = body
+    policy._data = body.data
+    policy._body = body
+    return policy
 
 
 class AcceptableMX(BaseConfig):
@@ -502,9 +1099,9 @@ class AcceptableMX(BaseConfig):
         return self._data.get('accept-mx-domains')
 
     def add_acceptable_mx(self, domain_suffix):
-        unique_domain_suffixes = set(self._data['accept-mx-domains'])
-        unique_domain_suffixes.add(domain_suffix)
-        self._data['accept-mx-domains'] = list(unique_domain_suffixes)
+        # keep the listed order so serialized configs are stable
+        if domain_suffix not in self._data['accept-mx-domains']:
+            self._data['accept-mx-domains'].append(domain_suffix)
 
     @property
     def comment(self):
@@ -548,8 +1145,8 @@ class AcceptableMX(BaseConfig):
         fresh_policy = super(self.__class__, self).update(newer_policy,
                                                           **kwargs)
         if kwargs.get('merge'):
-            new_accepted_mxs = set(self.accept_mx_domains)
-            new_accepted_mxs = new_accepted_mxs.union(newer_policy.accept_mx_domains)
+            new_accepted_mxs = (self.accept_mx_domains +
+                                newer_policy.accept_mx_domains)
         else:
             new_accepted_mxs = newer_policy.accept_mx_domains
         for domain in new_accepted_mxs:
@@ -564,6 +1161,21 @@ class AcceptableMX(BaseConfig):
         return fresh_policy
 
 
+# validate() codes that make is_valid() false
+INVALID_CONFIG_ERRORS = ('invalid-acceptable-mx', 'missing-tls-policy',
+                         'incomplete-tls-policy', 'orphaned-tls-policy')
+
+
+class ValidationError(collections.namedtuple('ValidationError',
+                                             ['code', 'subject', 'message'])):
+    """One problem found by Config.validate().
+
+    'code' is a short machine readable tag such as 'missing-tls-policy',
+    'subject' is the domain, suffix or property the problem is about.
+    """
+    __slots__ = ()
+
+
 class ConfigError(ValueError):
     def __init__(self, message):
         super(self.__class__, self).__init__(message)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Keep a local copy of the signed STARTTLS Everywhere policy up to date.
+
+A refresh costs one conditional HEAD request when nothing changed.  When the
+policy did change, a signed delta from our version is tried first and the
+full policy is only downloaded if the server has no such delta.
+
+Server layout, relative to the policy URL:
+  <url>                       the full policy JSON
+  <url>.sig                   detached signature of the policy
+  <url>.deltas/<from>.json    change set from version <from> to the latest
+  <url>.deltas/<from>.json.sig
+where versions are the policy 'timestamp' in epoch seconds.  A delta file
+looks like {"from": 1401414363, "to": 1401500000, "changes": {...}} with
+"changes" as produced by Config.ConfigDiff.to_json_dict().
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import urllib2
+
+import AtomicWrite
+import Config
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+POLICY_FILE = 'policy.json'
+STATE_FILE = 'state.json'
+# verification results remembered, oldest are dropped first
+MAX_VERIFIED_ENTRIES = 32
+
+
+class FetchError(IOError): pass
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class GPGVerifier(object):
+    """Check detached signatures with gpg against a fixed keyring."""
+
+    def __init__(self, keyring, gpg='gpg'):
+        self.keyring = keyring
+        self.gpg = gpg
+
+    def __call__(self, data, signature):
+        tmp_dir = tempfile.mkdtemp(prefix='starttls-verify-')
+        data_file = os.path.join(tmp_dir, 'data')
+        signature_file = os.path.join(tmp_dir, 'data.sig')
+        try:
+            with open(data_file, 'wb') as f:
+                f.write(data)
+            with open(signature_file, 'wb') as f:
+                f.write(signature)
+            with open(os.devnull, 'w') as devnull:
+                rc = subprocess.call(
+                    [self.gpg, '--batch', '--no-default-keyring',
+                     '--keyring', self.keyring, '--verify',
+                     signature_file, data_file],
+                    stdout=devnull, stderr=devnull)
+        finally:
+            for path in (data_file, signature_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            os.rmdir(tmp_dir)
+        return rc == 0
+
+
+def config_version(config):
+    """The policy version: its timestamp in whole epoch seconds."""
+    if config is None or config.timestamp is None:
+        return None
+    return int(Config.epoch_seconds(config.timestamp))
+
+
+class PolicyFetcher(object):
+    """Fetch, verify and cache the policy published at policy_url.
+
+    Args:
+      policy_url: canonical URL of the full policy.
+      cache_dir: directory holding the verified policy and fetch state.
+      verifier: callable(data, signature) -> bool, e.g. a GPGVerifier.
+      opener: urllib2 opener, replaceable for testing.
+    """
+
+    def __init__(self, policy_url, cache_dir, verifier, opener=None):
+        self.policy_url = policy_url
+        self.cache_dir = cache_dir
+        self.verifier = verifier
+        self.opener = opener or urllib2.build_opener()
+        self.policy_file = os.path.join(cache_dir, POLICY_FILE)
+        self.state_file = os.path.join(cache_dir, STATE_FILE)
+        self.state = self.load_state()
+        # Kept between refreshes so a long running process parses only once.
+        self.config = None
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+        if not isinstance(state, dict):
+            state = {}
+        state.setdefault('verified', [])
+        return state
+
+    def save_state(self):
+        with AtomicWrite.atomic_write(self.state_file) as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+
+    def local_config(self):
+        """The cached policy, loaded from disk on first use (None if absent)."""
+        if self.config is None and os.path.isfile(self.policy_file):
+            self.config = Config.Config()
+            self.config.load_from_json_file(self.policy_file)
+        return self.config
+
+    def conditional_headers(self):
+        headers = {}
+        if self.state.get('etag'):
+            headers['If-None-Match'] = self.state['etag']
+        if self.state.get('last-modified'):
+            headers['If-Modified-Since'] = self.state['last-modified']
+        return headers
+
+    def open(self, request):
+        """Open a request; returns None for 304 Not Modified and 404."""
+        try:
+            return self.opener.open(request)
+        except urllib2.HTTPError as e:
+            if e.code in (304, 404):
+                return None
+            raise FetchError('Fetching %s failed: %s' % (
+                request.get_full_url(), e))
+        except urllib2.URLError as e:
+            raise FetchError('Fetching %s failed: %s' % (
+                request.get_full_url(), e.reason))
+
+    def download(self, url):
+        response = self.open(urllib2.Request(url))
+        if response is None:
+            return None
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def verify(self, url, data):
+        """Check data against the detached signature at url + '.sig'.
+
+        Positive results are remembered by content hash, so the same signed
+        version is never run through the verifier twice.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.state['verified']:
+            return
+        signature = self.download(url + '.sig')
+        if signature is None or not self.verifier(data, signature):
+            raise FetchError('Bad or missing signature for %s' % url)
+        self.state['verified'].append(digest)
+        del self.state['verified'][:-MAX_VERIFIED_ENTRIES]
+
+    def refresh(self):
+        """Bring the cached policy up to date.
+
+        Returns:
+          A (Config, how) tuple where how is 'unchanged', 'delta' or 'full'.
+        """
+        current = self.local_config()
+        head = self.open(HeadRequest(self.policy_url,
+                                     headers=self.conditional_headers()))
+        if head is None and current is not None:
+            return current, 'unchanged'
+        validators = {}
+        if head is not None:
+            validators = head.info()
+            head.close()
+
+        new_config, how = None, 'full'
+        if current is not None:
+            new_config = self.fetch_delta(current)
+            how = 'delta'
+        if new_config is None:
+            new_config, how = self.fetch_full(current), 'full'
+
+        new_config.write_to_json_file(self.policy_file)
+        self.config = new_config
+        self.state['etag'] = validators.get('ETag')
+        self.state['last-modified'] = validators.get('Last-Modified')
+        self.save_state()
+        logger.info('Policy updated to version %s (%s)' % (
+            config_version(new_config), how))
+        return new_config, how
+
+    def fetch_delta(self, current):
+        """Apply the signed delta from our version.
+
+        Returns None if there is no delta or it is malformed, so the full
+        policy is fetched instead.
+        """
+        version = config_version(current)
+        if version is None:
+            return None
+        delta_url = '%s.deltas/%d.json' % (self.policy_url, version)
+        data = self.download(delta_url)
+        if data is None:
+            return None
+        self.verify(delta_url, data)
+        try:
+            delta = json.loads(data)
+            if delta['from'] != version or delta['to'] < version:
+                raise FetchError('Delta %s does not apply to version %d' % (
+                    delta_url, version))
+            new_config = current.apply_change_set(delta['changes'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warn('Malformed delta %s, fetching the full policy: %s' % (
+                delta_url, e))
+            return None
+        if config_version(new_config) != delta['to']:
+            raise FetchError('Delta %s produced version %s, expected %s' % (
+                delta_url, config_version(new_config), delta['to']))
+        return new_config
+
+    def fetch_full(self, current):
+        data = self.download(self.policy_url)
+        if data is None:
+            raise FetchError('No policy at %s' % self.policy_url)
+        self.verify(self.policy_url, data)
+        new_config = Config.Config()
+        try:
+            new_config.from_json_dict(json.loads(data))
+        except ValueError as e:
+            raise FetchError('Malformed policy %s: %s' % (self.policy_url, e))
+        # Never go back to an older policy than the one we have.
+        if config_version(new_config) < config_version(current):
+            raise FetchError('Fetched policy is older than the cached one')
+        return new_config
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Fetch the signed STARTTLS Everywhere policy')
+    arg_parser.add_argument('policy_url')
+    arg_parser.add_argument('cache_dir')
+    arg_parser.add_argument('--keyring', required=True,
+                            help='gpg keyring with the policy signing key')
+    args = arg_parser.parse_args()
+    logger.setLevel(logging.INFO)
+    fetcher = PolicyFetcher(args.policy_url, args.cache_dir,
+                            GPGVerifier(args.keyring))
+    try:
+        config, how = fetcher.refresh()
+    except FetchError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    print fetcher.policy_file, how
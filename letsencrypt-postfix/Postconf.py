@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Effective Postfix parameter values from a single postconf run.
+
+postconf -x prints every parameter, defaults included, with $name references
+expanded, so one run answers all questions about the running configuration
+(mail_version, data_directory, ...).  The result is cached until main.cf
+changes.
+"""
+import logging
+import os
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+POSTCONF = "/usr/sbin/postconf"
+
+# (postconf, config dir) -> (main.cf stat key, {name: value})
+_snapshots = {}
+
+
+class PostconfError(Exception): pass
+
+
+def parse_postconf(output):
+    """Parse postconf output into a {name: value} dict."""
+    values = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition("=")
+        if sep:
+            values[name.strip()] = value.strip()
+    return values
+
+
+def main_cf_key(config_dir):
+    """What main.cf changes are detected by: its mtime, size and inode."""
+    try:
+        st = os.stat(os.path.join(config_dir, "main.cf"))
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class Postconf(object):
+    """
+    Parameters of the Postfix instance configured in config_dir.
+
+    The first lookup runs postconf once; later ones reuse its output (also
+    across Postconf objects) for as long as main.cf is unchanged.
+    """
+
+    def __init__(self, config_dir, postconf=POSTCONF):
+        self.config_dir = config_dir
+        self.postconf = postconf
+
+    def snapshot(self):
+        """Return all effective parameter values as a dict."""
+        cache_key = (self.postconf, os.path.abspath(self.config_dir))
+        stat_key = main_cf_key(self.config_dir)
+        cached = _snapshots.get(cache_key)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        cmd = subprocess.Popen([self.postconf, "-c", self.config_dir, "-x"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = cmd.communicate()
+        if cmd.returncode != 0:
+            raise PostconfError("postconf -c %s failed: %s" % (
+                self.config_dir, stderr.strip()))
+        values = parse_postconf(stdout)
+        _snapshots[cache_key] = (stat_key, values)
+        return values
+
+    def get(self, name, default=None):
+        return self.snapshot().get(name, default)
+
+    def version(self):
+        """The Postfix version as a tuple, e.g. (2, 11, 3)."""
+        mail_version = self.get("mail_version")
+        if not mail_version:
+            raise PostconfError("postconf did not report mail_version")
+        # snapshot releases look like 3.4-20181125
+        return tuple(int(i) for i in
+                     mail_version.split("-")[0].split("."))
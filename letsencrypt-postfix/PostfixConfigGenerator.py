@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 
+import collections
+import hashlib
+import json
 import logging
 import sys
-import string
 import subprocess
+import time
 import os, os.path
 
+import AtomicWrite
+import CABundle
+import Cdb
+import Checkpoints
+import Config
+import Postconf
+import PostfixLogSummary
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -29,32 +40,172 @@ def parse_line(line_data):
     return (num, left.strip(), right.strip())
 
 
+class CfEntry(collections.namedtuple('CfEntry',
+                                      ['name', 'value', 'first', 'last'])):
+    """One parameter setting in main.cf, spanning raw lines first..last."""
+    __slots__ = ()
+
+    def line_numbers(self):
+        return range(self.first, self.last + 1)
+
+
+def parse_main_cf(raw_lines):
+    """
+    Index main.cf in a single pass: parameter name -> list of CfEntry in
+    file order.
+
+    Following postfix's rules a line starting with whitespace continues the
+    previous logical line, and blank lines and comment lines are skipped
+    (they do not end a logical line).
+    """
+    index = collections.OrderedDict()
+    logical = None   # [first line number, last line number, text]
+
+    def finish(logical):
+        parsed = parse_line((logical[0], logical[2]))
+        if parsed:
+            num, name, value = parsed
+            index.setdefault(name, []).append(
+                CfEntry(name, value, logical[0], logical[1]))
+
+    for num, line in enumerate(raw_lines):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if line[0] in " \t" and logical is not None:
+            logical[1] = num
+            logical[2] += " " + stripped
+            continue
+        if logical is not None:
+            finish(logical)
+        logical = [num, num, stripped]
+    if logical is not None:
+        finish(logical)
+    return index
+
+
 class ExistingConfigError(ValueError): pass
 
 
+POSTFIX = "/usr/sbin/postfix"
+
+
+# Lookup table types for the policy map.  texthash is read into memory by
+# every smtp process; the others are indexed files postfix opens directly.
+# cdb is built in-process, the rest with postmap.
+POLICY_MAP_TYPES = ("texthash", "cdb", "hash", "btree", "lmdb")
+POLICY_MAP_SUFFIXES = {"cdb": ".cdb", "hash": ".db", "btree": ".db",
+                       "lmdb": ".lmdb"}
+# TLS session cache: btree is available wherever postfix is; lmdb
+# (postfix >= 2.11 when built with it) is accepted if already configured.
+SESSION_CACHE_TYPES = ("btree", "lmdb")
+SESSION_CACHE_DATABASE = "btree:${data_directory}/smtp_scache"
+# smtp_tls_session_cache_timeout per deployment profile.  Busy relays
+# revisit the same MXs often and do fine with postfix's default; hosts
+# that deliver to a domain only now and then need entries to live longer
+# to get any resumptions at all (postfix caps this at 8640000s).
+SESSION_CACHE_PROFILES = {"relay": "3600s", "low-volume": "86400s"}
+# our policy map, in each config dir
+POLICY_FILE_NAME = "starttls_everywhere_policy"
+# hash of the last generated policy map, beside the map itself
+MANIFEST_SUFFIX = ".manifest"
+# title of the checkpoint a command line deploy saves
+DEPLOY_CHECKPOINT_TITLE = "STARTTLS Everywhere deploy"
+# validation errors that would leave the policy map we write wrong; the
+# rest (expiry, enforce-mode, ...) do not change what we write
+FATAL_VALIDATION_ERRORS = ("missing-tls-policy",)
+
+
+def fatal_validation_errors(policy_config):
+    """
+    Return the problems in policy_config that the policy map would inherit:
+    FATAL_VALIDATION_ERRORS, acceptable MX entries without an MX domain and
+    TLS policies without the min-tls-version policy_entry() writes.
+    """
+    errors = [error for error in policy_config.validate()
+              if error.code in FATAL_VALIDATION_ERRORS]
+    for domain, properties in sorted(
+            policy_config.acceptable_mxs.iteritems()):
+        if not properties.accept_mx_domains:
+            errors.append(Config.ValidationError(
+                'invalid-acceptable-mx', domain,
+                'Acceptable MX entry for %s lists no MX domain.' % domain))
+    for domain_suffix, policy in sorted(
+            policy_config.tls_policies.iteritems()):
+        if not policy.min_tls_version:
+            errors.append(Config.ValidationError(
+                'incomplete-tls-policy', domain_suffix,
+                'TLS policy for %s has no min-tls-version.' % domain_suffix))
+    return errors
+
+
 class PostfixConfigGenerator:
     def __init__(self,
                  policy_config,
                  postfix_dir,
                  fixup=False,
                  fopen=open,
-                 version=None):
+                 version=None,
+                 policy_map_type="texthash",
+                 ca_sources=CABundle.DEFAULT_CA_SOURCES,
+                 ca_path=None,
+                 certs_observed=None,
+                 postconf=Postconf.POSTCONF,
+                 session_cache_profile=None,
+                 connection_cache_log=None,
+                 connection_cache_top=20,
+                 connection_cache_min=100,
+                 checkpoint_dir=None):
+        if policy_map_type not in POLICY_MAP_TYPES:
+            raise ValueError("Unsupported policy map type %s, use one of %s"
+                             % (policy_map_type, ", ".join(POLICY_MAP_TYPES)))
+        if (session_cache_profile is not None and
+                session_cache_profile not in SESSION_CACHE_PROFILES):
+            raise ValueError("Unknown session cache profile %s, use one of %s"
+                             % (session_cache_profile,
+                                ", ".join(sorted(SESSION_CACHE_PROFILES))))
         self.fixup          = fixup
+        self.policy_map_type = policy_map_type
+        self.session_cache_profile = session_cache_profile
+        # mail log to pick the busiest policy domains for connection reuse
+        self.connection_cache_log = connection_cache_log
+        self.connection_cache_top = connection_cache_top
+        self.connection_cache_min = connection_cache_min
         self.postfix_dir    = postfix_dir
         self.policy_config  = policy_config
-        self.policy_file    = os.path.join(postfix_dir,
-                                           "starttls_everywhere_policy")
+        self.policy_file    = os.path.join(postfix_dir, POLICY_FILE_NAME)
         self.ca_file = os.path.join(postfix_dir, "starttls_everywhere_CAfile")
+        self.connection_cache_file = os.path.join(
+            postfix_dir, "starttls_everywhere_connection_cache")
+        self.ca_sources = ca_sources
+        # optional hashed directory of the same roots for smtp_tls_CApath
+        self.ca_path = ca_path
+        # chains saved by tools/CheckSTARTTLS.py; if set, only the roots
+        # that issued them go into the bundle
+        self.certs_observed = certs_observed
 
         self.additions = []
-        self.deletions = []
+        # raw line numbers to comment out when fixing up
+        self.deletions = set()
+        # files we actually rewrote; restart() is a no-op while it's empty
+        self.changed_files = set()
+        self.checkpoints = Checkpoints.CheckpointStore(
+            checkpoint_dir or
+            os.path.join(postfix_dir, "starttls_everywhere_checkpoints"))
+        # path -> digest of its contents before we first changed it, or None
+        # if it did not exist; goes into a checkpoint on save()
+        self.originals = {}
         self.fn = self.find_postfix_cf()
         self.raw_cf = fopen(self.fn).readlines()
-        self.cf = map(string.strip, self.raw_cf)
-        #self.cf = [line for line in cf if line and not line.startswith("#")]
+        # parameter name -> [CfEntry], all lookups go through this
+        self.cf_index = parse_main_cf(self.raw_cf)
         self.policy_lines = []
-        self.new_cf = ""
+        # [(domain, old entry, new entry)] from the last policy map update
+        self.policy_changes = []
+        self.policy_text_hash = None
 
+        # effective parameter values, from one postconf run
+        self.postconf = Postconf.Postconf(postfix_dir, postconf)
         # Set in .prepare() unless running in a test
         self.postfix_version = version
 
@@ -69,30 +220,34 @@ class PostfixConfigGenerator:
         """
         acceptable = [ideal] + also_acceptable
 
-        l = [(num,line) for num,line in enumerate(self.cf)
-             if line.startswith(var)]
-        if not any(l):
+        entries = self.cf_index.get(var)
+        if not entries:
             self.additions.append(var + " = " + ideal)
+            return
+        values = set(entry.value for entry in entries)
+        if len(values) > 1:
+            if not self.fixup:
+                raise ExistingConfigError(
+                    "Conflicting existing config values " +
+                    repr([(e.first, e.name, e.value) for e in entries])
+                )
         else:
-            values = map(parse_line, l)
-            if len(set(values)) > 1:
-                if self.fixup:
-                    conflicting_lines = [num for num,_var,val in values]
-                    self.deletions.extend(conflicting_lines)
-                    self.additions.append(var + " = " + ideal)
-                else:
-                    raise ExistingConfigError(
-                        "Conflicting existing config values " + `l`
-                    )
-            val = values[0][2]
-            if val not in acceptable:
-                if self.fixup:
-                    self.deletions.append(values[0][0])
-                    self.additions.append(var + " = " + ideal)
-                else:
-                    raise ExistingConfigError(
-                        "Existing config has %s=%s"%(var,val)
-                    )
+            # postfix uses the last setting, which is the only value here
+            val = entries[-1].value
+            if val in acceptable:
+                return
+            if not self.fixup:
+                raise ExistingConfigError(
+                    "Existing config has %s=%s"%(var,val)
+                )
+        for entry in entries:
+            self.deletions.update(entry.line_numbers())
+        self.additions.append(var + " = " + ideal)
+
+    def get_cf_value(self, var):
+        """Return the effective (last) value of @var in main.cf, or None."""
+        entries = self.cf_index.get(var)
+        return entries[-1].value if entries else None
 
     def wrangle_existing_config(self):
         """
@@ -106,10 +261,12 @@ class PostfixConfigGenerator:
         # Maximum verbosity lets us collect failure information
         self.ensure_cf_var("smtp_tls_loglevel", "1", [])
         # Inject a reference to our per-domain policy map
-        policy_cf_entry = "texthash:" + self.policy_file
+        policy_cf_entry = self.policy_map_type + ":" + self.policy_file
 
         self.ensure_cf_var("smtp_tls_policy_maps", policy_cf_entry, [])
         self.ensure_cf_var("smtp_tls_CAfile", self.ca_file, [])
+        if self.ca_path:
+            self.ensure_cf_var("smtp_tls_CApath", self.ca_path, [])
 
 	# Disable SSLv2 and SSLv3. Syntax for `smtp_tls_protocols` changed
 	# between Postfix version 2.5 and 2.6, since we only support => 2.11
@@ -121,61 +278,333 @@ class PostfixConfigGenerator:
 	self.ensure_cf_var("smtp_tls_protocols", "!SSLv2, !SSLv3", [])
 	self.ensure_cf_var("smtp_tls_mandatory_protocols", "!SSLv2, !SSLv3", [])
 
-    def maybe_add_config_lines(self, fopen=open):
+        self.ensure_tls_session_cache()
+
+    def ensure_tls_session_cache(self):
+        """
+        Make sure the smtp client caches TLS sessions, so the deliveries our
+        policy forces onto TLS can resume sessions instead of doing a full
+        handshake each time.
+        """
+        current = self.get_cf_value("smtp_tls_session_cache_database")
+        also_acceptable = []
+        if current and current != SESSION_CACHE_DATABASE:
+            map_type, _, _ = current.partition(":")
+            if (map_type in SESSION_CACHE_TYPES and self.in_data_directory(
+                    "smtp_tls_session_cache_database")):
+                also_acceptable.append(current)
+        self.ensure_cf_var("smtp_tls_session_cache_database",
+                           SESSION_CACHE_DATABASE, also_acceptable)
+        # Without an explicit profile the timeout is left to the operator
+        # (or postfix's default).
+        if self.session_cache_profile is not None:
+            self.ensure_cf_var(
+                "smtp_tls_session_cache_timeout",
+                SESSION_CACHE_PROFILES[self.session_cache_profile], [])
+        if self.policy_config is not None:
+            domains, mx_suffixes = self.session_cache_beneficiaries()
+            logger.info('TLS session cache serves {} policy domains over {} '
+                        'MX domains'.format(domains, mx_suffixes))
+
+    def in_data_directory(self, var):
+        """
+        Whether the file of the "type:path" table @var is inside postfix's
+        data_directory, comparing the effective paths with symlinks resolved.
+        """
+        data_directory = self.get_effective_value("data_directory")
+        _, _, path = (self.get_effective_value(var) or "").partition(":")
+        if not data_directory or not path:
+            return False
+        return os.path.realpath(path).startswith(
+            os.path.join(os.path.realpath(data_directory), ""))
+
+    def session_cache_beneficiaries(self):
+        """
+        Return (address domains, distinct MX suffixes) that our policy map
+        sends over TLS.  Sessions are cached per MX, so domains sharing an
+        MX also share its cached sessions.
+        """
+        domains = 0
+        mx_suffixes = set()
+        for properties in self.policy_config.acceptable_mxs.values():
+            # set_domainwise_tls_policies requires TLS to the first MX
+            mx_domain = properties.accept_mx_domains[0]
+            if self.policy_config.get_tls_policy(mx_domain) is not None:
+                domains += 1
+                mx_suffixes.add(mx_domain)
+        return domains, len(mx_suffixes)
+
+    def iter_new_cf(self):
+        """
+        Yield the lines of the rewritten main.cf: the original lines, with
+        deleted ones commented out when fixing up, followed by our additions.
+        """
+        deletions = self.deletions if self.fixup else set()
+        for num, line in enumerate(self.raw_cf):
+            if num in deletions:
+                yield "# Line removed by STARTTLS Everywhere\n# " + line
+            else:
+                yield line
+        if self.raw_cf and not self.raw_cf[-1].endswith("\n"):
+            yield "\n"
+        header = ["#", "# New config lines added by STARTTLS Everywhere", "#"]
+        for line in header + self.additions:
+            yield line + "\n"
+
+    def maybe_add_config_lines(self, fopen=None):
+        """
+        Rewrite main.cf if our additions change it.
+
+        The new file is streamed to a temporary file beside main.cf and
+        renamed over it, so postfix never reads a half written main.cf.
+        ensure_cf_var() only adds lines for settings that are missing or
+        wrong, so without additions nothing is written.
+        """
         if not self.additions:
             return
         if self.fixup:
-            logger.info('Deleting lines: {}'.format(self.deletions))
-        self.additions[:0]=["#",
-                            "# New config lines added by STARTTLS Everywhere",
-                            "#"]
-        new_cf_lines = "\n".join(self.additions) + "\n"
+            logger.info('Deleting lines: {}'.format(sorted(self.deletions)))
         logger.info('Adding to {}:'.format(self.fn))
-        logger.info(new_cf_lines)
-        if self.raw_cf[-1][-1] == "\n":         sep = ""
-        else:                                   sep = "\n"
+        logger.info("\n".join(self.additions))
 
-        for num, line in enumerate(self.raw_cf):
-            if self.fixup and num in self.deletions:
-                self.new_cf += "# Line removed by STARTTLS Everywhere\n# " + line
-            else:
-                self.new_cf += line
-        self.new_cf += sep + new_cf_lines
-
-        if not os.access(self.fn, os.W_OK):
-            raise Exception("Can't write to %s, please re-run as root."
-                % self.fn)
-        with fopen(self.fn, "w") as f:
-            f.write(self.new_cf)
-
-    def set_domainwise_tls_policies(self, fopen=open):
-        all_acceptable_mxs = self.policy_config.acceptable_mxs
-        for address_domain, properties in all_acceptable_mxs.items():
-            mx_list = properties.accept_mx_domains
-            if len(mx_list) > 1:
-                logger.warn('Lists of multiple accept-mx-domains not yet '
-                            'supported.')
-                logger.warn('Using MX {} for {}'.format(mx_list[0],
-                                                        address_domain)
-                           )
-                logger.warn('Ignoring: {}'.format(', '.join(mx_list[1:])))
-            mx_domain = mx_list[0]
-            mx_policy = self.policy_config.get_tls_policy(mx_domain)
-            entry = address_domain + " encrypt"
-            if mx_policy.min_tls_version.lower() == "tlsv1":
-                entry += " protocols=!SSLv2:!SSLv3"
-            elif mx_policy.min_tls_version.lower() == "tlsv1.1":
-                entry += " protocols=!SSLv2:!SSLv3:!TLSv1"
-            elif mx_policy.min_tls_version.lower() == "tlsv1.2":
-                entry += " protocols=!SSLv2:!SSLv3:!TLSv1:!TLSv1.1"
-            else:
-                logger.warn('Unknown minimum TLS version: {} '.format(
-                    mx_policy.min_tls_version)
-                )
-            self.policy_lines.append(entry)
+        if fopen is not None:
+            with fopen(self.fn, "w") as f:
+                f.writelines(self.iter_new_cf())
+        else:
+            cf_dir = os.path.dirname(os.path.abspath(self.fn))
+            if not (os.access(self.fn, os.W_OK) and
+                    os.access(cf_dir, os.W_OK)):
+                raise Exception("Can't write to %s, please re-run as root."
+                    % self.fn)
+            self.record_original(self.fn)
+            with AtomicWrite.atomic_write(self.fn) as f:
+                f.writelines(self.iter_new_cf())
+        self.changed_files.add(self.fn)
+
+    def policy_entry(self, address_domain, properties, mx_entries=None):
+        """
+        Return the policy map value for one address domain.  mx_entries,
+        if given, caches the value of each MX domain across calls.
+        """
+        mx_list = properties.accept_mx_domains
+        if len(mx_list) > 1:
+            logger.warn('Lists of multiple accept-mx-domains not yet '
+                        'supported.')
+            logger.warn('Using MX {} for {}'.format(mx_list[0],
+                                                    address_domain)
+                       )
+            logger.warn('Ignoring: {}'.format(', '.join(mx_list[1:])))
+        mx_domain = mx_list[0]
+        if mx_entries is not None and mx_domain in mx_entries:
+            return mx_entries[mx_domain]
+        mx_policy = self.policy_config.get_tls_policy(mx_domain)
+        min_tls_version = mx_policy.min_tls_version.lower()
+        entry = "encrypt"
+        if min_tls_version == "tlsv1":
+            entry += " protocols=!SSLv2:!SSLv3"
+        elif min_tls_version == "tlsv1.1":
+            entry += " protocols=!SSLv2:!SSLv3:!TLSv1"
+        elif min_tls_version == "tlsv1.2":
+            entry += " protocols=!SSLv2:!SSLv3:!TLSv1:!TLSv1.1"
+        else:
+            logger.warn('Unknown minimum TLS version: {} '.format(
+                mx_policy.min_tls_version)
+            )
+        if mx_entries is not None:
+            mx_entries[mx_domain] = entry
+        return entry
+
+    def set_domainwise_tls_policies(self, fopen=None):
+        """
+        Bring the policy map in line with the policy config.
+
+        A manifest beside the map records the hash of the map we wrote last.
+        If the map on disk still has that hash and its entries match the new
+        ones, nothing is touched and restart() will not reload postfix.
+        The manifest stays marked pending until postfix has been reloaded
+        (see complete_policy_manifest), so a deploy that fails part way is
+        redone in full by the next run.
+        """
+        # many address domains share an MX, and so its entry
+        mx_entries = {}
+        entries = {}
+        for address_domain, properties in \
+                self.policy_config.acceptable_mxs.iteritems():
+            entries[address_domain] = self.policy_entry(
+                address_domain, properties, mx_entries)
+        # sorted so the same policy always produces the same file
+        domains = sorted(entries)
+        self.policy_lines = [domain + " " + entries[domain]
+                             for domain in domains]
+
+        previous = self.load_policy_entries()
+        if previous is None:
+            # a full rebuild, every entry is new
+            self.policy_changes = [(domain, None, entries[domain])
+                                   for domain in domains]
+        else:
+            self.policy_changes = [
+                (domain, old, new)
+                for domain, old, new in Config.merge_join(previous, entries)
+                if old != new]
+        if previous is not None and not self.policy_changes:
+            logger.info('{} is already up to date'.format(self.policy_file))
+            return
+        logger.info('{} policy map entries changed'.format(
+            len(self.policy_changes)))
+        self.write_policy_map(fopen, patch=previous is not None)
+        self.save_policy_manifest()
+
+    def policy_map_file(self):
+        """The file postfix opens for our policy map."""
+        return self.policy_file + POLICY_MAP_SUFFIXES.get(
+            self.policy_map_type, "")
+
+    def load_policy_entries(self):
+        """
+        Return the {domain: entry} we wrote last time, or None if the map
+        files on disk are not (or no longer) the ones we generated.
+        """
+        try:
+            with open(self.policy_file + MANIFEST_SUFFIX) as f:
+                manifest = json.load(f)
+            with open(self.policy_file, "rb") as f:
+                data = f.read()
+        except (IOError, ValueError):
+            return None
+        if (manifest.get("pending") or
+                manifest.get("map_type") != self.policy_map_type or
+                manifest.get("sha256") != hashlib.sha256(data).hexdigest() or
+                not os.path.isfile(self.policy_map_file())):
+            return None
+        entries = {}
+        for line in data.decode("utf-8").splitlines():
+            domain, _, entry = line.partition(" ")
+            entries[domain] = entry
+        return entries
+
+    def save_policy_manifest(self):
+        manifest = {"map_type": self.policy_map_type,
+                    "sha256": self.policy_text_hash,
+                    "pending": True}
+        # not synced: a manifest lost in a crash only costs a full rebuild
+        with AtomicWrite.atomic_write(self.policy_file + MANIFEST_SUFFIX,
+                                      fsync=False) as f:
+            json.dump(manifest, f, sort_keys=True)
+
+    def write_policy_map(self, fopen=None, patch=False):
+        """
+        Write policy_lines as the text policy map and, for indexed map
+        types, build the file postfix actually opens from it.
+
+        With patch, postmap updates an existing indexed map in place with
+        just the entries in policy_changes rather than rebuilding it.
+        """
+        text = "\n".join(self.policy_lines) + "\n"
+        self.policy_text_hash = hashlib.sha256(
+            text.encode("utf-8")).hexdigest()
+        if fopen is not None:
+            with fopen(self.policy_file, "w") as f:
+                f.write(text)
+        else:
+            self.record_original(self.policy_file)
+            with AtomicWrite.atomic_write(self.policy_file) as f:
+                f.write(text)
+        self.changed_files.add(self.policy_file)
+        if self.policy_map_type == "texthash":
+            return
+        map_file = self.policy_map_file()
+        self.record_original(map_file)
+        if self.policy_map_type == "cdb":
+            # postfix folds lookup keys to lower case
+            entries = (line.partition(" ") for line in self.policy_lines)
+            with AtomicWrite.atomic_write(map_file, "wb") as f:
+                Cdb.write_cdb(f, ((domain.lower().encode("utf-8"),
+                                   value.encode("utf-8"))
+                                  for domain, _, value in entries))
+        elif patch:
+            self.postmap_patch(self.policy_map_type, self.policy_file,
+                               self.policy_changes)
+        else:
+            self.postmap(self.policy_map_type, self.policy_file)
+        self.changed_files.add(map_file)
+
+    def connection_cache_destinations(self, counts):
+        """
+        Pick the policy domains worth keeping SMTP connections open for.
+
+        counts is PostfixLogSummary.get_counts() output, keyed by the
+        comma separated policy domains served by each MX; every domain of
+        an MX is credited with all TLS connections to it.
+
+        Returns:
+          Up to connection_cache_top domains with at least
+          connection_cache_min connections, busiest first.
+        """
+        volume = collections.defaultdict(int)
+        for domains, validations in counts.items():
+            for domain in domains.split(", "):
+                volume[domain] += validations["all"]
+        busy = [(-connections, domain)
+                for domain, connections in volume.items()
+                if connections >= self.connection_cache_min and
+                domain in self.policy_config.acceptable_mxs]
+        busy.sort()
+        return [domain for _, domain in busy[:self.connection_cache_top]]
 
-        with fopen(self.policy_file, "w") as f:
-            f.write("\n".join(self.policy_lines) + "\n")
+    def set_connection_cache_destinations(self):
+        """
+        Turn on SMTP connection caching for the busiest policy domains in
+        connection_cache_log, so repeated deliveries to them reuse one TLS
+        connection instead of handshaking for every message.
+        """
+        with open(self.connection_cache_log) as log:
+            counts = PostfixLogSummary.get_counts(log, self.policy_config,
+                                                  0)[0]
+        destinations = self.connection_cache_destinations(counts)
+        logger.info('Caching connections to {} policy domains'.format(
+            len(destinations)))
+        text = "".join(domain + " cache\n" for domain in destinations)
+        try:
+            with open(self.connection_cache_file) as f:
+                unchanged = f.read() == text
+        except IOError:
+            unchanged = False
+        if not unchanged:
+            self.record_original(self.connection_cache_file)
+            with AtomicWrite.atomic_write(self.connection_cache_file) as f:
+                f.write(text)
+            self.changed_files.add(self.connection_cache_file)
+        self.ensure_cf_var("smtp_connection_cache_destinations",
+                           "texthash:" + self.connection_cache_file, [])
+
+    def postmap(self, map_type, source_file):
+        rc = subprocess.call(["/usr/sbin/postmap",
+                              "%s:%s" % (map_type, source_file)])
+        if rc != 0:
+            raise Exception("PluginError: postmap failed for %s:%s"
+                            % (map_type, source_file))
+
+    def postmap_patch(self, map_type, source_file, changes):
+        """
+        Apply [(key, old value, new value)] to an existing indexed map:
+        removed keys are deleted, the others inserted or replaced.
+        """
+        map_name = "%s:%s" % (map_type, source_file)
+        deleted = [key for key, _, new in changes if new is None]
+        updated = [key + " " + new for key, _, new in changes
+                   if new is not None]
+        for args, lines in ((["-d", "-"], deleted), (["-i"], updated)):
+            if not lines:
+                continue
+            cmd = subprocess.Popen(["/usr/sbin/postmap"] + args + [map_name],
+                                   stdin=subprocess.PIPE)
+            cmd.communicate(("\n".join(lines) + "\n").encode("utf-8"))
+            # postmap -d exits 2 when none of the keys were found
+            ok = (0, 2) if args[0] == "-d" else (0,)
+            if cmd.returncode not in ok:
+                raise Exception("PluginError: postmap %s failed for %s"
+                                % (" ".join(args), map_name))
 
     ### Let's Encrypt client IPlugin ###
     # https://github.com/letsencrypt/letsencrypt/blob/master/letsencrypt/plugins/common.py#L35
@@ -261,17 +690,18 @@ class PostfixConfigGenerator:
         :raises .PluginError:
             Unable to find Postfix version.
         """
-	# Parse Postfix version number (feature support, syntax changes etc.)
-	cmd = subprocess.Popen(['/usr/sbin/postconf', '-d', 'mail_version'],
-                               stdout=subprocess.PIPE)
-        stdout, _ = cmd.communicate()
-        if cmd.returncode != 0:
-            raise Exception('PluginError: Unable to determine Postfix version.')
+        try:
+            return self.postconf.version()
+        except (Postconf.PostconfError, OSError, ValueError) as e:
+            raise Exception('PluginError: Unable to determine Postfix '
+                            'version: %s' % e)
 
-        # grabs version component of string like "mail_version = 2.11.3"
-        mail_version = stdout.split()[2]
-        postfix_version = tuple([int(i) for i in mail_version.split('.')])
-	return postfix_version
+    def get_effective_value(self, var):
+        """
+        Return what postfix actually uses for @var, defaults included and
+        $references expanded, or None for unknown parameters.
+        """
+        return self.postconf.get(var)
 
     def more_info(self):
         """Human-readable string to help the user.
@@ -299,10 +729,9 @@ class PostfixConfigGenerator:
         """
         var_names = ('myhostname', 'mydomain', 'myorigin')
         names_found = set()
-        for num, line in enumerate(self.cf):
-            num, found_var, found_value = parse_line((num, line))
-            if found_var in var_names:
-                names_found.add(found_value)
+        for var in var_names:
+            for entry in self.cf_index.get(var, []):
+                names_found.add(entry.value)
         name_list = list(names_found)
         name_list.sort()
         return name_list
@@ -321,6 +750,8 @@ class PostfixConfigGenerator:
         self.ensure_cf_var("smtpd_tls_cert_file", fullchain_path, [])
         self.ensure_cf_var("smtpd_tls_key_file", key_path, [])
         self.set_domainwise_tls_policies()
+        if self.connection_cache_log:
+            self.set_connection_cache_destinations()
         self.update_CAfile()
 
     def enhance(self, domain, enhancement, options=None):
@@ -354,10 +785,8 @@ class PostfixConfigGenerator:
         cert_materials = {'smtpd_tls_key_file': None,
                           'smtpd_tls_cert_file': None,
                          }
-        for num, line in enumerate(self.cf):
-            num, found_var, found_value = parse_line((num, line))
-            if found_var in cert_materials.keys():
-                cert_materials[found_var] = found_value
+        for var in cert_materials.keys():
+            cert_materials[var] = self.get_cf_value(var)
 
         if not all(cert_materials.values()):
             cert_material_tuples = []
@@ -381,11 +810,32 @@ class PostfixConfigGenerator:
         :raises .PluginError: when save is unsuccessful
         """
         self.maybe_add_config_lines()
+        try:
+            if temporary:
+                self.checkpoints.add(self.originals, Checkpoints.TEMPORARY)
+            else:
+                self.checkpoints.add(self.originals)
+                if title:
+                    self.checkpoints.finalize(title)
+        except (Checkpoints.CheckpointError, EnvironmentError) as e:
+            raise Exception("PluginError: cannot save checkpoint: %s" % e)
+        self.originals = {}
+
+    def record_original(self, path):
+        """Keep path's current contents for the next checkpoint; call
+        before changing it."""
+        if path not in self.originals:
+            self.originals[path] = self.checkpoints.store_blob(path)
 
     def rollback_checkpoints(self, rollback=1):
         """Revert `rollback` number of configuration checkpoints.
         :raises .PluginError: when configuration cannot be fully reverted
         """
+        try:
+            restored = self.checkpoints.rollback(rollback)
+        except (Checkpoints.CheckpointError, EnvironmentError) as e:
+            raise Exception("PluginError: cannot roll back: %s" % e)
+        self.changed_files.update(restored)
 
     def recovery_routine(self):
         """Revert configuration to most recent finalized checkpoint.
@@ -394,20 +844,33 @@ class PostfixConfigGenerator:
         execution interruptions.
         :raises .errors.PluginError: If unable to recover the configuration
         """
+        try:
+            restored = self.checkpoints.recover()
+        except (Checkpoints.CheckpointError, EnvironmentError) as e:
+            raise Exception("PluginError: cannot recover: %s" % e)
+        self.changed_files.update(restored)
 
     def view_config_changes(self):
         """Display all of the LE config changes.
         :raises .PluginError: when config changes cannot be parsed
         """
+        try:
+            checkpoints = self.checkpoints.checkpoints()
+        except Checkpoints.CheckpointError as e:
+            raise Exception("PluginError: %s" % e)
+        for checkpoint in reversed(checkpoints):
+            sys.stdout.write("{} {}\n".format(
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(checkpoint["timestamp"])),
+                checkpoint["title"]))
+            for path in sorted(checkpoint["files"]):
+                sys.stdout.write("    {}\n".format(path))
 
     def config_test(self):
         """Make sure the configuration is valid.
         :raises .MisconfigurationError: when the config is not in a usable state
         """
-        if os.geteuid() != 0:
-            rc = os.system('sudo /usr/sbin/postfix check')
-        else:
-            rc = os.system('/usr/sbin/postfix check')
+        rc = self.postfix_command("check")
         if rc != 0:
             raise Exception('MisconfigurationError: Postfix failed self-check.')
 
@@ -415,41 +878,282 @@ class PostfixConfigGenerator:
         """Restart or refresh the server content.
         :raises .PluginError: when server cannot be restarted
         """
-        logger.info('Reloading postfix config...')
-        if os.geteuid() != 0:
-            rc = os.system("sudo service postfix reload")
+        if not self.changed_files:
+            logger.info('No configuration changes, not reloading postfix.')
         else:
-            rc = os.system("service postfix reload")
-        if rc != 0:
-            raise Exception('PluginError: cannot restart postfix')
+            logger.info('Reloading postfix config...')
+            rc = self.postfix_command("reload")
+            if rc != 0:
+                raise Exception('PluginError: cannot restart postfix')
+        complete_policy_manifest(self.policy_file)
+
+    def postfix_command(self, *args):
+        """Run postfix(1) for our instance, through sudo unless root."""
+        return start_postfix(self.postfix_dir, args).wait()
 
     def update_CAfile(self):
-        os.system("cat /usr/share/ca-certificates/mozilla/*.crt > " + self.ca_file)
+        """
+        Rebuild the CA bundle (and CApath directory) from ca_sources,
+        rewriting them only if their certificates changed.  If a source
+        cannot be read, an existing bundle is kept as it is.
+        """
+        try:
+            certs = CABundle.read_certificates(self.ca_sources)
+        except (IOError, OSError) as e:
+            if not os.path.isfile(self.ca_file):
+                raise Exception("PluginError: cannot read CA certificates: "
+                                "%s" % e)
+            logger.warn('Cannot read CA certificates, keeping {}: {}'.format(
+                self.ca_file, e))
+            return
+        if self.certs_observed:
+            issuers, unobserved = CABundle.observed_issuers(
+                self.certs_observed, self.policy_config.acceptable_mxs)
+            roots = CABundle.used_roots(certs, issuers)
+            if roots:
+                logger.info('Keeping {} of {} CA certificates'.format(
+                    len(roots), len(certs)))
+                if unobserved:
+                    logger.warn('No certificates observed for {} mail '
+                                'domains, their roots may be missing'.format(
+                                    unobserved))
+                certs = roots
+            else:
+                logger.warn('No observed certificate was issued by a known '
+                            'CA, keeping all of them')
+        if not certs:
+            raise Exception("PluginError: no CA certificates found in %s"
+                            % ", ".join(self.ca_sources))
+        recorded = self.ca_file in self.originals
+        self.record_original(self.ca_file)
+        if CABundle.write_bundle(self.ca_file, certs):
+            self.changed_files.add(self.ca_file)
+        elif not recorded:
+            # unchanged, so not part of the next checkpoint
+            del self.originals[self.ca_file]
+        if self.ca_path and CABundle.write_ca_path(self.ca_path, certs):
+            self.changed_files.add(self.ca_path)
+
+
+def start_postfix(config_dir, args, postfix=POSTFIX):
+    """Start postfix(1) for the instance in config_dir; returns the Popen."""
+    cmd = [postfix, "-c", config_dir] + list(args)
+    if os.geteuid() != 0:
+        cmd = ["sudo"] + cmd
+    return subprocess.Popen(cmd)
+
+
+### postmulti(1) multi-instance support ###
+
+POSTMULTI = "/usr/sbin/postmulti"
+
+
+class PostfixInstance(collections.namedtuple(
+        'PostfixInstance', ['name', 'group', 'enabled', 'config_dir'])):
+    """One line of postmulti -l output."""
+    __slots__ = ()
+
+
+def parse_postmulti(output):
+    """Parse postmulti -l output into PostfixInstances."""
+    instances = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4:
+            name, group, enabled, config_dir = fields
+            instances.append(PostfixInstance(name, group, enabled == "y",
+                                             config_dir))
+    return instances
+
+
+def list_instances(main_config_dir, postmulti=POSTMULTI):
+    """List the instances managed from the primary instance's config dir."""
+    env = dict(os.environ, MAIL_CONFIG=main_config_dir)
+    cmd = subprocess.Popen([postmulti, "-l"], stdout=subprocess.PIPE, env=env)
+    stdout, _ = cmd.communicate()
+    if cmd.returncode != 0:
+        raise Exception("PluginError: postmulti -l failed")
+    return parse_postmulti(stdout)
+
 
+# The policy every worker deploys.  Set before the worker processes are
+# forked, so they share the parent's parsed copy instead of each being
+# sent (or re-reading) its own.
+_shared_policy_config = None
 
-def usage():
-    print ("Usage: %s starttls-everywhere.json /etc/postfix "
-           "/etc/letsencrypt/live/example.com/" % sys.argv[0])
-    sys.exit(1)
+
+def deploy_instance(work):
+    """Generate one instance's config; runs in a worker process."""
+    config_dir, cert_args, generator_kwargs = work
+    generator_kwargs = dict(generator_kwargs)
+    ca_path = generator_kwargs.get("ca_path")
+    if ca_path and not os.path.isabs(ca_path):
+        generator_kwargs["ca_path"] = os.path.join(config_dir, ca_path)
+    try:
+        pcgen = PostfixConfigGenerator(_shared_policy_config, config_dir,
+                                       fixup=True, **generator_kwargs)
+        pcgen.prepare()
+        pcgen.deploy_cert(*cert_args)
+        pcgen.save(DEPLOY_CHECKPOINT_TITLE)
+    except Exception as e:
+        return [], "%s: %s" % (type(e).__name__, e)
+    return sorted(pcgen.changed_files), None
+
+
+def deploy_instances(policy_config, instances, cert_args, jobs=4,
+                     generator_kwargs=None):
+    """
+    Generate the config of every instance, up to jobs at a time.
+
+    cert_args are the deploy_cert() arguments.  A relative ca_path in
+    generator_kwargs is taken relative to each instance's config dir.
+
+    Returns:
+      [(instance, changed files, error message or None)]
+    """
+    # only needed in this mode, keep it out of the common start up path
+    import multiprocessing
+    global _shared_policy_config
+    _shared_policy_config = policy_config
+    work = [(instance.config_dir, cert_args, generator_kwargs or {})
+            for instance in instances]
+    pool = multiprocessing.Pool(max(1, min(jobs, len(work))))
+    try:
+        results = pool.map(deploy_instance, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_policy_config = None
+    return [(instance, changed, error)
+            for instance, (changed, error) in zip(instances, results)]
+
+
+def complete_policy_manifest(policy_file):
+    """
+    Clear the pending mark save_policy_manifest() left on policy_file's
+    manifest, once postfix is running with everything deployed with it.
+    """
+    manifest_file = policy_file + MANIFEST_SUFFIX
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return
+    if not manifest.pop("pending", False):
+        return
+    with AtomicWrite.atomic_write(manifest_file, fsync=False) as f:
+        json.dump(manifest, f, sort_keys=True)
+
+
+def reload_instances(instances, batch_size=1, postfix=POSTFIX):
+    """
+    Reload instances batch_size at a time, in order.  The instances of a
+    batch reload concurrently; a failure stops before the next batch.
+    The policy manifests of the instances reloaded are completed.
+    """
+    for start in range(0, len(instances), batch_size):
+        batch = instances[start:start + batch_size]
+        logger.info('Reloading {}'.format(
+            ", ".join(instance.name for instance in batch)))
+        running = [(instance, start_postfix(instance.config_dir, ["reload"],
+                                            postfix))
+                   for instance in batch]
+        failed = [instance.name for instance, cmd in running
+                  if cmd.wait() != 0]
+        if failed:
+            raise Exception("PluginError: cannot reload postfix instances "
+                            + ", ".join(failed))
+        for instance in batch:
+            complete_policy_manifest(
+                os.path.join(instance.config_dir, POLICY_FILE_NAME))
 
 
 if __name__ == "__main__":
-    import Config as config
-    if len(sys.argv) != 4:
-        usage()
-    c = config.Config()
-    c.load_from_json_file(sys.argv[1])
-    postfix_dir = sys.argv[2]
-    le_lineage = sys.argv[3]
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Configure Postfix to enforce the STARTTLS Everywhere "
+                    "policy and use a Let's Encrypt certificate",
+        epilog="Example: %(prog)s starttls-everywhere.json /etc/postfix "
+               "/etc/letsencrypt/live/example.com/")
+    arg_parser.add_argument("policy_file")
+    arg_parser.add_argument("postfix_dir")
+    arg_parser.add_argument("le_lineage")
+    arg_parser.add_argument("--policy-map-type", default="texthash",
+                            choices=POLICY_MAP_TYPES,
+                            help="lookup table type for the policy map")
+    arg_parser.add_argument("--ca-path",
+                            help="also install the CA certificates as a "
+                                 "hashed smtp_tls_CApath directory here")
+    arg_parser.add_argument("--certs-observed",
+                            help="directory of certificate chains saved by "
+                                 "CheckSTARTTLS.py; only install the CAs "
+                                 "that issued them")
+    arg_parser.add_argument("--session-cache-profile",
+                            choices=sorted(SESSION_CACHE_PROFILES),
+                            help="set the TLS session cache timeout for this "
+                                 "kind of deployment (by default the timeout "
+                                 "is left alone)")
+    arg_parser.add_argument("--connection-cache-log",
+                            help="mail log to find the busiest policy "
+                                 "domains in; connections to them are cached")
+    arg_parser.add_argument("--connection-cache-top", type=int, default=20,
+                            help="cache connections to at most this many "
+                                 "domains")
+    arg_parser.add_argument("--connection-cache-min", type=int, default=100,
+                            help="only for domains with at least this many "
+                                 "TLS connections in the log")
+    arg_parser.add_argument("--postmulti", action="store_true",
+                            help="configure every postmulti instance "
+                                 "managed from postfix_dir, in parallel")
+    arg_parser.add_argument("--jobs", type=int, default=4,
+                            help="instances to configure at once")
+    arg_parser.add_argument("--reload-batch", type=int, default=1,
+                            help="instances to reload at once")
+    args = arg_parser.parse_args()
+    c = Config.Config()
+    c.load_from_json_file(args.policy_file)
+    errors = fatal_validation_errors(c)
+    for error in errors:
+        logger.error(error.message)
+    if errors:
+        sys.exit(1)
+    postfix_dir = args.postfix_dir
+    le_lineage = args.le_lineage
     pieces = [os.path.join(le_lineage, f) for f in (
         "cert.pem", "privkey.pem", "chain.pem", "fullchain.pem")]
     if not os.path.isdir(le_lineage) or not all(os.path.isfile(p) for p in pieces) :
-        print "Let's Encrypt directory", le_lineage, "does not appear to contain a valid lineage"
-        print
-        usage()
+        arg_parser.error("Let's Encrypt directory %s does not appear to "
+                         "contain a valid lineage" % le_lineage)
     cert, key, chain, fullchain = pieces
-    pcgen = PostfixConfigGenerator(c, postfix_dir, fixup=True)
+    generator_kwargs = dict(policy_map_type=args.policy_map_type,
+                            ca_path=args.ca_path,
+                            certs_observed=args.certs_observed,
+                            session_cache_profile=args.session_cache_profile,
+                            connection_cache_log=args.connection_cache_log,
+                            connection_cache_top=args.connection_cache_top,
+                            connection_cache_min=args.connection_cache_min)
+    if args.postmulti:
+        instances = list_instances(postfix_dir)
+        results = deploy_instances(
+            c, instances, ("example.com", cert, key, chain, fullchain),
+            args.jobs, generator_kwargs)
+        for instance, changed, error in results:
+            if error:
+                logger.error('{}: {}'.format(instance.name, error))
+        reload_instances([instance for instance, changed, error in results
+                          if changed and instance.enabled],
+                         args.reload_batch)
+        # stopped instances pick their config up when they are started
+        for instance, changed, error in results:
+            if not error and not instance.enabled:
+                complete_policy_manifest(
+                    os.path.join(instance.config_dir, POLICY_FILE_NAME))
+        if any(error for _, _, error in results):
+            sys.exit(1)
+        sys.exit(0)
+    pcgen = PostfixConfigGenerator(c, postfix_dir, fixup=True,
+                                   **generator_kwargs)
     pcgen.prepare()
     pcgen.deploy_cert("example.com", cert, key, chain, fullchain)
-    pcgen.save()
+    pcgen.save(DEPLOY_CHECKPOINT_TITLE)
     pcgen.restart()
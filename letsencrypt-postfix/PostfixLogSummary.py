@@ -1,17 +1,43 @@
 #!/usr/bin/env python
 import argparse
+import bz2
+import calendar
 import collections
+import errno
+import gzip
+import io
+import itertools
+import json
+import mmap
 import os
 import re
 import sys
 import time
 
+import AtomicWrite
 import Config
 
 TIME_FORMAT = "%b %d %H:%M:%S"
 
-# TODO: There's more to be learned from postfix logs!  Here's one sample
-# observed during failures from the sender vagrant vm:
+# Logs are read through buffers this big rather than line by line.
+BUFFER_SIZE = 1024 * 1024
+
+# Where cron and follow mode remember how far each log has been read.
+DEFAULT_STATE_FILE = "/tmp/starttls-everywhere-log-state.json"
+# Standard input cannot be seeked, so cron mode remembers the time of the
+# last line it counted there instead.
+DEFAULT_TIMESTAMP_FILE = "/tmp/starttls-everywhere-last-timestamp-processed.txt"
+
+# With --jobs, plain log files are split into pieces of about this size.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Rotated logs look like mail.log.1, mail.log.2.gz or, with logrotate's
+# dateext, mail.log-20140606.bz2.
+ROTATED_RE = re.compile(r"^(.*?)(?:\.(\d+)|-(\d{8}))?(?:\.gz|\.bz2)?$")
+
+# There's more to be learned from postfix logs than single lines tell.  Here's
+# one sample observed during failures from the sender vagrant vm, whose lines
+# TLSCorrelator joins to attribute the deferral to its cause:
 
 # Jun  6 00:21:31 precise32 postfix/smtpd[3648]: connect from localhost[127.0.0.1]
 # Jun  6 00:21:34 precise32 postfix/smtpd[3648]: lost connection after STARTTLS from localhost[127.0.0.1]
@@ -26,45 +52,516 @@ TIME_FORMAT = "%b %d %H:%M:%S"
 #
 # Also:
 # Oct 10 19:12:13 sender postfix/smtp[1711]: 62D3F481249: to=<vagrant@valid-example-recipient.com>, relay=valid-example-recipient.com[192.168.33.7]:25, delay=0.07, delays=0.03/0.01/0.03/0, dsn=4.7.4, status=deferred (TLS is required, but was not offered by host valid-example-recipient.com[192.168.33.7])
-def get_counts(input, config, earliest_timestamp):
+
+# Only smtp client lines mentioning TLS can match; anything else is rejected
+# with these substring checks before any parsing.  "/smtp[" also matches
+# postmulti instances logging as e.g. postfix-out/smtp[1234].
+SMTP_CLIENT_TAG = "/smtp["
+
+# Typical line looks like:
+# Jun 12 06:24:14 sender postfix/smtp[9045]: Untrusted TLS connection established to valid-example-recipient.com[192.168.33.7]:25: TLSv1.1 with cipher AECDH-AES256-SHA (256/256 bits)
+# or a deferral like the ones above.  Matched just after the 15 character
+# timestamp.  Groups 1 and 2 are the validation level and MX of an
+# established TLS connection (which can indicate the difference between
+# Untrusted, Trusted, and Verified certs), group 3 the MX of a message
+# deferred for a TLS-related reason.
+# ([^[]*) <--- any group of characters that is not "["
+SMTP_TLS_RE = re.compile(
+  r" \S+ \S+/smtp\[\d+\]: (?:"
+  r"([A-Za-z]+) TLS connection established to ([^[]*)"
+  r"|.*?relay=([^[ ]*).* status=deferred.*TLS)")
+
+def get_counts(input, config, earliest_timestamp, minutes=None):
+  """
+  Count the TLS connections and deferrals in the log lines of input.
+  The timestamp returned is the time of the last line counted, or 0.
+  If given, minutes (a defaultdict(int)) also gets the counts of each log
+  minute, as {("Jun 12 06:24", domain or MX, validation or "deferred"): n}
+  for a SummaryStore.
+  """
   seen_trusted = False
 
   counts = collections.defaultdict(lambda: collections.defaultdict(int))
   tls_deferred = collections.defaultdict(int)
-  # Typical line looks like:
-  # Jun 12 06:24:14 sender postfix/smtp[9045]: Untrusted TLS connection established to valid-example-recipient.com[192.168.33.7]:25: TLSv1.1 with cipher AECDH-AES256-SHA (256/256 bits)
-  # indicate a problem that should be alerted on.
-  # ([^[]*) <--- any group of characters that is not "["
-  # Log lines for when a message is deferred for a TLS-related reason. These
-  deferred_re = re.compile("relay=([^[ ]*).* status=deferred.*TLS")
-  # Log lines for when a TLS connection was successfully established. These can
-  # indicate the difference between Untrusted, Trusted, and Verified certs.
-  connected_re = re.compile("([A-Za-z]+) TLS connection established to ([^[]*)")
   mx_to_domain_mapping = config.get_mx_to_domain_policy_map()
+  # mx hostname -> "domain, domain" key into counts, or None
+  mx_domains = {}
 
+  # Timestamps only change once a second, so lines sharing the previous
+  # line's prefix reuse its parse (and whether it was too old).
+  last_prefix = None
+  last_time = None
+  too_old = False
   timestamp = 0
-  for line in sys.stdin:
-    timestamp = time.strptime(line[0:15], TIME_FORMAT)
-    if timestamp < earliest_timestamp:
+  match_tls = SMTP_TLS_RE.match
+  for line in input:
+    prefix = line[0:15]
+    if SMTP_CLIENT_TAG not in line or "TLS" not in line:
+      continue
+    if prefix != last_prefix:
+      last_prefix = prefix
+      last_time = time.strptime(prefix, TIME_FORMAT)
+      too_old = last_time < earliest_timestamp
+    if too_old:
       continue
-    deferred = deferred_re.search(line)
-    connected = connected_re.search(line)
-    if connected:
-      validation = connected.group(1)
-      mx_hostname = connected.group(2).lower()
+    match = match_tls(line, 15)
+    if not match:
+      continue
+    timestamp = last_time
+    validation, connected_mx, deferred_mx = match.groups()
+    if validation:
+      mx_hostname = connected_mx.lower()
       if validation == "Trusted" or validation == "Verified":
         seen_trusted = True
-      address_domains = config.get_address_domains(mx_hostname, mx_to_domain_mapping)
-      if address_domains:
-        domains_str = [ a.domain for a in address_domains ]
-        d = ', '.join(domains_str)
+      if mx_hostname not in mx_domains:
+        address_domains = config.get_address_domains(mx_hostname, mx_to_domain_mapping)
+        mx_domains[mx_hostname] = address_domains and ', '.join(
+          a.domain for a in address_domains)
+      d = mx_domains[mx_hostname]
+      if d:
         counts[d][validation] += 1
         counts[d]["all"] += 1
-    elif deferred:
-      mx_hostname = deferred.group(1).lower()
-      tls_deferred[mx_hostname] += 1
+        if minutes is not None:
+          minutes[(prefix[0:12], d, validation)] += 1
+          minutes[(prefix[0:12], d, "all")] += 1
+    else:
+      tls_deferred[deferred_mx.lower()] += 1
+      if minutes is not None:
+        minutes[(prefix[0:12], deferred_mx.lower(), "deferred")] += 1
   return (counts, tls_deferred, seen_trusted, timestamp)
 
+# Any smtp client line, matched just after the timestamp: the process (e.g.
+# postfix/smtp[3682]) and what it logged.
+SMTP_LINE_RE = re.compile(r" \S+ (\S+/smtp\[\d+\]): (.*)")
+# The status of one delivery attempt: queue ID, relay, status and reason.
+STATUS_RE = re.compile(r"([0-9A-Za-z]+): to=<[^>]*>,.*? relay=([^[ ,]*).*?"
+                       r" status=(\w+)(?: \((.*)\))?")
+# The message has left the queue, delivered or not.
+QMGR_REMOVED_RE = re.compile(r" \S+ \S+/qmgr\[\d+\]: ([0-9A-Za-z]+): removed")
+# OpenSSL errors look like 3682:error:140740BF:SSL routines:SSL23_CLIENT_HELLO:no protocols available:s23_clnt.c:381:
+# or, in OpenSSL 3, error:0A000086:SSL routines::certificate verify failed:...
+OPENSSL_ERROR_RE = re.compile(r"error:[0-9A-Fa-f]+:[^:]*:[^:]*:([^:]+)")
+# name[address] or name[address]:port, replaced by "host" in causes
+HOST_RE = re.compile(r"(?:host )?\S+\[[^]]*\](?::\d+)?")
+# Causes that a more specific one logged by the same attempt replaces.
+GENERIC_CAUSES = frozenset(["SSL_connect error"])
+
+def tls_cause(message):
+  """A short description of the TLS problem an smtp client line reports."""
+  error = OPENSSL_ERROR_RE.search(message)
+  if error:
+    return error.group(1)
+  if message.startswith("SSL_connect error"):
+    return "SSL_connect error"
+  if message.startswith("warning: "):
+    message = message[len("warning: "):]
+  return HOST_RE.sub("host", message.rstrip())
+
+def log_seconds(prefix):
+  """Seconds since the start of the (unknown) year of a log timestamp."""
+  return calendar.timegm(time.strptime(prefix, TIME_FORMAT))
+
+class TLSCorrelator(object):
+  """
+  Attribute TLS deferrals to their causes by joining the lines of a
+  delivery attempt.
+
+  An smtp client logs why TLS failed (SSL_connect error, TLS library
+  problem, ...) on lines of their own before the status line of the
+  attempt, so causes are remembered by smtp process ID until that status
+  line, which names the queue ID.  Deferred messages are then followed
+  by queue ID to see whether they were finally sent or bounced.
+
+  Both tables keep their most recently used max_entries entries, and drop
+  entries not seen for max_age seconds of log time, so memory stays
+  bounded however many messages go by.
+  """
+
+  def __init__(self, max_entries=10000, max_age=4 * 3600):
+    self.max_entries = max_entries
+    self.max_age = max_age
+    # smtp process -> (log time, cause)
+    self.pending = collections.OrderedDict()
+    # queue ID -> (log time, (mx hostname, cause))
+    self.deferred = collections.OrderedDict()
+    # (mx hostname, cause) -> number of deferrals
+    self.causes = collections.defaultdict(int)
+    # status after a TLS deferral ("sent", "bounced", ...) -> messages
+    self.outcomes = collections.defaultdict(int)
+    self.evicted = 0
+    self.last_prefix = None
+    self.now = 0
+
+  def remember(self, table, key, value):
+    table.pop(key, None)
+    table[key] = (self.now, value)
+    while len(table) > self.max_entries:
+      table.popitem(last=False)
+      self.evicted += 1
+
+  def expire(self, table):
+    """Drop entries older than max_age (or from before New Year)."""
+    while table:
+      then = table[next(iter(table))][0]
+      if then <= self.now <= then + self.max_age:
+        break
+      table.popitem(last=False)
+      self.evicted += 1
+
+  def tick(self, prefix):
+    if prefix != self.last_prefix:
+      self.last_prefix = prefix
+      self.now = log_seconds(prefix)
+      self.expire(self.pending)
+      self.expire(self.deferred)
+
+  def feed(self, line):
+    if SMTP_CLIENT_TAG in line:
+      match = SMTP_LINE_RE.match(line, 15)
+      if match:
+        self.tick(line[0:15])
+        self.smtp_line(*match.groups())
+    elif "/qmgr[" in line and "removed" in line:
+      match = QMGR_REMOVED_RE.match(line, 15)
+      if match:
+        self.deferred.pop(match.group(1), None)
+
+  def smtp_line(self, process, message):
+    status = STATUS_RE.match(message)
+    if status is None:
+      if (("TLS" in message or "SSL" in message) and
+          "TLS connection established" not in message):
+        cause = tls_cause(message)
+        pending = self.pending.get(process)
+        if pending is None or pending[1] in GENERIC_CAUSES:
+          self.remember(self.pending, process, cause)
+      return
+    queue_id, mx_hostname, status, reason = status.groups()
+    mx_hostname = mx_hostname.lower()
+    pending = self.pending.pop(process, None)
+    if status == "deferred":
+      if pending is not None:
+        cause = pending[1]
+      elif reason and "TLS" in reason:
+        cause = HOST_RE.sub("host", reason)
+      else:
+        return
+      self.causes[(mx_hostname, cause)] += 1
+      self.remember(self.deferred, queue_id, (mx_hostname, cause))
+    elif queue_id in self.deferred:
+      del self.deferred[queue_id]
+      self.outcomes[status] += 1
+
+  def watch(self, lines):
+    """Feed lines to the correlator on their way to another consumer."""
+    for line in lines:
+      self.feed(line)
+      yield line
+
+def rotation_order(path):
+  """
+  Sort key putting rotated logs in chronological order: mail.log.2.gz,
+  mail.log.1, mail.log (or mail.log-20140605, mail.log-20140606, mail.log).
+  """
+  base, number, date = ROTATED_RE.match(path).groups()
+  if number is not None:
+    return (base, 0, -int(number))
+  if date is not None:
+    return (base, 0, int(date))
+  return (base, 1, 0)
+
+def open_log(path):
+  """Open a log for reading, decompressing .gz and .bz2 files as a stream."""
+  if path == "-":
+    return io.open(sys.stdin.fileno(), "rb", BUFFER_SIZE, closefd=False)
+  if path.endswith(".gz"):
+    return io.BufferedReader(gzip.open(path, "rb"), BUFFER_SIZE)
+  if path.endswith(".bz2"):
+    return bz2.BZ2File(path, "rb", BUFFER_SIZE)
+  return io.open(path, "rb", BUFFER_SIZE)
+
+def read_logs(paths):
+  """Yield the lines of the logs at paths, oldest log first."""
+  for path in sorted(paths, key=rotation_order):
+    f = open_log(path)
+    try:
+      for line in f:
+        yield line
+    finally:
+      f.close()
+
+def line_aligned_ranges(path, chunks):
+  """
+  Split the file at path into about chunks (start, end) byte ranges, each
+  ending just after a newline or at the end of the file.
+  """
+  size = os.path.getsize(path)
+  if size == 0:
+    return []
+  step = max(1, size // chunks)
+  with open(path, "rb") as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    ranges = []
+    start = 0
+    while start < size:
+      end = mm.find("\n", min(start + step, size) - 1)
+      end = size if end == -1 else end + 1
+      ranges.append((start, end))
+      start = end
+    return ranges
+  finally:
+    mm.close()
+
+def read_range(path, start, end):
+  """Yield the lines of the file at path between byte offsets start and end."""
+  with open(path, "rb") as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    mm.seek(start)
+    readline = mm.readline
+    while mm.tell() < end:
+      yield readline()
+  finally:
+    mm.close()
+
+def log_tasks(paths, jobs):
+  """
+  The pieces of work for get_counts_parallel, oldest first: (path, start,
+  end) for ranges of plain files, (path, None, None) for whole logs that
+  have to be read as a stream.
+  """
+  tasks = []
+  for path in sorted(paths, key=rotation_order):
+    if path == "-" or path.endswith((".gz", ".bz2")) or not os.path.isfile(path):
+      tasks.append((path, None, None))
+      continue
+    chunks = max(jobs, os.path.getsize(path) // CHUNK_SIZE + 1)
+    tasks.extend((path, start, end)
+                 for start, end in line_aligned_ranges(path, chunks))
+  return tasks
+
+# Set for the worker processes of get_counts_parallel, which inherit them.
+_shared_config = None
+_shared_earliest_timestamp = 0
+
+def count_task(task):
+  """get_counts() for one log_tasks() task, as picklable plain dicts."""
+  path, start, end = task
+  if start is None:
+    lines = read_logs([path])
+  else:
+    lines = read_range(path, start, end)
+  counts, tls_deferred, seen_trusted, timestamp = get_counts(
+    lines, _shared_config, _shared_earliest_timestamp)
+  return (dict((d, dict(v)) for d, v in counts.items()), dict(tls_deferred),
+          seen_trusted, timestamp)
+
+def merge_counts(earlier, later):
+  """
+  Combine the get_counts() results of two consecutive pieces of log into
+  those of the whole.  The merge is associative, so any split of a log
+  gives the same result as reading it in one go.
+  """
+  counts = collections.defaultdict(lambda: collections.defaultdict(int))
+  tls_deferred = collections.defaultdict(int)
+  for result in (earlier, later):
+    for d, validations in result[0].items():
+      for validation, n in validations.items():
+        counts[d][validation] += n
+    for mx_hostname, n in result[1].items():
+      tls_deferred[mx_hostname] += n
+  return (counts, tls_deferred, earlier[2] or later[2],
+          later[3] or earlier[3])
+
+def get_counts_parallel(paths, config, earliest_timestamp, jobs):
+  """get_counts() over the logs at paths, using up to jobs processes."""
+  # only needed in this mode, keep it out of the common start up path
+  import multiprocessing
+  global _shared_config, _shared_earliest_timestamp
+  _shared_config = config
+  _shared_earliest_timestamp = earliest_timestamp
+  tasks = log_tasks(paths, jobs)
+  pool = multiprocessing.Pool(max(1, jobs))
+  try:
+    # workers get /dev/null as stdin, so standard input is read here
+    file_results = iter(pool.map(count_task,
+                                 [task for task in tasks if task[0] != "-"],
+                                 chunksize=1))
+    results = [count_task(task) if task[0] == "-" else next(file_results)
+               for task in tasks]
+  finally:
+    pool.close()
+    pool.join()
+    _shared_config = None
+    _shared_earliest_timestamp = 0
+  return reduce(merge_counts, results, ({}, {}, False, 0))
+
+def load_state(state_file):
+  """Read {absolute log path: [inode, offset]} as saved by save_state()."""
+  try:
+    with open(state_file) as f:
+      return json.load(f)
+  except IOError:
+    return {}
+
+def save_state(state_file, state):
+  with AtomicWrite.atomic_write(state_file) as f:
+    json.dump(state, f, indent=2, sort_keys=True)
+
+def load_timestamp(timestamp_file):
+  """The time saved by save_timestamp(), or 0 before the first run."""
+  if not os.path.isfile(timestamp_file):
+    return 0
+  with open(timestamp_file) as f:
+    return time.strptime(f.read(), TIME_FORMAT)
+
+def save_timestamp(timestamp_file, timestamp):
+  with AtomicWrite.atomic_write(timestamp_file) as f:
+    f.write(time.strftime(TIME_FORMAT, timestamp))
+
+def lines_after(lines, timestamp):
+  """
+  Skip the lines of a chronological log up to the end of the second of
+  timestamp, and any lines among them without a timestamp.
+  """
+  def old(line):
+    try:
+      return time.strptime(line[0:15], TIME_FORMAT) <= timestamp
+    except ValueError:
+      return True
+  return itertools.dropwhile(old, lines)
+
+def rotated_file(path, inode):
+  """The rotated log of path (e.g. path.1) that is inode, or None."""
+  directory, name = os.path.split(path)
+  for other in sorted(os.listdir(directory or ".")):
+    if other == name or not other.startswith(name):
+      continue
+    other = os.path.join(directory, other)
+    if not other.endswith((".gz", ".bz2")) and os.stat(other).st_ino == inode:
+      return other
+  return None
+
+def read_from(f, offset, done=None):
+  """
+  Yield the complete lines of the open file f from offset on.  A final
+  line still being written is left for the next read; done(offset) is
+  called with the offset just past the last line read.
+  """
+  f.seek(offset)
+  try:
+    for line in f:
+      if not line.endswith("\n"):
+        break
+      offset += len(line)
+      yield line
+  finally:
+    f.close()
+    if done is not None:
+      done(offset)
+
+def new_lines(path, state):
+  """
+  Yield the lines added to the log at path since the position in state,
+  recording the new position there once they have all been read.
+
+  If the log was rotated since, the rest of the old file (found by its
+  inode among path's plain rotated siblings) comes first; if it was
+  truncated, it is read from the start.
+  """
+  key = os.path.abspath(path)
+  try:
+    f = io.open(path, "rb", BUFFER_SIZE)
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    # rotated away and not recreated yet; catch up on the next run
+    return
+  st = os.fstat(f.fileno())
+  inode, offset = state.get(key, (st.st_ino, 0))
+  if inode != st.st_ino:
+    old = rotated_file(path, inode)
+    if old is not None:
+      for line in read_from(io.open(old, "rb", BUFFER_SIZE), offset):
+        yield line
+    else:
+      print >> sys.stderr, "%s was rotated, and the rest of the old log " \
+        "could not be found" % path
+    offset = 0
+  elif st.st_size < offset:
+    offset = 0
+  def done(offset):
+    state[key] = [st.st_ino, offset]
+  for line in read_from(f, offset, done):
+    yield line
+
+def read_new_lines(paths, state):
+  return itertools.chain.from_iterable(
+    new_lines(path, state) for path in sorted(paths, key=rotation_order))
+
+def print_deferred(tls_deferred):
+  if len(tls_deferred) > 0:
+    print "Some mail was deferred due to TLS problems:"
+    for (k, v) in tls_deferred.iteritems():
+      print "%s: %s" % (k, v)
+
+def record(store, minutes):
+  store.add(minutes)
+  store.compact()
+
+def report_new_lines(paths, config, state, store=None, correlator=None):
+  """
+  Report TLS deferrals in the lines added to the logs since state, and
+  their causes if given a correlator, recording the counts in store if
+  given.
+  """
+  minutes = collections.defaultdict(int) if store is not None else None
+  lines = read_new_lines(paths, state)
+  if correlator is not None:
+    lines = correlator.watch(lines)
+  tls_deferred = get_counts(lines, config, 0, minutes)[1]
+  if store is not None:
+    record(store, minutes)
+  print_deferred(tls_deferred)
+  if correlator is not None:
+    print_causes(correlator)
+    # report each cause once; deliveries still pending carry over
+    correlator.causes.clear()
+    correlator.outcomes.clear()
+
+def follow(paths, config, state_file, interval, store=None, correlator=None):
+  """Run report_new_lines() every interval seconds until interrupted."""
+  state = load_state(state_file)
+  while True:
+    report_new_lines(paths, config, state, store, correlator)
+    save_state(state_file, state)
+    sys.stdout.flush()
+    time.sleep(interval)
+
+def print_causes(correlator):
+  if correlator.causes:
+    print "Causes of TLS deferrals:"
+    for (mx_hostname, cause), n in sorted(correlator.causes.items()):
+      print "%s: %s: %s" % (mx_hostname, cause, n)
+  for status, n in sorted(correlator.outcomes.items()):
+    print "Messages %s after a TLS deferral: %s" % (status, n)
+
+def print_report(store, days):
+  """Print the daily counts of the last days from store."""
+  validations = collections.defaultdict(dict)
+  for bucket, name, kind, count in store.last_days(days):
+    validations[(bucket, name)][kind] = count
+  for (bucket, name), kinds in sorted(validations.items()):
+    day = time.strftime("%Y-%m-%d", time.localtime(bucket))
+    for kind, count in sorted(kinds.items()):
+      if kind == "all":
+        continue
+      if kind == "deferred":
+        print day, name, "deferred", count
+      else:
+        print day, name, kind, count, "of", kinds["all"]
+
 def print_summary(counts):
   for mx_hostname, validations in counts.items():
     for validation, validation_count in validations.items():
@@ -75,22 +572,94 @@ def print_summary(counts):
 if __name__ == "__main__":
   arg_parser = argparse.ArgumentParser(description='Detect delivery problems'
     ' in Postfix log files that may be caused by security policies')
-  arg_parser.add_argument('-c', action="store_true", dest="cron", default=False)
+  arg_parser.add_argument('-c', action="store_true", dest="cron", default=False,
+    help="Only report deferrals, in the log lines added since the last run")
+  arg_parser.add_argument("--follow", action="store_true", default=False,
+    help="Keep running, reporting deferrals in new log lines")
+  arg_parser.add_argument("--interval", type=float, default=60,
+    help="Seconds between reads of the logs in follow mode")
+  arg_parser.add_argument("--state-file", default=DEFAULT_STATE_FILE,
+    help="Where -c and --follow keep the position read up to in each log")
+  arg_parser.add_argument("--timestamp-file", default=DEFAULT_TIMESTAMP_FILE,
+    help="Where -c keeps the time of the last line it counted on standard "
+    "input")
   arg_parser.add_argument("policy_file", nargs='?',
     default=os.path.join("examples", "starttls-everywhere.json"),
     help="STARTTLS Everywhere policy file")
+  arg_parser.add_argument("log_files", nargs='*', default=["-"],
+    help="Postfix logs to read, possibly rotated and compressed (e.g. "
+    "mail.log mail.log.1 mail.log.2.gz); read in chronological order. "
+    "Defaults to standard input, which -c skips up to the time of the last "
+    "line it counted")
+  arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+    help="Split the logs into pieces counted by this many processes")
+  arg_parser.add_argument("--causes", action="store_true", default=False,
+    help="Attribute deferrals to the TLS problems logged before them "
+    "(reads the logs in one process)")
+  arg_parser.add_argument("--store",
+    help="SQLite file to add the counts of new log lines to, kept in "
+    "minute, hour and day buckets; needs -c or --follow so no line is "
+    "counted twice (reads the logs in one process)")
+  arg_parser.add_argument("--report", type=int, metavar="DAYS",
+    help="Print the daily counts of the last DAYS days from --store "
+    "instead of reading logs")
 
   args = arg_parser.parse_args()
+  store = None
+  if args.store:
+    # only needed with --store, keep sqlite3 out of the common start up path
+    import SummaryStore
+    store = SummaryStore.SummaryStore(args.store)
+  if args.report is not None:
+    if store is None:
+      arg_parser.error("--report needs --store")
+    print_report(store, args.report)
+    sys.exit(0)
+
   config = Config.Config()
   config.load_from_json_file(args.policy_file)
 
-  last_timestamp_processed = 0
-  timestamp_file = '/tmp/starttls-everywhere-last-timestamp-processed.txt'
-  if os.path.isfile(timestamp_file):
-    last_timestamp_processed = time.strptime(open(timestamp_file).read(), TIME_FORMAT)
-  (counts, tls_deferred, seen_trusted, latest_timestamp) = get_counts(sys.stdin, config, last_timestamp_processed)
-  with open(timestamp_file, "w") as f:
-    f.write(time.strftime(TIME_FORMAT, latest_timestamp))
+  incremental = (args.cron or args.follow) and args.log_files != ["-"]
+  if store is not None and not incremental:
+    arg_parser.error("--store needs -c or --follow with log files, or "
+                     "rerunning over the same logs would count them again")
+  correlator = TLSCorrelator() if args.causes else None
+  minutes = collections.defaultdict(int) if store is not None else None
+  if args.follow:
+    if not incremental:
+      arg_parser.error("--follow needs log files")
+    try:
+      follow(args.log_files, config, args.state_file, args.interval, store,
+             correlator)
+    except KeyboardInterrupt:
+      sys.exit(0)
+  elif incremental:
+    state = load_state(args.state_file)
+    lines = read_new_lines(args.log_files, state)
+    if correlator is not None:
+      lines = correlator.watch(lines)
+    (counts, tls_deferred, seen_trusted, _) = get_counts(lines, config, 0, minutes)
+    save_state(args.state_file, state)
+  elif args.cron and args.log_files == ["-"]:
+    lines = read_logs(args.log_files)
+    last_timestamp = load_timestamp(args.timestamp_file)
+    if last_timestamp:
+      lines = lines_after(lines, last_timestamp)
+    if correlator is not None:
+      lines = correlator.watch(lines)
+    (counts, tls_deferred, seen_trusted, timestamp) = get_counts(
+      lines, config, 0)
+    if timestamp:
+      save_timestamp(args.timestamp_file, timestamp)
+  elif args.jobs > 1 and correlator is None and store is None:
+    (counts, tls_deferred, seen_trusted, _) = get_counts_parallel(args.log_files, config, 0, args.jobs)
+  else:
+    lines = read_logs(args.log_files)
+    if correlator is not None:
+      lines = correlator.watch(lines)
+    (counts, tls_deferred, seen_trusted, _) = get_counts(lines, config, 0, minutes)
+  if store is not None:
+    record(store, minutes)
 
   # If not running in cron, print an overall summary of log lines seen from known hosts.
   if not args.cron:
@@ -98,7 +667,6 @@ if __name__ == "__main__":
     if not seen_trusted:
       print 'No Trusted connections seen! Probably need to install a CAfile.'
 
-  if len(tls_deferred) > 0:
-    print "Some mail was deferred due to TLS problems:"
-    for (k, v) in tls_deferred.iteritems():
-      print "%s: %s" % (k, v)
+  print_deferred(tls_deferred)
+  if correlator is not None:
+    print_causes(correlator)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Log summary counts kept over time, aggregated into time buckets.
+
+Counts are added per minute of log time and go into a minute, an hour and
+a day bucket at once, so a range query reads a handful of pre-aggregated
+rows instead of reprocessing old logs.  compact() drops fine-grained
+buckets once they are older than their retention; the coarser buckets
+still hold their totals.
+
+Each row counts one kind of event for one name: a validation level
+("Trusted", "Untrusted", ..., and "all") for a policy domain, or
+"deferred" for an MX hostname whose mail was deferred for TLS reasons.
+"""
+import sqlite3
+import time
+
+
+# (resolution, bucket length, retention or None to keep forever), in seconds
+MINUTE = "minute"
+HOUR = "hour"
+DAY = "day"
+RESOLUTIONS = ((MINUTE, 60, 2 * 86400),
+               (HOUR, 3600, 90 * 86400),
+               (DAY, 86400, None))
+
+DEFERRED = "deferred"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counts (
+    resolution TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (resolution, bucket, name, kind)
+)
+"""
+
+# A log minute such as "Jun 12 06:24", with the year the log leaves out
+# put in front.
+MINUTE_FORMAT = "%Y %b %d %H:%M"
+
+
+def log_minute(minute, now=None):
+    """
+    The local time in seconds of a log minute like "Jun 12 06:24".  Logs
+    have no year, so it is the latest one that does not put the minute
+    in the future (months ahead of now are last year's).
+    """
+    now = time.localtime(now)
+    tm = time.strptime("%d %s" % (now.tm_year, minute), MINUTE_FORMAT)
+    if tm.tm_mon > now.tm_mon:
+        tm = time.strptime("%d %s" % (now.tm_year - 1, minute),
+                           MINUTE_FORMAT)
+    return int(time.mktime(tm))
+
+
+def bucket_start(seconds, resolution):
+    """The start of the local time bucket holding seconds."""
+    tm = time.localtime(seconds)
+    if resolution == MINUTE:
+        fields = tm[:5] + (0,)
+    elif resolution == HOUR:
+        fields = tm[:4] + (0, 0)
+    else:
+        fields = tm[:3] + (0, 0, 0)
+    return int(time.mktime(fields + (0, 0, -1)))
+
+
+def choose_resolution(start, end, now=None):
+    """
+    The coarsest resolution with at least two buckets in the range, or a
+    coarser one if compact() has already dropped its buckets at start.
+    """
+    if now is None:
+        now = time.time()
+    chosen = None
+    for resolution, length, retention in RESOLUTIONS:
+        kept = retention is None or start >= now - retention
+        if kept and (chosen is None or end - start >= 2 * length):
+            chosen = resolution
+    return chosen
+
+
+class SummaryStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, minutes, now=None):
+        """
+        Add {(log minute, name, kind): count}, as collected by
+        PostfixLogSummary.get_counts(), to every resolution's buckets.
+        """
+        seconds = {}
+        rows = {}
+        for (minute, name, kind), count in minutes.items():
+            if minute not in seconds:
+                seconds[minute] = log_minute(minute, now)
+            for resolution, _, _ in RESOLUTIONS:
+                key = (resolution, bucket_start(seconds[minute], resolution),
+                       name, kind)
+                rows[key] = rows.get(key, 0) + count
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO counts VALUES (?, ?, ?, ?, 0)",
+                rows.keys())
+            self.db.executemany(
+                "UPDATE counts SET count = count + ? WHERE resolution = ?"
+                " AND bucket = ? AND name = ? AND kind = ?",
+                [(count,) + key for key, count in rows.items()])
+
+    def compact(self, now=None):
+        """Drop buckets older than their resolution's retention."""
+        if now is None:
+            now = time.time()
+        with self.db:
+            for resolution, _, retention in RESOLUTIONS:
+                if retention is not None:
+                    self.db.execute(
+                        "DELETE FROM counts WHERE resolution = ?"
+                        " AND bucket < ?", (resolution, now - retention))
+
+    def query(self, start, end, resolution=None):
+        """
+        [(bucket start, name, kind, count)] for the buckets starting in
+        [start, end), oldest first.
+        """
+        if resolution is None:
+            resolution = choose_resolution(start, end)
+        return self.db.execute(
+            "SELECT bucket, name, kind, count FROM counts"
+            " WHERE resolution = ? AND bucket >= ? AND bucket < ?"
+            " ORDER BY bucket, name, kind",
+            (resolution, start, end)).fetchall()
+
+    def totals(self, start, end, resolution=None):
+        """{(name, kind): count} summed over the range."""
+        if resolution is None:
+            resolution = choose_resolution(start, end)
+        return dict(((name, kind), count) for name, kind, count in
+                    self.db.execute(
+                        "SELECT name, kind, SUM(count) FROM counts"
+                        " WHERE resolution = ? AND bucket >= ? AND bucket < ?"
+                        " GROUP BY name, kind",
+                        (resolution, start, end)))
+
+    def last_days(self, days, now=None):
+        """query() the day buckets of the last days, today included."""
+        if now is None:
+            now = time.time()
+        start = bucket_start(now - (days - 1) * 86400, DAY)
+        return self.query(start, now, DAY)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Deterministic synthetic STARTTLS Everywhere policies for scale testing.
+
+The shape loosely follows real policy data: most address domains hand their
+mail to a few big shared providers, the rest run their own MX, some accept
+more than one MX suffix, and minimum TLS versions skew towards TLSv1.2.
+
+Usage:
+  ./SyntheticPolicy.py 100000 > policy.json
+"""
+import argparse
+import json
+import random
+import sys
+
+
+TLDS = ('com', 'net', 'org', 'de', 'co.uk', 'fr', 'nl', 'cn', 'com.br', 'edu')
+# (min-tls-version, weight)
+TLS_VERSIONS = (('TLSv1', 10), ('TLSv1.1', 20), ('TLSv1.2', 65),
+                ('TLSv1.3', 5))
+# Share of domains using a shared provider, subdomains of another listed
+# domain, and ones accepting a second (or third) MX suffix.
+PROVIDER_SHARE = 0.6
+SUBDOMAIN_SHARE = 0.1
+MULTI_MX_SHARE = 0.05
+TIMESTAMP = 1401414363
+LIFETIME = 30 * 24 * 3600
+
+
+def weighted_choice(rng, choices):
+    total = sum(weight for _choice, weight in choices)
+    point = rng.uniform(0, total)
+    for choice, weight in choices:
+        point -= weight
+        if point <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def make_tls_policy(rng):
+    policy = {
+        'require-tls': True,
+        'min-tls-version': weighted_choice(rng, TLS_VERSIONS),
+        'enforce-mode': 'enforce' if rng.random() < 0.7 else 'log-only',
+    }
+    if rng.random() < 0.5:
+        policy['require-valid-certificate'] = True
+    return policy
+
+
+def make_provider_suffixes(rng, num_domains):
+    num_providers = max(5, num_domains // 500)
+    return ['.mx%d.provider%d.%s' % (rng.randint(1, 3), n, rng.choice(TLDS))
+            for n in range(num_providers)]
+
+
+def pick_provider(rng, providers):
+    # Zipf-like popularity, the first few providers take most of the domains.
+    index = int(len(providers) * rng.random() ** 3)
+    return providers[min(index, len(providers) - 1)]
+
+
+def generate_policy(num_domains, seed=0):
+    """Return a policy dict (as loaded from JSON) with num_domains domains.
+
+    The same (num_domains, seed) always produces the same policy.
+    """
+    rng = random.Random(seed)
+    providers = make_provider_suffixes(rng, num_domains)
+    # Providers get one shared policy each, so identical bodies are common.
+    provider_policies = dict((suffix, make_tls_policy(rng))
+                             for suffix in providers)
+    tls_policies = {}
+    acceptable_mxs = {}
+    domains = []
+    for n in range(num_domains):
+        if domains and rng.random() < SUBDOMAIN_SHARE:
+            domain = 'dept%d.%s' % (n, rng.choice(domains))
+        else:
+            domain = 'domain%d.%s' % (n, rng.choice(TLDS))
+        domains.append(domain)
+        if rng.random() < PROVIDER_SHARE:
+            mx_suffixes = [pick_provider(rng, providers)]
+        else:
+            mx_suffixes = ['.mail%d.%s' % (n, rng.choice(TLDS))]
+        if rng.random() < MULTI_MX_SHARE:
+            extra = pick_provider(rng, providers)
+            if extra not in mx_suffixes:
+                mx_suffixes.append(extra)
+        for mx_suffix in mx_suffixes:
+            if mx_suffix in provider_policies:
+                tls_policies[mx_suffix] = provider_policies[mx_suffix]
+            elif mx_suffix not in tls_policies:
+                tls_policies[mx_suffix] = make_tls_policy(rng)
+        acceptable_mxs[domain] = {'accept-mx-domains': mx_suffixes}
+    return {
+        'author': 'Synthetic policy generator, seed %d' % seed,
+        'timestamp': TIMESTAMP,
+        'expires': TIMESTAMP + LIFETIME,
+        'tls-policies': tls_policies,
+        'acceptable-mxs': acceptable_mxs,
+    }
+
+
+def parse_size(value):
+    """Parse domain counts such as 1000, 10k or 1M."""
+    multipliers = {'k': 1000, 'm': 1000000}
+    value = value.strip().lower()
+    if value and value[-1] in multipliers:
+        return int(value[:-1]) * multipliers[value[-1]]
+    return int(value)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Write a synthetic STARTTLS Everywhere policy as JSON')
+    arg_parser.add_argument('domains', type=parse_size,
+                            help='number of address domains, e.g. 1000 or 1M')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    json.dump(generate_policy(args.domains, args.seed), sys.stdout,
+              indent=2, sort_keys=True)
+    sys.stdout.write('\n')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+import CABundle
+import Config
+import PostfixConfigGenerator as pcg
+
+
+CA_CERTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'examples', 'ca-certs')
+
+
+def read_fixture(name):
+    with open(os.path.join(CA_CERTS_DIR, name)) as f:
+        return f.read()
+
+
+class TestCABundle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.roots_dir = os.path.join(self.tmp_dir, 'roots')
+        os.mkdir(self.roots_dir)
+        for name in ('root1.pem', 'root2.pem'):
+            shutil.copy(os.path.join(CA_CERTS_DIR, name), self.roots_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testIssuerAndSubject(self):
+        root1, = CABundle.parse_pem_certificates(read_fixture('root1.pem'))
+        leaf, = CABundle.parse_pem_certificates(read_fixture('leaf.pem'))
+        self.assertEqual(root1.issuer, root1.subject)
+        self.assertEqual(root1.subject, leaf.issuer)
+        self.assertNotEqual(leaf.subject, leaf.issuer)
+        self.assertEqual(read_fixture('root1.pem'), root1.to_pem())
+
+    def testReadCertificatesDeduplicates(self):
+        certs = CABundle.read_certificates(
+            [self.roots_dir, os.path.join(CA_CERTS_DIR, 'root1.pem')])
+        self.assertEqual(2, len(certs))
+        self.assertEqual(2, len(set(cert.fingerprint for cert in certs)))
+
+    def testWriteBundleOnlyOnChange(self):
+        certs = CABundle.read_certificates([self.roots_dir])
+        bundle = os.path.join(self.tmp_dir, 'bundle')
+        self.assertTrue(CABundle.write_bundle(bundle, certs))
+        self.assertFalse(CABundle.write_bundle(bundle, certs))
+        self.assertTrue(CABundle.write_bundle(bundle, certs[:1]))
+        with open(bundle) as f:
+            self.assertEqual(read_fixture('root1.pem'), f.read())
+
+    def testUsedRoots(self):
+        observed = os.path.join(self.tmp_dir, 'certs-observed')
+        os.makedirs(os.path.join(observed, 'example.com'))
+        with open(os.path.join(observed, 'example.com', 'mx.example.com'),
+                  'w') as f:
+            f.write('CONNECTED(00000003)\n' + read_fixture('leaf.pem'))
+        issuers, unobserved = CABundle.observed_issuers(
+            observed, ['example.com', 'example.net'])
+        self.assertEqual(1, unobserved)
+        root1, = CABundle.parse_pem_certificates(read_fixture('root1.pem'))
+        certs = CABundle.read_certificates([self.roots_dir])
+        self.assertEqual([root1], CABundle.used_roots(certs, issuers))
+
+    def testWriteCAPath(self):
+        certs = CABundle.read_certificates([self.roots_dir])
+        ca_path = os.path.join(self.tmp_dir, 'CApath')
+        self.assertTrue(CABundle.write_ca_path(ca_path, certs))
+        names = os.listdir(ca_path)
+        self.assertEqual(2, len([n for n in names if n.endswith('.pem')]))
+        links = [n for n in names if os.path.islink(os.path.join(ca_path, n))]
+        self.assertEqual(2, len(links))
+        self.assertFalse(CABundle.write_ca_path(ca_path, certs))
+        self.assertTrue(CABundle.write_ca_path(ca_path, certs[1:]))
+        self.assertEqual(2, len(os.listdir(ca_path)))
+
+    def testWriteCAPathKeepsLinksDense(self):
+        # every certificate gets the same subject hash
+        subject_hash = CABundle.subject_hash
+        CABundle.subject_hash = lambda path: 'deadbeef'
+        try:
+            certs = CABundle.read_certificates(
+                [self.roots_dir, os.path.join(CA_CERTS_DIR, 'leaf.pem')])
+            ca_path = os.path.join(self.tmp_dir, 'CApath')
+            self.assertTrue(CABundle.write_ca_path(ca_path, certs))
+            links = CABundle.hash_links(ca_path)
+            self.assertEqual(set(cert.fingerprint + '.pem' for cert in certs),
+                             set(links['deadbeef'].values()))
+            dropped = certs[0].fingerprint + '.pem'
+            self.assertTrue(CABundle.write_ca_path(ca_path, certs[1:]))
+            after = CABundle.hash_links(ca_path)['deadbeef']
+            self.assertEqual([0, 1], sorted(after))
+            self.assertEqual(set(links['deadbeef'].values()) - set([dropped]),
+                             set(after.values()))
+            # only the last link moved, into the dropped one's place
+            for n, target in links['deadbeef'].items():
+                if target != dropped and n in after:
+                    self.assertEqual(target, after[n])
+            self.assertEqual(4, len(os.listdir(ca_path)))
+        finally:
+            CABundle.subject_hash = subject_hash
+
+
+class TestUpdateCAfile(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.postfix_dir, 'main.cf'), 'w') as f:
+            f.write('myhostname = mail.example.com\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.postfix_dir)
+
+    def testUpdateCAfileOnlyOnChange(self):
+        sources = [os.path.join(CA_CERTS_DIR, 'root1.pem'),
+                   os.path.join(CA_CERTS_DIR, 'root2.pem')]
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            Config.Config(), self.postfix_dir, ca_sources=sources)
+        postfix_config_gen.update_CAfile()
+        self.assertEqual(set([postfix_config_gen.ca_file]),
+                         postfix_config_gen.changed_files)
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            Config.Config(), self.postfix_dir, ca_sources=sources)
+        postfix_config_gen.update_CAfile()
+        self.assertEqual(set(), postfix_config_gen.changed_files)
+
+
+if __name__ == '__main__':
+    unittest.main()
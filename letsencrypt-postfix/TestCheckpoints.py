@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import Checkpoints
+import Config
+import PostfixConfigGenerator as pcg
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'examples')
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = Checkpoints.CheckpointStore(
+            os.path.join(self.tmp_dir, 'checkpoints'))
+        self.path = os.path.join(self.tmp_dir, 'main.cf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text, path=None):
+        with open(path or self.path, 'w') as f:
+            f.write(text)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return f.read()
+
+    def checkpoint(self, title, text, paths=None):
+        """Change the files to text, recording them first."""
+        originals = {}
+        for path in paths or [self.path]:
+            originals[path] = self.store.store_blob(path)
+            self.write(text, path)
+        self.store.add(originals)
+        self.store.finalize(title)
+
+    def blobs(self):
+        return sorted(os.listdir(self.store.blob_dir))
+
+    def testRollback(self):
+        self.write('one\n')
+        self.checkpoint('first', 'two\n')
+        self.checkpoint('second', 'three\n')
+        self.assertEqual(['first', 'second'],
+                         [c['title'] for c in self.store.checkpoints()])
+        self.assertEqual([self.path], self.store.rollback(1))
+        self.assertEqual('two\n', self.read())
+        self.store.rollback(1)
+        self.assertEqual('one\n', self.read())
+        self.assertEqual([], self.store.checkpoints())
+        self.assertEqual([], self.blobs())
+        self.assertRaises(Checkpoints.CheckpointError, self.store.rollback, 1)
+
+    def testRollbackTooFarTouchesNothing(self):
+        self.write('one\n')
+        self.checkpoint('first', 'two\n')
+        self.store.add({self.path: self.store.store_blob(self.path)},
+                       Checkpoints.TEMPORARY)
+        self.write('temporary\n')
+        self.assertRaises(Checkpoints.CheckpointError, self.store.rollback, 2)
+        self.assertEqual('temporary\n', self.read())
+        self.assertEqual(1, len(self.store.checkpoints()))
+
+    def testNewFileIsRemovedOnRollback(self):
+        new_file = os.path.join(self.tmp_dir, 'policy')
+        self.checkpoint('create', 'policy\n', [new_file])
+        self.store.rollback(1)
+        self.assertFalse(os.path.exists(new_file))
+
+    def testRollbackLeavesOtherKindsOfFileAlone(self):
+        new_file = os.path.join(self.tmp_dir, 'policy')
+        self.checkpoint('create', 'policy\n', [new_file])
+        os.remove(new_file)
+        os.mkdir(new_file)
+        with open(os.path.join(new_file, 'keep'), 'w') as f:
+            f.write('keep\n')
+        self.store.rollback(1)
+        self.assertTrue(os.path.isfile(os.path.join(new_file, 'keep')))
+
+    def testOldCheckpointsArePruned(self):
+        self.store.keep = 2
+        self.write('0\n')
+        for n in range(1, 5):
+            self.checkpoint(str(n), '%d\n' % n)
+        self.assertEqual(['3', '4'],
+                         [c['title'] for c in self.store.checkpoints()])
+        # only the contents the two left can restore
+        self.assertEqual(2, len(self.blobs()))
+        self.store.rollback(2)
+        self.assertEqual('2\n', self.read())
+
+    def testBlobsAreShared(self):
+        other = os.path.join(self.tmp_dir, 'other.cf')
+        self.write('same\n')
+        self.write('same\n', other)
+        self.checkpoint('both', 'changed\n', [self.path, other])
+        self.write('same\n')
+        self.checkpoint('again', 'changed\n')
+        self.assertEqual(1, len(self.blobs()))
+
+    def testRecoverRevertsUnfinalizedChanges(self):
+        self.write('one\n')
+        self.checkpoint('first', 'two\n')
+        self.store.add({self.path: self.store.store_blob(self.path)},
+                       Checkpoints.TEMPORARY)
+        self.write('temporary\n')
+        self.store.add({self.path: self.store.store_blob(self.path)})
+        self.write('in progress\n')
+        self.assertEqual([self.path], self.store.recover())
+        self.assertEqual('two\n', self.read())
+        self.assertEqual(1, len(self.store.checkpoints()))
+
+
+class TestGeneratorCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        self.main_cf = os.path.join(self.postfix_dir, 'main.cf')
+        with open(self.main_cf, 'w') as f:
+            f.write('myhostname = mail.fubard.org\n')
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'config.json'))
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.postfix_dir)
+
+    def deploy(self, **save_args):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir,
+            ca_sources=[os.path.join(EXAMPLES_DIR, 'ca-certs', 'root1.pem')])
+        postfix_config_gen.deploy_cert('example.com', '/le/cert.pem',
+                                       '/le/privkey.pem', '/le/chain.pem',
+                                       '/le/fullchain.pem')
+        postfix_config_gen.save(**save_args)
+        return postfix_config_gen
+
+    def testRollbackCheckpoint(self):
+        postfix_config_gen = self.deploy(title='deploy')
+        policy_file = postfix_config_gen.policy_file
+        self.assertTrue(os.path.exists(policy_file))
+        checkpoint, = postfix_config_gen.checkpoints.checkpoints()
+        self.assertEqual('deploy', checkpoint['title'])
+        self.assertEqual(sorted([self.main_cf, policy_file,
+                                 postfix_config_gen.ca_file]),
+                         sorted(checkpoint['files']))
+
+        postfix_config_gen.rollback_checkpoints(1)
+        with open(self.main_cf) as f:
+            self.assertEqual('myhostname = mail.fubard.org\n', f.read())
+        self.assertFalse(os.path.exists(policy_file))
+        self.assertFalse(os.path.exists(postfix_config_gen.ca_file))
+        self.assertIn(self.main_cf, postfix_config_gen.changed_files)
+
+    def testUnchangedDeployAddsNoCheckpoint(self):
+        postfix_config_gen = self.deploy(title='deploy')
+        pcg.complete_policy_manifest(postfix_config_gen.policy_file)
+        postfix_config_gen = self.deploy(title='again')
+        self.assertEqual(1, len(postfix_config_gen.checkpoints.checkpoints()))
+
+    def testRecoveryRoutine(self):
+        self.deploy(title='deploy')
+        with open(self.main_cf) as f:
+            deployed = f.read()
+        self.config.acceptable_mxs.clear()
+        postfix_config_gen = self.deploy(temporary=True)
+        with open(postfix_config_gen.policy_file) as f:
+            self.assertEqual('\n', f.read())
+        postfix_config_gen.recovery_routine()
+        with open(postfix_config_gen.policy_file) as f:
+            self.assertIn('valid-example-recipient.com', f.read())
+        with open(self.main_cf) as f:
+            self.assertEqual(deployed, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
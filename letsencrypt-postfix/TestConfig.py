@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 import copy
+import datetime
 import itertools
+import json
 import logging
+import os
+import shutil
+import stat
+import tempfile
 import unittest
 
 import Config
@@ -9,6 +15,33 @@ import Config
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'examples')
+
+
+class TestParseTimestamp(unittest.TestCase):
+
+    def testEpochSeconds(self):
+        self.assertEqual(datetime.datetime.fromtimestamp(1401093333),
+                         Config.parse_timestamp('1401093333', 'timestamp'))
+
+    def testIso8601FastPath(self):
+        parsed = Config.parse_timestamp('2015-08-01T12:00:00+08:00', 'expires')
+        self.assertEqual(datetime.timedelta(hours=8), parsed.utcoffset())
+        self.assertEqual('2015-08-01T12:00:00+0800',
+                         Config.to_dict({'e': parsed})['e'])
+        parsed = Config.parse_timestamp('2014-06-06T14:30:16.5Z', 'expires')
+        self.assertEqual((datetime.timedelta(0), 500000),
+                         (parsed.utcoffset(), parsed.microsecond))
+        self.assertIsNone(
+            Config.parse_timestamp('2014-06-06 14:30', 'expires').tzinfo)
+
+    def testOtherFormatsUseDateutil(self):
+        parsed = Config.parse_timestamp('Jun 6 2014 14:30:16', 'expires')
+        self.assertEqual(datetime.datetime(2014, 6, 6, 14, 30, 16), parsed)
+        self.assertRaises(Config.ConfigError, Config.parse_timestamp,
+                          'not a date', 'expires')
+
 
 class TestTLSPolicy(unittest.TestCase):
 
@@ -44,6 +77,48 @@ class TestTLSPolicy(unittest.TestCase):
         self.assertEquals(tls_policy.domain_suffix, self.old_config.domain_suffix)
 
 
+class TestTLSPolicyInterning(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {'require-tls': True, 'min-tls-version': 'TLSv1.2',
+                         'enforce-mode': 'enforce'}
+        self.config = Config.Config()
+        self.config.make_tls_policy_dict({'.a.com': self.settings,
+                                          '.b.com': dict(self.settings),
+                                          '.c.com': {'require-tls': True}})
+
+    def testIdenticalBodiesShareOneBody(self):
+        policies = self.config.tls_policies
+        self.assertIsNot(policies['.a.com'], policies['.b.com'])
+        self.assertEqual('.b.com', policies['.b.com'].domain_suffix)
+        self.assertIs(policies['.a.com']._body, policies['.b.com']._body)
+        self.assertIsNot(policies['.a.com']._body, policies['.c.com']._body)
+        other = Config.Config()
+        other.make_tls_policy_dict({'.d.com': self.settings})
+        self.assertIs(policies['.a.com']._body, other.tls_policies['.d.com']._body)
+
+    def testPoliciesStayMutable(self):
+        policies = self.config.tls_policies
+        policies['.a.com'].min_tls_version = 'TLSv1'
+        self.assertEqual('TLSv1', policies['.a.com'].min_tls_version)
+        self.assertEqual('TLSv1.2', policies['.b.com'].min_tls_version)
+        self.assertIsNone(policies['.a.com']._body)
+        self.assertEqual('TLSv1', json.loads(
+            self.config.to_json())['tls-policies']['.a.com']['min-tls-version'])
+        # interning again finds the body other policies already share
+        policies['.a.com'].min_tls_version = 'TLSv1.2'
+        Config.intern_tls_policy(policies['.a.com'])
+        self.assertIs(policies['.a.com']._body, policies['.b.com']._body)
+
+    def testToJsonRoundTrip(self):
+        reloaded = Config.Config()
+        reloaded.from_json_dict(json.loads(self.config.to_json()))
+        self.assertEqual(json.loads(self.config.to_json()),
+                         json.loads(reloaded.to_json()))
+        self.assertEqual(self.settings,
+                         json.loads(reloaded.to_json())['tls-policies']['.b.com'])
+
+
 class TestAcceptableMX(unittest.TestCase):
 
     def setUp(self):
@@ -128,5 +203,271 @@ class TestConfig(unittest.TestCase):
         self.assertDictEqual(test_data, control_data)
 
 
+class TestConfigValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config.Config()
+        self.config.from_json_dict({
+            'timestamp': 1401093333,
+            'expires': '2015-08-01T12:00:00+08:00',
+            'tls-policies': {
+                '.eff.org': {'require-tls': True,
+                             'min-tls-version': 'TLSv1.1',
+                             'enforce-mode': 'enforce'},
+                '.google.com': {'require-tls': True,
+                                'min-tls-version': 'TLSv1.2',
+                                'enforce-mode': 'log-only'},
+            },
+            'acceptable-mxs': {
+                'eff.org': {'accept-mx-domains': ['.eff.org']},
+                'gmail.com': {'accept-mx-domains': ['.google.com']},
+            },
+        })
+        self.now = datetime.datetime(2015, 1, 1)
+
+    def codes(self, now=None):
+        return sorted((e.code, e.subject)
+                      for e in self.config.validate(now or self.now))
+
+    def testValidConfig(self):
+        self.assertEqual([], self.codes())
+        self.assertTrue(self.config.is_valid())
+
+    def testExpiryDoesNotMakeInvalid(self):
+        self.assertEqual([('expired', 'expires')],
+                         self.codes(datetime.datetime(2016, 1, 1)))
+        self.assertTrue(self.config.is_valid())
+
+    def testGetAllMxHosts(self):
+        self.assertEqual(set(['.eff.org', '.google.com']),
+                         self.config.get_all_mx_hosts())
+
+    def testReportsEveryViolation(self):
+        self.config.make_tls_policy_dict({
+            '.mail.google.com': {'require-tls': True,
+                                 'min-tls-version': 'TLSv1.2',
+                                 'enforce-mode': 'enforce'},
+            '.orphan.net': {'require-tls': True},
+        })
+        self.config.make_acceptable_mxs_dict({
+            'yahoo.com': {'accept-mx-domains': ['.yahoodns.net']},
+        })
+        self.assertEqual([
+            ('expired', 'expires'),
+            ('incomplete-tls-policy', '.orphan.net'),
+            ('missing-tls-policy', 'yahoo.com'),
+            ('orphaned-tls-policy', '.mail.google.com'),
+            ('orphaned-tls-policy', '.orphan.net'),
+            ('overlapping-tls-policy', '.mail.google.com'),
+        ], self.codes(datetime.datetime(2016, 1, 1)))
+        self.assertFalse(self.config.is_valid())
+
+    def testFindOverlappingSuffixes(self):
+        overlaps = Config.find_overlapping_suffixes(
+            ['.google.com', '.mx.mail.google.com', '*.eff.org', '.eff.org',
+             '.google.co'])
+        self.assertEqual(sorted([('.mx.mail.google.com', '.google.com'),
+                                 ('.eff.org', '*.eff.org')]),
+                         sorted(overlaps))
+
+
+class TestConfigDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.old = Config.Config()
+        self.old.load_from_json_file(os.path.join(EXAMPLES_DIR, 'bigger_test_config.json'))
+        self.new = Config.Config()
+        self.new.load_from_json_file(os.path.join(EXAMPLES_DIR, 'bigger_test_config.json'))
+
+    def testIdenticalConfigs(self):
+        diff = self.old.diff(self.new)
+        self.assertEqual(0, len(diff))
+        self.assertEqual({'properties': {},
+                          'tls-policies': {'set': {}, 'remove': []},
+                          'acceptable-mxs': {'set': {}, 'remove': []}},
+                         diff.to_json_dict())
+
+    def testAddedRemovedChanged(self):
+        del self.new.tls_policies['.yahoodns.net']
+        del self.new.acceptable_mxs['yahoo.com']
+        self.new.tls_policies['.eff.org'].min_tls_version = 'TLSv1.2'
+        self.new.make_tls_policy_dict({'.outlook.com': {'require-tls': True}})
+        self.new.timestamp = 1401414364
+        diff = self.old.diff(self.new)
+        self.assertEqual(['.outlook.com'], list(diff.tls_policies.added))
+        self.assertEqual(['.yahoodns.net'], list(diff.tls_policies.removed))
+        self.assertEqual(['.eff.org'], list(diff.tls_policies.changed))
+        self.assertEqual(['yahoo.com'], list(diff.acceptable_mxs.removed))
+        self.assertEqual(['timestamp'], list(diff.properties))
+        self.assertEqual(5, len(diff))
+        change_set = diff.to_json_dict()
+        self.assertEqual(['.eff.org', '.outlook.com'],
+                         sorted(change_set['tls-policies']['set']))
+        self.assertEqual('TLSv1.2', change_set['tls-policies']['set']
+                         ['.eff.org']['min-tls-version'])
+        self.assertEqual(['yahoo.com'],
+                         change_set['acceptable-mxs']['remove'])
+
+    def testMergeJoin(self):
+        joined = list(Config.merge_join({'a': 1, 'c': 3}, {'b': 2, 'c': 4}))
+        self.assertEqual([('a', 1, None), ('b', None, 2), ('c', 3, 4)], joined)
+
+
+class TestConfigUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = Config.Config()
+        self.upstream.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'bigger_test_config.json'))
+        self.override = Config.Config()
+        self.override.from_json_dict({
+            'author': 'Local postmaster',
+            'tls-policies': {
+                '.eff.org': {'min-tls-version': 'TLSv1.2'},
+                '.example.net': {'require-tls': True,
+                                 'min-tls-version': 'TLSv1.2',
+                                 'enforce-mode': 'enforce'},
+            },
+            'acceptable-mxs': {
+                'example.net': {'accept-mx-domains': ['.example.net']},
+            },
+        })
+
+    def testMergeSharesUnchangedPolicies(self):
+        merged = self.upstream.merge(self.override)
+        self.assertEqual('Local postmaster', merged.author)
+        self.assertEqual(self.upstream.timestamp, merged.timestamp)
+        self.assertIs(self.upstream.tls_policies['.google.com'],
+                      merged.tls_policies['.google.com'])
+        self.assertIs(self.upstream.acceptable_mxs['eff.org'],
+                      merged.acceptable_mxs['eff.org'])
+        self.assertIs(self.override.tls_policies['.example.net'],
+                      merged.tls_policies['.example.net'])
+        eff_policy = merged.tls_policies['.eff.org']
+        self.assertEqual('TLSv1.2', eff_policy.min_tls_version)
+        self.assertEqual('enforce', eff_policy.enforce_mode)
+        # the inputs are left alone
+        self.assertEqual('TLSv1.1',
+                         self.upstream.tls_policies['.eff.org'].min_tls_version)
+        self.assertNotIn('.example.net', self.upstream.tls_policies)
+
+    def testMergeLayersOverSharedSections(self):
+        merged = self.upstream.merge(self.override)
+        for section in ('tls_policies', 'acceptable_mxs'):
+            layered = getattr(merged, section)
+            self.assertIs(getattr(self.upstream, section), layered.base)
+            self.assertEqual(set(getattr(self.override, section)),
+                             set(layered.changes))
+        # layering a further override keeps one shared base
+        again = merged.merge(self.override)
+        self.assertIs(self.upstream.tls_policies, again.tls_policies.base)
+        self.assertEqual(sorted(merged.tls_policies),
+                         sorted(again.tls_policies))
+        self.assertEqual(Config.to_dict(merged.tls_policies),
+                         Config.to_dict(again.tls_policies))
+
+    def testLayeredDict(self):
+        base = {'a': 1, 'b': 2}
+        layered = Config.LayeredDict(base)
+        layered['c'] = 3
+        layered['a'] = 10
+        del layered['b']
+        self.assertEqual({'a': 10, 'c': 3}, dict(layered))
+        self.assertEqual(2, len(layered))
+        self.assertNotIn('b', layered)
+        self.assertRaises(KeyError, layered.__delitem__, 'b')
+        layered['b'] = 20
+        self.assertEqual(3, len(layered))
+        self.assertEqual({'a': 1, 'b': 2}, base)
+        # the base's owner may still change it
+        base['d'] = 4
+        del base['a']
+        self.assertEqual({'a': 10, 'b': 20, 'c': 3, 'd': 4}, dict(layered))
+        self.assertEqual(4, len(layered))
+        del base['b']
+        self.assertEqual(4, len(layered))
+
+    def testAddIsMerge(self):
+        merged = self.upstream + self.override
+        self.assertEqual(4, len(merged.tls_policies))
+
+    def testUpdateReplacesSections(self):
+        updated = self.upstream.update(self.override)
+        self.assertEqual(['.eff.org', '.example.net'],
+                         sorted(updated.tls_policies))
+        self.assertIsNone(updated.timestamp)
+        self.assertIsNone(updated.tls_policies['.eff.org'].enforce_mode)
+
+    def testUpdateCopiesSections(self):
+        updated = self.upstream.update(self.override)
+        del self.override.tls_policies['.eff.org']
+        self.assertIn('.eff.org', updated.tls_policies)
+        del updated.acceptable_mxs['example.net']
+        self.assertIn('example.net', self.override.acceptable_mxs)
+
+
+class TestJsonSerialization(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'bigger_test_config.json'))
+        self.tmp_dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.tmp_dir, 'policy.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testCanonicalOutput(self):
+        expected = json.dumps(Config.to_dict(self.config._data),
+                              sort_keys=True, indent=2, separators=(',', ': '))
+        self.assertEqual(expected, self.config.to_json())
+        chunks = []
+        Config.write_json({'a': [], 'b': {}}, chunks.append)
+        self.assertEqual('{\n  "a": [],\n  "b": {}\n}', ''.join(chunks))
+
+    def testWriteReplacesFileAtomically(self):
+        with open(self.json_file, 'w') as f:
+            f.write('old')
+        os.chmod(self.json_file, 0640)
+        self.config.write_to_json_file(self.json_file)
+        self.assertEqual(['policy.json'], os.listdir(self.tmp_dir))
+        self.assertEqual(0640, stat.S_IMODE(os.stat(self.json_file).st_mode))
+        reloaded = Config.Config()
+        reloaded.load_from_json_file(self.json_file)
+        self.assertEqual(self.config.to_json(), reloaded.to_json())
+
+    def testFopenPathWritesTheSameFile(self):
+        self.config.write_to_json_file(self.json_file)
+        with open(self.json_file) as f:
+            atomic = f.read()
+        self.config.write_to_json_file(self.json_file, open)
+        with open(self.json_file) as f:
+            self.assertEqual(atomic, f.read())
+        self.assertEqual(self.config.to_json() + '\n', atomic)
+
+    def testScalars(self):
+        chunks = []
+        Config.write_json([1, 2L, 1.5, None, True, u'\xe9', 'x'],
+                          chunks.append)
+        self.assertEqual(json.dumps([1, 2L, 1.5, None, True, u'\xe9', 'x'],
+                                    indent=2, separators=(',', ': ')),
+                         ''.join(chunks))
+
+    def testFailedWriteKeepsOldFile(self):
+        with open(self.json_file, 'w') as f:
+            f.write('old')
+
+        def broken_write_json(write):
+            write('{')
+            raise IOError('disk full')
+        self.config.write_json = broken_write_json
+        self.assertRaises(IOError, self.config.write_to_json_file,
+                          self.json_file)
+        self.assertEqual(['policy.json'], os.listdir(self.tmp_dir))
+        with open(self.json_file) as f:
+            self.assertEqual('old', f.read())
+
+
 if __name__ == '__main__':
     unittest.main()
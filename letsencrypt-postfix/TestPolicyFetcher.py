@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import Config
+import PolicyFetcher
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+
+def sign(data):
+    return 'sig:' + hashlib.sha256(data).hexdigest()
+
+
+class FakeVerifier(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, data, signature):
+        self.calls += 1
+        return signature == sign(data)
+
+
+class PolicyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves self.server.files with ETags, honouring If-None-Match."""
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        self.server.requests.append((self.command, self.path))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def policy_json(timestamp, min_tls_version='TLSv1.1'):
+    return json.dumps({
+        'timestamp': timestamp,
+        'tls-policies': {
+            '.eff.org': {'require-tls': True, 'enforce-mode': 'enforce',
+                         'min-tls-version': min_tls_version},
+            '.google.com': {'require-tls': True, 'enforce-mode': 'enforce',
+                            'min-tls-version': 'TLSv1.2'},
+        },
+        'acceptable-mxs': {
+            'eff.org': {'accept-mx-domains': ['.eff.org']},
+            'gmail.com': {'accept-mx-domains': ['.google.com']},
+        },
+    })
+
+
+class TestPolicyFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                PolicyRequestHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/policy.json' % self.server.server_port
+        self.cache_dir = tempfile.mkdtemp()
+        self.verifier = FakeVerifier()
+        self.publish('/policy.json', policy_json(1000))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def publish(self, path, data):
+        self.server.files[path] = data
+        self.server.files[path + '.sig'] = sign(data)
+
+    def fetcher(self):
+        return PolicyFetcher.PolicyFetcher(self.url, self.cache_dir,
+                                           self.verifier)
+
+    def testFullThenUnchanged(self):
+        config, how = self.fetcher().refresh()
+        self.assertEqual('full', how)
+        self.assertEqual(1000, PolicyFetcher.config_version(config))
+        del self.server.requests[:]
+        config, how = self.fetcher().refresh()
+        self.assertEqual('unchanged', how)
+        self.assertEqual([('HEAD', '/policy.json')], self.server.requests)
+        self.assertEqual(['.eff.org', '.google.com'],
+                         sorted(config.tls_policies))
+
+    def testDeltaUpdate(self):
+        self.fetcher().refresh()
+        old = Config.Config()
+        old.from_json_dict(json.loads(policy_json(1000)))
+        new = Config.Config()
+        new.from_json_dict(json.loads(policy_json(2000, 'TLSv1.2')))
+        self.publish('/policy.json', policy_json(2000, 'TLSv1.2'))
+        self.publish('/policy.json.deltas/1000.json', json.dumps(
+            {'from': 1000, 'to': 2000,
+             'changes': old.diff(new).to_json_dict()}))
+        del self.server.requests[:]
+        config, how = self.fetcher().refresh()
+        self.assertEqual('delta', how)
+        self.assertNotIn(('GET', '/policy.json'), self.server.requests)
+        self.assertEqual('TLSv1.2',
+                         config.tls_policies['.eff.org'].min_tls_version)
+        reloaded = self.fetcher().local_config()
+        self.assertEqual(config.to_json(), reloaded.to_json())
+        self.assertEqual('unchanged', self.fetcher().refresh()[1])
+
+    def testMissingDeltaFallsBackToFull(self):
+        self.fetcher().refresh()
+        self.publish('/policy.json', policy_json(2000, 'TLSv1.2'))
+        config, how = self.fetcher().refresh()
+        self.assertEqual('full', how)
+        self.assertEqual(2000, PolicyFetcher.config_version(config))
+
+    def testMalformedDeltaFallsBackToFull(self):
+        self.fetcher().refresh()
+        self.publish('/policy.json', policy_json(2000, 'TLSv1.2'))
+        self.publish('/policy.json.deltas/1000.json', json.dumps(
+            {'from': 1000, 'to': 2000,
+             'changes': {'properties': {'tls-policies': {}}}}))
+        config, how = self.fetcher().refresh()
+        self.assertEqual('full', how)
+        self.assertEqual(2000, PolicyFetcher.config_version(config))
+
+    def testStateWithoutVerified(self):
+        with open(os.path.join(self.cache_dir, PolicyFetcher.STATE_FILE),
+                  'w') as f:
+            json.dump({'etag': None}, f)
+        self.assertEqual('full', self.fetcher().refresh()[1])
+
+    def testBadSignatureKeepsCachedPolicy(self):
+        self.fetcher().refresh()
+        self.server.files['/policy.json'] = policy_json(2000)
+        self.assertRaises(PolicyFetcher.FetchError, self.fetcher().refresh)
+        self.assertEqual(1000, PolicyFetcher.config_version(
+            self.fetcher().local_config()))
+
+    def testRefusesOlderPolicy(self):
+        self.publish('/policy.json', policy_json(2000))
+        self.fetcher().refresh()
+        self.publish('/policy.json', policy_json(1000))
+        self.assertRaises(PolicyFetcher.FetchError, self.fetcher().refresh)
+
+    def testVerificationIsCached(self):
+        self.fetcher().refresh()
+        self.assertEqual(1, self.verifier.calls)
+        # Losing the ETag forces a download of the same signed version.
+        os.remove(os.path.join(self.cache_dir, PolicyFetcher.POLICY_FILE))
+        state_file = os.path.join(self.cache_dir, PolicyFetcher.STATE_FILE)
+        with open(state_file) as f:
+            state = json.load(f)
+        state['etag'] = None
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+        self.assertEqual('full', self.fetcher().refresh()[1])
+        self.assertEqual(1, self.verifier.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
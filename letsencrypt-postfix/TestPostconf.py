@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import Postconf
+import PostfixConfigGenerator as pcg
+
+
+POSTCONF_OUTPUT = """data_directory = /var/lib/postfix
+mail_version = 3.1.4
+myhostname = mail.fubard.org
+smtp_tls_session_cache_database = btree:/var/lib/postfix/smtp_scache
+smtpd_banner = mail.fubard.org ESMTP Postfix
+relayhost =
+"""
+
+# Prints POSTCONF_OUTPUT and counts its runs in a file beside main.cf.
+FAKE_POSTCONF = """#!/bin/sh
+[ "$1" = "-c" ] || exit 1
+echo run >> "$2/postconf-runs"
+cat <<'EOF'
+%sEOF
+""" % POSTCONF_OUTPUT
+
+
+class TestPostconf(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        self.main_cf = os.path.join(self.postfix_dir, 'main.cf')
+        with open(self.main_cf, 'w') as f:
+            f.write('myhostname = mail.fubard.org\n')
+        self.postconf = os.path.join(self.postfix_dir, 'postconf')
+        with open(self.postconf, 'w') as f:
+            f.write(FAKE_POSTCONF)
+        os.chmod(self.postconf, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.postfix_dir)
+
+    def runs(self):
+        with open(os.path.join(self.postfix_dir, 'postconf-runs')) as f:
+            return len(f.readlines())
+
+    def testParse(self):
+        values = Postconf.parse_postconf(POSTCONF_OUTPUT)
+        self.assertEqual('/var/lib/postfix', values['data_directory'])
+        self.assertEqual('', values['relayhost'])
+        self.assertEqual('mail.fubard.org ESMTP Postfix',
+                         values['smtpd_banner'])
+
+    def testSnapshotCachedUntilMainCfChanges(self):
+        postconf = Postconf.Postconf(self.postfix_dir, self.postconf)
+        self.assertEqual((3, 1, 4), postconf.version())
+        self.assertEqual('/var/lib/postfix', postconf.get('data_directory'))
+        postconf = Postconf.Postconf(self.postfix_dir, self.postconf)
+        self.assertIsNone(postconf.get('no_such_parameter'))
+        self.assertEqual(1, self.runs())
+        with open(self.main_cf, 'a') as f:
+            f.write('mydomain = fubard.org\n')
+        postconf.get('mail_version')
+        self.assertEqual(2, self.runs())
+
+    def testFailure(self):
+        postconf = Postconf.Postconf(self.postfix_dir, '/bin/false')
+        self.assertRaises(Postconf.PostconfError, postconf.snapshot)
+
+    def testGeneratorRunsPostconfOnce(self):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            None, self.postfix_dir, postconf=self.postconf)
+        postfix_config_gen.prepare()
+        self.assertEqual((3, 1, 4), postfix_config_gen.postfix_version)
+        self.assertEqual(
+            'btree:/var/lib/postfix/smtp_scache',
+            postfix_config_gen.get_effective_value(
+                'smtp_tls_session_cache_database'))
+        self.assertEqual(1, self.runs())
+
+
+if __name__ == '__main__':
+    unittest.main()
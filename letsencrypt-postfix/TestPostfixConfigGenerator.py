@@ -7,9 +7,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import io
+import json
 import logging
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
 import unittest
 
+import Cdb
 import Config
 import PostfixConfigGenerator as pcg
 
@@ -17,6 +25,9 @@ import PostfixConfigGenerator as pcg
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'examples')
+
 
 # Fake Postfix Configs
 names_only_config = """myhostname = mail.fubard.org
@@ -29,6 +40,17 @@ certs_only_config = (
 smtpd_tls_key_file = /etc/letsencrypt/live/www.fubard.org/privkey.pem""")
 
 
+continued_config = """# smtp_tls_protocols = commented out
+smtp_tls_protocols_extra = !SSLv2
+smtpd_tls_protocols =
+    !SSLv2,
+# a comment inside a continued setting
+    !SSLv3
+smtp_tls_loglevel = 1
+smtp_tls_loglevel = 2
+myhostname = mail.fubard.org"""
+
+
 def GetFakeOpen(fake_file_contents):
     fake_file = io.StringIO()
     # cast this to unicode for py2
@@ -87,5 +109,618 @@ class TestPostfixConfigGenerator(unittest.TestCase):
         self.assertEqual([], postfix_config_gen.get_all_certs_keys())
 
 
+class TestMainCfIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_config_gen = pcg.PostfixConfigGenerator(
+            None, 'tests/', fixup=True, fopen=GetFakeOpen(continued_config))
+
+    def testParseContinuationLinesAndComments(self):
+        index = self.postfix_config_gen.cf_index
+        self.assertEqual(['smtp_tls_protocols_extra', 'smtpd_tls_protocols',
+                          'smtp_tls_loglevel', 'myhostname'], list(index))
+        entry, = index['smtpd_tls_protocols']
+        self.assertEqual(('!SSLv2, !SSLv3', 2, 5),
+                         (entry.value, entry.first, entry.last))
+        self.assertEqual('2',
+                         self.postfix_config_gen.get_cf_value('smtp_tls_loglevel'))
+
+    def testNoPrefixCollisions(self):
+        self.postfix_config_gen.ensure_cf_var('smtp_tls_protocols',
+                                              '!SSLv2, !SSLv3', [])
+        self.assertEqual(['smtp_tls_protocols = !SSLv2, !SSLv3'],
+                         self.postfix_config_gen.additions)
+        self.assertEqual(set(), self.postfix_config_gen.deletions)
+
+    def testAcceptableContinuedValue(self):
+        self.postfix_config_gen.ensure_cf_var('smtpd_tls_protocols',
+                                              '!SSLv2, !SSLv3', [])
+        self.assertEqual([], self.postfix_config_gen.additions)
+
+    def testFixupDeletesWholeSpans(self):
+        self.postfix_config_gen.ensure_cf_var('smtpd_tls_protocols',
+                                              '!SSLv2, !SSLv3, !TLSv1', [])
+        self.assertEqual(set([2, 3, 4, 5]),
+                         self.postfix_config_gen.deletions)
+        self.postfix_config_gen.ensure_cf_var('smtp_tls_loglevel', '1', [])
+        self.assertEqual(set([2, 3, 4, 5, 6, 7]),
+                         self.postfix_config_gen.deletions)
+        self.assertEqual(['smtpd_tls_protocols = !SSLv2, !SSLv3, !TLSv1',
+                          'smtp_tls_loglevel = 1'],
+                         self.postfix_config_gen.additions)
+
+    def testConflictWithoutFixup(self):
+        self.postfix_config_gen.fixup = False
+        self.assertRaises(pcg.ExistingConfigError,
+                          self.postfix_config_gen.ensure_cf_var,
+                          'smtp_tls_loglevel', '1', [])
+
+
+class TestMainCfRewrite(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        self.main_cf = os.path.join(self.postfix_dir, 'main.cf')
+        with open(self.main_cf, 'w') as f:
+            f.write(continued_config)
+        os.chmod(self.main_cf, 0640)
+
+    def tearDown(self):
+        shutil.rmtree(self.postfix_dir)
+
+    def generator(self):
+        return pcg.PostfixConfigGenerator(None, self.postfix_dir, fixup=True)
+
+    def testRewriteIsAtomicAndKeepsMode(self):
+        postfix_config_gen = self.generator()
+        postfix_config_gen.ensure_cf_var('smtp_tls_loglevel', '1', [])
+        postfix_config_gen.ensure_cf_var('smtpd_use_tls', 'yes', [])
+        postfix_config_gen.maybe_add_config_lines()
+        # no temporary files left behind, just the original in a checkpoint
+        self.assertEqual(['main.cf', 'starttls_everywhere_checkpoints'],
+                         sorted(os.listdir(self.postfix_dir)))
+        self.assertEqual(0640, stat.S_IMODE(os.stat(self.main_cf).st_mode))
+        with open(self.main_cf) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(['# Line removed by STARTTLS Everywhere',
+                          '# smtp_tls_loglevel = 1',
+                          '# Line removed by STARTTLS Everywhere',
+                          '# smtp_tls_loglevel = 2',
+                          'myhostname = mail.fubard.org',
+                          '#',
+                          '# New config lines added by STARTTLS Everywhere',
+                          '#',
+                          'smtp_tls_loglevel = 1',
+                          'smtpd_use_tls = yes'], lines[6:])
+        self.assertEqual(set([self.main_cf]),
+                         postfix_config_gen.changed_files)
+        # A second run finds everything in place and touches nothing.
+        postfix_config_gen = self.generator()
+        postfix_config_gen.ensure_cf_var('smtp_tls_loglevel', '1', [])
+        postfix_config_gen.ensure_cf_var('smtpd_use_tls', 'yes', [])
+        postfix_config_gen.maybe_add_config_lines()
+        self.assertEqual(set(), postfix_config_gen.changed_files)
+
+    def testRestartSkippedWithoutChanges(self):
+        postfix_config_gen = self.generator()
+        commands = []
+        postfix_config_gen.postfix_command = \
+            lambda *args: commands.append(args) or 0
+        postfix_config_gen.restart()
+        self.assertEqual([], commands)
+        postfix_config_gen.changed_files.add(self.main_cf)
+        postfix_config_gen.restart()
+        self.assertEqual([('reload',)], commands)
+
+    def testMissingCASourceKeepsCAfile(self):
+        missing = os.path.join(self.postfix_dir, 'no-such-ca-certificates')
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            None, self.postfix_dir, ca_sources=[missing])
+        self.assertRaises(Exception, postfix_config_gen.update_CAfile)
+        with open(postfix_config_gen.ca_file, 'w') as f:
+            f.write('existing bundle')
+        logging.disable(logging.WARNING)
+        try:
+            postfix_config_gen.update_CAfile()
+        finally:
+            logging.disable(logging.NOTSET)
+        with open(postfix_config_gen.ca_file) as f:
+            self.assertEqual('existing bundle', f.read())
+        self.assertEqual(set(), postfix_config_gen.changed_files)
+
+
+class TestPolicyMapTypes(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.postfix_dir, 'main.cf'), 'w') as f:
+            f.write(names_only_config)
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'starttls-everywhere.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.postfix_dir)
+
+    def testCdbRoundTrip(self):
+        items = [(b'key%d' % n, b'value %d' % n) for n in range(1000)]
+        cdb_file = os.path.join(self.postfix_dir, 'test.cdb')
+        with open(cdb_file, 'wb') as f:
+            Cdb.write_cdb(f, iter(items))
+        with open(cdb_file, 'rb') as f:
+            data = f.read()
+        for key, value in items:
+            self.assertEqual(value, Cdb.cdb_get(data, key))
+        self.assertIsNone(Cdb.cdb_get(data, b'missing'))
+
+    def testCdbPolicyMap(self):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir, policy_map_type='cdb')
+        postfix_config_gen.wrangle_existing_config()
+        policy_file = postfix_config_gen.policy_file
+        self.assertIn('smtp_tls_policy_maps = cdb:' + policy_file,
+                      postfix_config_gen.additions)
+        postfix_config_gen.set_domainwise_tls_policies()
+        with open(policy_file + '.cdb', 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(self.config.acceptable_mxs),
+                         len(postfix_config_gen.policy_lines))
+        for line in postfix_config_gen.policy_lines:
+            domain, _, value = line.partition(' ')
+            self.assertEqual(value, Cdb.cdb_get(data, domain.lower()))
+        self.assertIn(policy_file + '.cdb', postfix_config_gen.changed_files)
+
+    def testUnchangedPolicyMapIsNotRewritten(self):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual(len(self.config.acceptable_mxs),
+                         len(postfix_config_gen.policy_changes))
+        pcg.complete_policy_manifest(postfix_config_gen.policy_file)
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual([], postfix_config_gen.policy_changes)
+        self.assertEqual(set(), postfix_config_gen.changed_files)
+
+    def testIncompleteDeployIsRedone(self):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        # postfix was never reloaded with this map
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual(len(self.config.acceptable_mxs),
+                         len(postfix_config_gen.policy_changes))
+        self.assertIn(postfix_config_gen.policy_file,
+                      postfix_config_gen.changed_files)
+
+        reloads = []
+        postfix_config_gen.postfix_command = \
+            lambda *args: reloads.append(args) or 0
+        postfix_config_gen.restart()
+        self.assertEqual([("reload",)], reloads)
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual([], postfix_config_gen.policy_changes)
+
+    def testPolicyMapEditedOutsideIsRewritten(self):
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        policy_file = postfix_config_gen.policy_file
+        with open(policy_file, 'a') as f:
+            f.write('example.net none\n')
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir)
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertIn(policy_file, postfix_config_gen.changed_files)
+        with open(policy_file) as f:
+            self.assertNotIn('example.net', f.read())
+
+    def testIndexedPolicyMapIsPatched(self):
+        patches = []
+        def fake_postmap(map_type, source_file):
+            with open(source_file + '.db', 'w') as f:
+                f.write('indexed')
+        def fake_postmap_patch(map_type, source_file, changes):
+            patches.append(changes)
+
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir, policy_map_type='hash')
+        postfix_config_gen.postmap = fake_postmap
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual([], patches)
+        pcg.complete_policy_manifest(postfix_config_gen.policy_file)
+
+        domain = sorted(self.config.acceptable_mxs)[0]
+        del self.config.acceptable_mxs[domain]
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir, policy_map_type='hash')
+        postfix_config_gen.postmap = fake_postmap
+        postfix_config_gen.postmap_patch = fake_postmap_patch
+        postfix_config_gen.set_domainwise_tls_policies()
+        self.assertEqual(1, len(patches))
+        self.assertEqual([domain], [key for key, old, new in patches[0]])
+        self.assertIsNone(patches[0][0][2])
+        self.assertEqual(set([postfix_config_gen.policy_file,
+                              postfix_config_gen.policy_file + '.db']),
+                         postfix_config_gen.changed_files)
+
+    def testUnknownMapType(self):
+        self.assertRaises(ValueError, pcg.PostfixConfigGenerator,
+                          self.config, self.postfix_dir,
+                          policy_map_type='nis')
+
+
+# postconf -x output: data_directory is beside the script and %s is the
+# expanded smtp_tls_session_cache_database
+FAKE_SESSION_CACHE_POSTCONF = """#!/bin/sh
+echo "data_directory = $(dirname "$0")/data"
+echo "smtp_tls_session_cache_database = %s"
+"""
+
+
+class TestTLSSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_directory = os.path.join(self.tmp_dir, 'data')
+        os.mkdir(self.data_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def generator(self, main_cf, effective_cache='', **kwargs):
+        postconf = os.path.join(self.tmp_dir, 'postconf')
+        with open(postconf, 'w') as f:
+            f.write(FAKE_SESSION_CACHE_POSTCONF % effective_cache)
+        os.chmod(postconf, stat.S_IRWXU)
+        return pcg.PostfixConfigGenerator(None, self.tmp_dir,
+                                          fopen=GetFakeOpen(main_cf),
+                                          postconf=postconf, **kwargs)
+
+    def testAddedWhenMissing(self):
+        postfix_config_gen = self.generator(names_only_config)
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertEqual(
+            ['smtp_tls_session_cache_database = '
+             'btree:${data_directory}/smtp_scache'],
+            postfix_config_gen.additions)
+
+    def testTimeoutOnlySetForProfile(self):
+        main_cf = ('smtp_tls_session_cache_database = '
+                   'btree:${data_directory}/smtp_scache\n'
+                   'smtp_tls_session_cache_timeout = 7200s\n')
+        postfix_config_gen = self.generator(main_cf)
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertEqual([], postfix_config_gen.additions)
+        postfix_config_gen = self.generator(
+            names_only_config, session_cache_profile='relay')
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertIn('smtp_tls_session_cache_timeout = 3600s',
+                      postfix_config_gen.additions)
+
+    def testExistingCacheKept(self):
+        postfix_config_gen = self.generator(
+            'smtp_tls_session_cache_database = '
+            'lmdb:$data_directory/smtp_scache\n'
+            'smtp_tls_session_cache_timeout = 7200s\n',
+            'lmdb:' + os.path.join(self.data_directory, 'smtp_scache'))
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertEqual([], postfix_config_gen.additions)
+
+    def testCacheInDataDirectoryThroughSymlinkKept(self):
+        link = os.path.join(self.tmp_dir, 'link')
+        os.symlink(self.data_directory, link)
+        cache = 'btree:' + os.path.join(link, 'smtp_scache')
+        postfix_config_gen = self.generator(
+            'smtp_tls_session_cache_database = %s\n'
+            'smtp_tls_session_cache_timeout = 7200s\n' % cache, cache)
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertEqual([], postfix_config_gen.additions)
+
+    def testCacheEscapingDataDirectoryReplaced(self):
+        main_cf = ('smtp_tls_session_cache_database = '
+                   'btree:$data_directory/../scache\n')
+        postfix_config_gen = self.generator(
+            main_cf, 'btree:' + os.path.join(self.data_directory, '..',
+                                             'scache'))
+        self.assertRaises(pcg.ExistingConfigError,
+                          postfix_config_gen.ensure_tls_session_cache)
+
+    def testUnsuitableCacheReplaced(self):
+        main_cf = ('smtp_tls_session_cache_database = hash:/tmp/scache\n'
+                   'smtp_tls_session_cache_timeout = 7200s\n')
+        self.assertRaises(pcg.ExistingConfigError,
+                          self.generator(main_cf).ensure_tls_session_cache)
+        postfix_config_gen = self.generator(
+            main_cf, fixup=True, session_cache_profile='low-volume')
+        postfix_config_gen.ensure_tls_session_cache()
+        self.assertEqual(set([0, 1]), postfix_config_gen.deletions)
+        self.assertEqual(
+            ['smtp_tls_session_cache_database = '
+             'btree:${data_directory}/smtp_scache',
+             'smtp_tls_session_cache_timeout = 86400s'],
+            postfix_config_gen.additions)
+
+    def testUnknownProfile(self):
+        self.assertRaises(ValueError, self.generator, names_only_config,
+                          session_cache_profile='turbo')
+
+    def testBeneficiaries(self):
+        config = Config.Config()
+        config.load_from_json_file(os.path.join(EXAMPLES_DIR, 'config.json'))
+        postfix_config_gen = pcg.PostfixConfigGenerator(
+            config, '/postfix', fopen=GetFakeOpen(names_only_config))
+        self.assertEqual((1, 1),
+                         postfix_config_gen.session_cache_beneficiaries())
+
+
+def connection_log_line(mx_host):
+    return ('Jun 12 06:24:14 sender postfix/smtp[9045]: Trusted TLS connection '
+            'established to %s[192.0.2.7]:25: TLSv1.2 with cipher '
+            'ECDHE-RSA-AES256-GCM-SHA384 (256/256 bits)\n' % mx_host)
+
+
+class TestConnectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.postfix_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.postfix_dir, 'main.cf'), 'w') as f:
+            f.write(names_only_config)
+        self.log = os.path.join(self.postfix_dir, 'mail.log')
+        with open(self.log, 'w') as f:
+            f.writelines([connection_log_line('mx-aol.mail.aol.com')] * 5 +
+                         [connection_log_line('163mx01.mxmail.163.com')] * 3 +
+                         [connection_log_line('mx1.icloud.com')] +
+                         [connection_log_line('mx.unlisted.example')] * 9)
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'starttls-everywhere.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.postfix_dir)
+
+    def generator(self, **kwargs):
+        return pcg.PostfixConfigGenerator(
+            self.config, self.postfix_dir, connection_cache_log=self.log,
+            connection_cache_min=2, **kwargs)
+
+    def testBusiestPolicyDomainsAreCached(self):
+        postfix_config_gen = self.generator()
+        postfix_config_gen.set_connection_cache_destinations()
+        cache_file = postfix_config_gen.connection_cache_file
+        with open(cache_file) as f:
+            self.assertEqual('aol.com cache\n163.com cache\n', f.read())
+        self.assertEqual(['smtp_connection_cache_destinations = texthash:' +
+                          cache_file], postfix_config_gen.additions)
+        self.assertEqual(set([cache_file]), postfix_config_gen.changed_files)
+        postfix_config_gen = self.generator()
+        postfix_config_gen.set_connection_cache_destinations()
+        self.assertEqual(set(), postfix_config_gen.changed_files)
+
+    def testTopN(self):
+        postfix_config_gen = self.generator(connection_cache_top=1)
+        postfix_config_gen.set_connection_cache_destinations()
+        with open(postfix_config_gen.connection_cache_file) as f:
+            self.assertEqual('aol.com cache\n', f.read())
+
+
+POSTMULTI_OUTPUT = """-               -               y         /etc/postfix
+postfix-out     mta             y         /etc/postfix-out
+postfix-test    test            n         /etc/postfix-test
+"""
+
+FAKE_POSTCONF = """#!/bin/sh
+echo mail_version = 3.1.4
+"""
+
+# Logs "<config dir> <command>" and fails for config dirs named "broken".
+FAKE_POSTFIX = """#!/bin/sh
+echo "$2 $3" >> "$(dirname "$0")/postfix.log"
+case "$2" in */broken) exit 1;; esac
+"""
+
+
+class TestPostmulti(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'config.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def script(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def instance(self, name):
+        config_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(config_dir)
+        with open(os.path.join(config_dir, 'main.cf'), 'w') as f:
+            f.write(names_only_config)
+        return pcg.PostfixInstance(name, '-', True, config_dir)
+
+    def testParsePostmulti(self):
+        instances = pcg.parse_postmulti(POSTMULTI_OUTPUT)
+        self.assertEqual(['-', 'postfix-out', 'postfix-test'],
+                         [instance.name for instance in instances])
+        self.assertEqual([True, True, False],
+                         [instance.enabled for instance in instances])
+        self.assertEqual('/etc/postfix-out', instances[1].config_dir)
+
+    def testDeployInstances(self):
+        instances = [self.instance('postfix-%d' % n) for n in range(3)]
+        generator_kwargs = {
+            'postconf': self.script('postconf', FAKE_POSTCONF),
+            'ca_sources': [os.path.join(EXAMPLES_DIR, 'ca-certs',
+                                        'root1.pem')],
+        }
+        cert_args = ('example.com', '/le/cert.pem', '/le/privkey.pem',
+                     '/le/chain.pem', '/le/fullchain.pem')
+        results = pcg.deploy_instances(self.config, instances, cert_args,
+                                       jobs=2,
+                                       generator_kwargs=generator_kwargs)
+        self.assertEqual(instances, [instance for instance, _, _ in results])
+        for instance, changed, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(['main.cf', 'starttls_everywhere_CAfile',
+                              'starttls_everywhere_policy'],
+                             sorted(os.path.basename(path)
+                                    for path in changed))
+            with open(os.path.join(instance.config_dir, 'main.cf')) as f:
+                self.assertIn('smtp_tls_policy_maps = texthash:' +
+                              os.path.join(instance.config_dir,
+                                           'starttls_everywhere_policy'),
+                              f.read())
+        # Not reloaded yet: the policy maps are redone.
+        results = pcg.deploy_instances(self.config, instances, cert_args,
+                                       jobs=2,
+                                       generator_kwargs=generator_kwargs)
+        self.assertEqual([(['starttls_everywhere_policy'], None)] * 3,
+                         [([os.path.basename(path) for path in changed],
+                           error) for _, changed, error in results])
+        # What reload_instances() does once each instance reloads.
+        for instance in instances:
+            pcg.complete_policy_manifest(os.path.join(
+                instance.config_dir, pcg.POLICY_FILE_NAME))
+        # Nothing to do the third time round.
+        results = pcg.deploy_instances(self.config, instances, cert_args,
+                                       jobs=2,
+                                       generator_kwargs=generator_kwargs)
+        self.assertEqual([([], None)] * 3,
+                         [(changed, error) for _, changed, error in results])
+        for instance in instances:
+            checkpoints = pcg.PostfixConfigGenerator(
+                None, instance.config_dir).checkpoints.checkpoints()
+            self.assertEqual([pcg.DEPLOY_CHECKPOINT_TITLE] * 2,
+                             [c['title'] for c in checkpoints])
+
+    def testDeployReportsErrors(self):
+        instances = [self.instance('postfix-0'),
+                     pcg.PostfixInstance('missing', '-', True,
+                                         os.path.join(self.tmp_dir, 'none'))]
+        results = pcg.deploy_instances(
+            self.config, instances, ('example.com', 'c', 'k', 'ch', 'f'),
+            generator_kwargs={'postconf': '/bin/false'})
+        self.assertTrue(all(error for _, _, error in results))
+
+    @unittest.skipIf(os.geteuid() != 0, 'postfix is run through sudo')
+    def testReloadInstancesInBatches(self):
+        postfix = self.script('postfix', FAKE_POSTFIX)
+        instances = [pcg.PostfixInstance(name, '-', True,
+                                         os.path.join('/etc', name))
+                     for name in ('a', 'b', 'broken', 'c')]
+        self.assertRaises(Exception, pcg.reload_instances, instances, 2,
+                          postfix)
+        with open(os.path.join(self.tmp_dir, 'postfix.log')) as f:
+            reloaded = sorted(f.read().splitlines())
+        self.assertEqual(['/etc/a reload', '/etc/b reload',
+                          '/etc/broken reload', '/etc/c reload'], reloaded)
+        os.remove(os.path.join(self.tmp_dir, 'postfix.log'))
+        self.assertRaises(Exception, pcg.reload_instances, instances, 1,
+                          postfix)
+        with open(os.path.join(self.tmp_dir, 'postfix.log')) as f:
+            self.assertEqual(['/etc/a reload', '/etc/b reload',
+                              '/etc/broken reload'], f.read().splitlines())
+
+
+
+# Runs a script with the postfix binaries it starts (through sudo or not)
+# swapped for the ones in $FAKE_SBIN.
+FAKE_SBIN_RUNNER = """
+import os, runpy, subprocess, sys
+real_popen = subprocess.Popen
+def fake_popen(cmd, *args, **kwargs):
+    if cmd[0] == 'sudo':
+        cmd = cmd[1:]
+    if cmd[0].startswith('/usr/sbin/'):
+        cmd = [os.path.join(os.environ['FAKE_SBIN'],
+                            os.path.basename(cmd[0]))] + cmd[1:]
+    return real_popen(cmd, *args, **kwargs)
+subprocess.Popen = fake_popen
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+FAKE_SBIN_POSTCONF = """#!/bin/sh
+echo mail_version = 3.1.4
+echo "data_directory = $(dirname "$0")/data"
+"""
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.postfix_dir = os.path.join(self.tmp_dir, 'postfix')
+        os.mkdir(self.postfix_dir)
+        with open(os.path.join(self.postfix_dir, 'main.cf'), 'w') as f:
+            f.write(names_only_config)
+        self.lineage = os.path.join(self.tmp_dir, 'live')
+        os.mkdir(self.lineage)
+        for name in ('cert.pem', 'privkey.pem', 'chain.pem', 'fullchain.pem'):
+            open(os.path.join(self.lineage, name), 'w').close()
+        self.sbin = os.path.join(self.tmp_dir, 'sbin')
+        os.mkdir(self.sbin)
+        os.mkdir(os.path.join(self.sbin, 'data'))
+        for name, text in (('postconf', FAKE_SBIN_POSTCONF),
+                           ('postfix', FAKE_POSTFIX)):
+            path = os.path.join(self.sbin, name)
+            with open(path, 'w') as f:
+                f.write(text)
+            os.chmod(path, stat.S_IRWXU)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_generator(self, policy_file):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, FAKE_SBIN=self.sbin)
+        cmd = subprocess.Popen(
+            [sys.executable, '-c', FAKE_SBIN_RUNNER,
+             os.path.join(script_dir, 'PostfixConfigGenerator.py'),
+             policy_file, self.postfix_dir, self.lineage],
+            cwd=script_dir, env=env, stderr=subprocess.PIPE)
+        _, stderr = cmd.communicate()
+        return cmd.returncode, stderr
+
+    def testReadmeCommand(self):
+        # the example lacks enforce-mode, which the policy map does not use
+        rc, stderr = self.run_generator(
+            os.path.join(EXAMPLES_DIR, 'starttls-everywhere.json'))
+        self.assertEqual(0, rc, stderr)
+        with open(os.path.join(self.postfix_dir,
+                               'starttls_everywhere_policy')) as f:
+            self.assertEqual(25, len(f.read().splitlines()))
+        with open(os.path.join(self.sbin, 'postfix.log')) as f:
+            self.assertEqual([self.postfix_dir + ' reload'],
+                             f.read().splitlines())
+
+    def testSingleInstanceRejectsInvalidPolicy(self):
+        with open(os.path.join(EXAMPLES_DIR, 'starttls-everywhere.json')) as f:
+            policy = json.load(f)
+        del policy['tls-policies']['.google.com']['min-tls-version']
+        policy_file = os.path.join(self.tmp_dir, 'policy.json')
+        with open(policy_file, 'w') as f:
+            json.dump(policy, f)
+        rc, stderr = self.run_generator(policy_file)
+        self.assertEqual(1, rc)
+        self.assertIn(b'TLS policy for .google.com has no min-tls-version',
+                      stderr)
+        self.assertEqual(['main.cf'], os.listdir(self.postfix_dir))
+        with open(os.path.join(self.postfix_dir, 'main.cf')) as f:
+            self.assertEqual(names_only_config, f.read())
+
+
 if __name__ == '__main__':
     unittest.main()
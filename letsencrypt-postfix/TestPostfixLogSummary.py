@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+import bz2
+import gzip
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import Config
+import PostfixLogSummary
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'examples')
+
+DOMAIN = 'valid-example-recipient.com'
+
+LOG = """Jun  6 00:21:31 sender postfix/smtpd[3648]: connect from localhost[127.0.0.1]
+Jun  6 00:21:34 sender postfix/smtpd[3648]: lost connection after STARTTLS from localhost[127.0.0.1]
+Jun  6 00:22:01 sender postfix/smtp[3682]: warning: TLS library problem: 3682:error:140740BF:SSL routines:SSL23_CLIENT_HELLO:no protocols available:s23_clnt.c:381:
+Jun  6 00:22:01 sender postfix/smtp[3682]: AF3B6480475: to=<vagrant@valid-example-recipient.com>, relay=MX.valid-example-recipient.com[192.168.33.7]:25, delay=0.06, delays=0.03/0.03/0/0, dsn=4.7.5, status=deferred (Cannot start TLS: handshake failure)
+Jun 12 06:24:14 sender postfix/smtp[9045]: Untrusted TLS connection established to mx.valid-example-recipient.com[192.168.33.7]:25: TLSv1.1 with cipher AECDH-AES256-SHA (256/256 bits)
+Jun 12 06:24:14 sender postfix-out/smtp[9046]: Trusted TLS connection established to mx.valid-example-recipient.com[192.168.33.7]:25: TLSv1.2 with cipher ECDHE-RSA-AES256-GCM-SHA384 (256/256 bits)
+Jun 12 06:24:15 sender postfix/smtp[9047]: Untrusted TLS connection established to mail.unknown.example[10.0.0.1]:25: TLSv1.2 with cipher ECDHE-RSA-AES256-GCM-SHA384 (256/256 bits)
+Jun 12 06:24:15 sender postfix/smtpd[9048]: Anonymous TLS connection established from mx.valid-example-recipient.com[192.168.33.7]: TLSv1.2 with cipher ECDHE-RSA-AES256-GCM-SHA384 (256/256 bits)
+Jun 12 06:24:16 sender postfix/smtp[9049]: 62D3F481249: to=<vagrant@valid-example-recipient.com>, relay=mx.valid-example-recipient.com[192.168.33.7]:25, delay=0.07, delays=0.03/0.01/0.03/0, dsn=4.7.4, status=deferred (TLS is required, but was not offered by host mx.valid-example-recipient.com[192.168.33.7])
+Jun 12 06:24:17 sender postfix/smtp[9049]: 62D3F481249: to=<vagrant@valid-example-recipient.com>, relay=mx.valid-example-recipient.com[192.168.33.7]:25, delay=0.07, dsn=2.0.0, status=sent (250 2.0.0 Ok)
+Jun 12 06:24:18 sender postfix/qmgr[3673]: 62D3F481249: removed
+""".splitlines(True)
+
+
+class TestGetCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'config.json'))
+
+    def get_counts(self, lines, earliest_timestamp=0):
+        return PostfixLogSummary.get_counts(lines, self.config,
+                                            earliest_timestamp)
+
+    def testCounts(self):
+        counts, tls_deferred, seen_trusted, timestamp = self.get_counts(LOG)
+        self.assertEqual({DOMAIN: {'Untrusted': 1, 'Trusted': 1, 'all': 2}},
+                         counts)
+        self.assertEqual({'mx.' + DOMAIN: 2}, tls_deferred)
+        self.assertTrue(seen_trusted)
+        # the last deferral, not the qmgr line after it
+        self.assertEqual(time.strptime('Jun 12 06:24:16',
+                                       PostfixLogSummary.TIME_FORMAT),
+                         timestamp)
+
+    def testEarliestTimestamp(self):
+        earliest = time.strptime('Jun 12 06:24:15',
+                                 PostfixLogSummary.TIME_FORMAT)
+        counts, tls_deferred, seen_trusted, _ = self.get_counts(LOG, earliest)
+        self.assertEqual({}, counts)
+        self.assertEqual({'mx.' + DOMAIN: 1}, tls_deferred)
+        self.assertFalse(seen_trusted)
+
+    def testIrrelevantLinesOnly(self):
+        lines = [l for l in LOG if '/smtp[' not in l]
+        counts, tls_deferred, seen_trusted, timestamp = self.get_counts(lines)
+        self.assertEqual(({}, {}, False), (counts, tls_deferred, seen_trusted))
+        self.assertEqual(0, timestamp)
+
+    def testUnparsableLastLine(self):
+        lines = LOG + ['-- MARK --\n']
+        self.assertEqual(time.strptime('Jun 12 06:24:16',
+                                       PostfixLogSummary.TIME_FORMAT),
+                         self.get_counts(lines)[3])
+
+    def testNoInput(self):
+        self.assertEqual(0, self.get_counts([])[3])
+
+
+class TestReadLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_log(self, name, lines, opener=open):
+        path = os.path.join(self.tmp_dir, name)
+        f = opener(path, 'wb')
+        try:
+            f.write(''.join(lines))
+        finally:
+            f.close()
+        return path
+
+    def testRotationOrder(self):
+        paths = ['mail.log', 'mail.log.1', 'mail.log.10.gz', 'mail.log.2.gz']
+        self.assertEqual(['mail.log.10.gz', 'mail.log.2.gz', 'mail.log.1',
+                          'mail.log'],
+                         sorted(paths, key=PostfixLogSummary.rotation_order))
+        paths = ['mail.log', 'mail.log-20140607', 'mail.log-20140606.bz2']
+        self.assertEqual(['mail.log-20140606.bz2', 'mail.log-20140607',
+                          'mail.log'],
+                         sorted(paths, key=PostfixLogSummary.rotation_order))
+
+    def testReadRotatedAndCompressed(self):
+        paths = [self.write_log('mail.log', LOG[8:]),
+                 self.write_log('mail.log.1', LOG[5:8]),
+                 self.write_log('mail.log.2.gz', LOG[2:5], gzip.open),
+                 self.write_log('mail.log.3.bz2', LOG[:2], bz2.BZ2File)]
+        self.assertEqual(LOG, list(PostfixLogSummary.read_logs(paths)))
+
+
+class TestParallelCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'mail.log')
+        with open(self.path, 'wb') as f:
+            f.write(''.join(LOG * 50))
+        self.config = Config.Config()
+        self.config.load_from_json_file(
+            os.path.join(EXAMPLES_DIR, 'config.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def plain(self, result):
+        counts, tls_deferred, seen_trusted, timestamp = result
+        return (dict((d, dict(v)) for d, v in counts.items()),
+                dict(tls_deferred), seen_trusted, timestamp)
+
+    def testLineAlignedRanges(self):
+        ranges = PostfixLogSummary.line_aligned_ranges(self.path, 7)
+        self.assertTrue(len(ranges) >= 7)
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(os.path.getsize(self.path), ranges[-1][1])
+        lines = []
+        for start, end in ranges:
+            lines.extend(PostfixLogSummary.read_range(self.path, start, end))
+        self.assertEqual(LOG * 50, lines)
+
+    def testMergeIsAssociative(self):
+        results = [PostfixLogSummary.get_counts(LOG[i:i + 3], self.config, 0)
+                   for i in range(0, len(LOG), 3)]
+        merge = PostfixLogSummary.merge_counts
+        self.assertEqual(
+            self.plain(merge(merge(results[0], results[1]), results[2])),
+            self.plain(merge(results[0], merge(results[1], results[2]))))
+
+    def testSameAsSerial(self):
+        gz_path = os.path.join(self.tmp_dir, 'mail.log.1.gz')
+        f = gzip.open(gz_path, 'wb')
+        f.write(''.join(LOG))
+        f.close()
+        paths = [self.path, gz_path]
+        earliest = time.strptime('Jun  6 00:22:00',
+                                 PostfixLogSummary.TIME_FORMAT)
+        serial = PostfixLogSummary.get_counts(
+            PostfixLogSummary.read_logs(paths), self.config, earliest)
+        parallel = PostfixLogSummary.get_counts_parallel(
+            paths, self.config, earliest, 3)
+        self.assertEqual(self.plain(serial), self.plain(parallel))
+        self.assertEqual(51, parallel[0][DOMAIN]['Untrusted'])
+
+
+class TestNewLines(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'mail.log')
+        self.state_file = os.path.join(self.tmp_dir, 'state.json')
+        self.state = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def append(self, text, path=None):
+        with open(path or self.path, 'a') as f:
+            f.write(text)
+
+    def read(self):
+        lines = list(PostfixLogSummary.read_new_lines([self.path], self.state))
+        # what the next run starts from
+        PostfixLogSummary.save_state(self.state_file, self.state)
+        self.state = PostfixLogSummary.load_state(self.state_file)
+        return lines
+
+    def testOnlyNewLines(self):
+        self.append('one\ntwo\n')
+        self.assertEqual(['one\n', 'two\n'], self.read())
+        self.assertEqual([], self.read())
+        self.append('three\nfou')
+        self.assertEqual(['three\n'], self.read())
+        self.append('r\n')
+        self.assertEqual(['four\n'], self.read())
+        self.assertEqual([os.stat(self.path).st_ino,
+                          os.path.getsize(self.path)],
+                         self.state[os.path.abspath(self.path)])
+
+    def testTruncation(self):
+        self.append('one\ntwo\n')
+        self.read()
+        open(self.path, 'w').close()
+        self.append('new\n')
+        self.assertEqual(['new\n'], self.read())
+
+    def testRotation(self):
+        self.append('one\n')
+        self.read()
+        self.append('two\n')
+        os.rename(self.path, self.path + '.1')
+        self.append('three\n')
+        self.assertEqual(['two\n', 'three\n'], self.read())
+        self.assertEqual([], self.read())
+
+    def testRotatedAway(self):
+        self.append('one\n')
+        self.read()
+        os.rename(self.path, self.path + '.1')
+        self.assertEqual([], self.read())
+        self.append('two\n')
+        self.assertEqual(['two\n'], self.read())
+
+
+# From the sample at the top of PostfixLogSummary.py, with another delivery
+# interleaved.
+CORRELATED_LOG = """Jun  6 00:22:01 sender postfix/qmgr[3673]: AF3B6480475: from=<root@sender.example.com>, size=576, nrcpt=1 (queue active)
+Jun  6 00:22:01 sender postfix/smtp[3682]: SSL_connect error to valid-example-recipient.com[192.168.33.7]:25: -1
+Jun  6 00:22:01 sender postfix/smtp[3690]: 1B2C3D4E5F6: to=<a@other.example>, relay=mx.other.example[10.0.0.2]:25, delay=0.1, delays=0/0/0/0.1, dsn=2.0.0, status=sent (250 2.0.0 Ok)
+Jun  6 00:22:01 sender postfix/smtp[3682]: warning: TLS library problem: 3682:error:140740BF:SSL routines:SSL23_CLIENT_HELLO:no protocols available:s23_clnt.c:381:
+Jun  6 00:22:01 sender postfix/smtp[3682]: AF3B6480475: to=<vagrant@valid-example-recipient.com>, relay=valid-example-recipient.com[192.168.33.7]:25, delay=0.06, delays=0.03/0.03/0/0, dsn=4.7.5, status=deferred (Cannot start TLS: handshake failure)
+Jun  6 00:22:02 sender postfix/smtp[3691]: 62D3F481249: to=<vagrant@valid-example-recipient.com>, relay=valid-example-recipient.com[192.168.33.7]:25, delay=0.07, delays=0.03/0.01/0.03/0, dsn=4.7.4, status=deferred (TLS is required, but was not offered by host valid-example-recipient.com[192.168.33.7])
+Jun  6 00:22:03 sender postfix/smtp[3692]: 9A8B7C6D5E4: to=<b@other.example>, relay=mx.other.example[10.0.0.2]:25, delay=0.1, dsn=4.4.2, status=deferred (lost connection with mx.other.example[10.0.0.2] while receiving the initial server greeting)
+Jun  6 00:27:01 sender postfix/smtp[3700]: AF3B6480475: to=<vagrant@valid-example-recipient.com>, relay=valid-example-recipient.com[192.168.33.7]:25, delay=300, dsn=2.0.0, status=sent (250 2.0.0 Ok)
+Jun  6 00:27:01 sender postfix/qmgr[3673]: AF3B6480475: removed
+""".splitlines(True)
+
+
+class TestTLSCorrelator(unittest.TestCase):
+
+    def testCauses(self):
+        correlator = PostfixLogSummary.TLSCorrelator()
+        self.assertEqual(CORRELATED_LOG,
+                         list(correlator.watch(CORRELATED_LOG)))
+        self.assertEqual(
+            {(DOMAIN, 'no protocols available'): 1,
+             (DOMAIN, 'TLS is required, but was not offered by host'): 1},
+            correlator.causes)
+        self.assertEqual({'sent': 1}, correlator.outcomes)
+        self.assertEqual([], list(correlator.pending))
+        self.assertEqual(['62D3F481249'], list(correlator.deferred))
+
+    def testTLSCause(self):
+        self.assertEqual(
+            'certificate verify failed',
+            PostfixLogSummary.tls_cause(
+                'warning: TLS library problem: error:0A000086:SSL routines::'
+                'certificate verify failed:../ssl/statem/statem_clnt.c:1889:'))
+        self.assertEqual(
+            'SSL_connect error',
+            PostfixLogSummary.tls_cause('SSL_connect error to '
+                                        'mx.example.com[10.0.0.1]:25: -1'))
+
+    def testBoundedTables(self):
+        correlator = PostfixLogSummary.TLSCorrelator(max_entries=2,
+                                                     max_age=60)
+        for pid in range(5):
+            correlator.feed('Jun  6 00:22:01 sender postfix/smtp[%d]: '
+                            'SSL_connect error to mx.example.com'
+                            '[10.0.0.1]:25: -1\n' % pid)
+        self.assertEqual(['postfix/smtp[3]', 'postfix/smtp[4]'],
+                         list(correlator.pending))
+        correlator.feed(CORRELATED_LOG[-2])
+        self.assertEqual([], list(correlator.pending))
+        self.assertEqual(5, correlator.evicted)
+
+    def testReportNewLines(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'mail.log')
+        config = Config.Config()
+        config.load_from_json_file(os.path.join(EXAMPLES_DIR, 'config.json'))
+        correlator = PostfixLogSummary.TLSCorrelator()
+        state = {}
+        stdout = sys.stdout
+        try:
+            with open(path, 'w') as f:
+                f.writelines(CORRELATED_LOG[:5])
+            sys.stdout = StringIO.StringIO()
+            PostfixLogSummary.report_new_lines([path], config, state,
+                                               correlator=correlator)
+            first = sys.stdout.getvalue()
+            with open(path, 'a') as f:
+                f.writelines(CORRELATED_LOG[5:])
+            sys.stdout = StringIO.StringIO()
+            PostfixLogSummary.report_new_lines([path], config, state,
+                                               correlator=correlator)
+            second = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmp_dir)
+        self.assertIn('%s: no protocols available: 1' % DOMAIN, first)
+        self.assertNotIn('no protocols available', second)
+        self.assertIn('%s: TLS is required, but was not offered by host: 1'
+                      % DOMAIN, second)
+        self.assertIn('Messages sent after a TLS deferral: 1', second)
+
+
+
+class TestCronOnStandardInput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.timestamp_file = os.path.join(self.tmp_dir, 'timestamp')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_cron(self, lines):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'PostfixLogSummary.py')
+        cmd = subprocess.Popen(
+            [sys.executable, script, '-c',
+             '--timestamp-file', self.timestamp_file,
+             os.path.join(EXAMPLES_DIR, 'config.json')],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout, _ = cmd.communicate(''.join(lines))
+        self.assertEqual(0, cmd.returncode)
+        return stdout
+
+    def testLinesAfter(self):
+        timestamp = time.strptime('Jun 12 06:24:14',
+                                  PostfixLogSummary.TIME_FORMAT)
+        lines = ['-- MARK --\n'] + LOG
+        self.assertEqual(LOG[6:], list(PostfixLogSummary.lines_after(
+            iter(lines), timestamp)))
+
+    def testOnlyNewDeferralsReported(self):
+        self.assertIn('mx.%s: 2' % DOMAIN, self.run_cron(LOG))
+        self.assertEqual('', self.run_cron(LOG))
+        deferral = LOG[8].replace('06:24:16', '06:30:00')
+        self.assertIn('mx.%s: 1' % DOMAIN, self.run_cron(LOG + [deferral]))
+        self.assertEqual('', self.run_cron(LOG + [deferral]))
+
+
+if __name__ == '__main__':
+    unittest.main()
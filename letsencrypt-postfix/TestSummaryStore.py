@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import Config
+import PostfixLogSummary
+import SummaryStore
+
+from TestPostfixLogSummary import DOMAIN, EXAMPLES_DIR, LOG
+
+
+def local_time(text):
+    return int(time.mktime(time.strptime(text, '%Y-%m-%d %H:%M')))
+
+
+# when the counts are added
+NOW = local_time('2014-06-12 12:00')
+
+
+class TestSummaryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SummaryStore.SummaryStore(
+            os.path.join(self.tmp_dir, 'summary.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def testLogMinute(self):
+        self.assertEqual(local_time('2014-06-12 06:24'),
+                         SummaryStore.log_minute('Jun 12 06:24', NOW))
+        # a December line read in January is from last year
+        self.assertEqual(local_time('2013-12-31 23:59'),
+                         SummaryStore.log_minute(
+                             'Dec 31 23:59', local_time('2014-01-01 00:01')))
+
+    def testBuckets(self):
+        self.store.add({('Jun 12 06:24', DOMAIN, 'Trusted'): 2,
+                        ('Jun 12 06:25', DOMAIN, 'Trusted'): 1,
+                        ('Jun 12 07:01', DOMAIN, 'Trusted'): 4,
+                        ('Jun 11 23:59', DOMAIN, 'Trusted'): 8}, NOW)
+        self.store.add({('Jun 12 06:24', DOMAIN, 'Trusted'): 16}, NOW)
+        day = local_time('2014-06-12 00:00')
+        self.assertEqual([(day, DOMAIN, 'Trusted', 23)],
+                         self.store.query(day, NOW, SummaryStore.DAY))
+        hour = local_time('2014-06-12 06:00')
+        self.assertEqual([(hour, DOMAIN, 'Trusted', 19),
+                          (hour + 3600, DOMAIN, 'Trusted', 4)],
+                         self.store.query(hour, NOW, SummaryStore.HOUR))
+        self.assertEqual({(DOMAIN, 'Trusted'): 19},
+                         self.store.totals(local_time('2014-06-12 06:24'),
+                                           local_time('2014-06-12 06:26'),
+                                           SummaryStore.MINUTE))
+        self.assertEqual([(day, DOMAIN, 'Trusted', 23)],
+                         self.store.last_days(1, NOW))
+        self.assertEqual(2, len(self.store.last_days(2, NOW)))
+
+    def testCompactKeepsCoarseTotals(self):
+        self.store.add({('Jun  1 06:24', DOMAIN, 'Trusted'): 1}, NOW)
+        self.store.compact(NOW)
+        start = local_time('2014-06-01 00:00')
+        self.assertEqual([], self.store.query(start, NOW, SummaryStore.MINUTE))
+        self.assertEqual({(DOMAIN, 'Trusted'): 1},
+                         self.store.totals(start, NOW, SummaryStore.HOUR))
+        self.assertEqual({(DOMAIN, 'Trusted'): 1},
+                         self.store.totals(start, start + 3600))
+
+    def testChooseResolution(self):
+        choose = SummaryStore.choose_resolution
+        self.assertEqual(SummaryStore.MINUTE, choose(NOW - 600, NOW, NOW))
+        self.assertEqual(SummaryStore.HOUR, choose(NOW - 86400, NOW, NOW))
+        self.assertEqual(SummaryStore.DAY, choose(NOW - 7 * 86400, NOW, NOW))
+        # minute buckets this old have been compacted away
+        self.assertEqual(SummaryStore.HOUR,
+                         choose(NOW - 7 * 86400, NOW - 7 * 86400 + 600, NOW))
+
+    def testFromGetCounts(self):
+        config = Config.Config()
+        config.load_from_json_file(os.path.join(EXAMPLES_DIR, 'config.json'))
+        minutes = collections.defaultdict(int)
+        PostfixLogSummary.get_counts(LOG, config, 0, minutes)
+        self.assertEqual({('Jun 12 06:24', DOMAIN, 'Untrusted'): 1,
+                          ('Jun 12 06:24', DOMAIN, 'Trusted'): 1,
+                          ('Jun 12 06:24', DOMAIN, 'all'): 2,
+                          ('Jun  6 00:22', 'mx.' + DOMAIN, 'deferred'): 1,
+                          ('Jun 12 06:24', 'mx.' + DOMAIN, 'deferred'): 1},
+                         minutes)
+        self.store.add(minutes, NOW)
+        self.assertEqual(2, self.store.totals(
+            local_time('2014-06-01 00:00'), NOW)[(DOMAIN, 'all')])
+
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'mail.log')
+        with open(self.log, 'w') as f:
+            f.writelines(LOG)
+        self.store_file = os.path.join(self.tmp_dir, 'summary.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_summary(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'PostfixLogSummary.py')
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                [sys.executable, script, '--store', self.store_file,
+                 '--state-file', os.path.join(self.tmp_dir, 'state.json')] +
+                list(args) +
+                [os.path.join(EXAMPLES_DIR, 'config.json'), self.log],
+                stdout=devnull, stderr=devnull)
+
+    def totals(self):
+        store = SummaryStore.SummaryStore(self.store_file)
+        try:
+            return store.totals(0, time.time(), SummaryStore.DAY)
+        finally:
+            store.close()
+
+    def testRerunCountsNothingTwice(self):
+        self.assertEqual(0, self.run_summary('-c'))
+        totals = self.totals()
+        self.assertEqual(2, totals[(DOMAIN, 'all')])
+        self.assertEqual(0, self.run_summary('-c'))
+        self.assertEqual(totals, self.totals())
+
+    def testStoreNeedsIncrementalRuns(self):
+        self.assertEqual(2, self.run_summary())
+        self.assertEqual({}, self.totals())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import logging
+import unittest
+
+import Config
+import SyntheticPolicy
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+
+class TestSyntheticPolicy(unittest.TestCase):
+
+    def testDeterministic(self):
+        self.assertEqual(SyntheticPolicy.generate_policy(500, seed=3),
+                         SyntheticPolicy.generate_policy(500, seed=3))
+        self.assertNotEqual(SyntheticPolicy.generate_policy(500, seed=3),
+                            SyntheticPolicy.generate_policy(500, seed=4))
+
+    def testLoadsWithoutMissingOrOrphanedPolicies(self):
+        policy = SyntheticPolicy.generate_policy(2000)
+        self.assertEqual(2000, len(policy['acceptable-mxs']))
+        config = Config.Config()
+        config.from_json_dict(policy)
+        codes = set(e.code for e in config.validate())
+        # multi-MX domains and the fixed timestamps are expected failures
+        self.assertEqual(set(['invalid-acceptable-mx', 'expired']), codes)
+        # shared providers mean far fewer distinct policy bodies
+        bodies = set(id(p._body) for p in config.tls_policies.values())
+        self.assertLess(len(bodies), len(config.tls_policies) // 10)
+
+    def testParseSize(self):
+        self.assertEqual(1000, SyntheticPolicy.parse_size('1k'))
+        self.assertEqual(1000000, SyntheticPolicy.parse_size('1M'))
+        self.assertEqual(250, SyntheticPolicy.parse_size('250'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,12 +9,18 @@ import re
 import json
 import collections
 
-import dns.resolver
-from M2Crypto import X509
-from publicsuffix import PublicSuffixList
+# dnspython, M2Crypto and publicsuffix are slow to import (the latter also
+# parses the whole suffix list), so they are only loaded when first needed.
 
-public_suffix_list = PublicSuffixList()
 CERTS_OBSERVED = 'certs-observed'
+_public_suffix_list = None
+
+def public_suffix_list():
+    global _public_suffix_list
+    if _public_suffix_list is None:
+        from publicsuffix import PublicSuffixList
+        _public_suffix_list = PublicSuffixList()
+    return _public_suffix_list
 
 def mkdirp(path):
     try:
@@ -26,6 +32,7 @@ def mkdirp(path):
 
 def extract_names(pem):
     """Return a set of DNS subject names from PEM-encoded leaf cert."""
+    from M2Crypto import X509
     leaf = X509.load_cert_string(pem, X509.FORMAT_PEM)
 
     subj = leaf.get_subject()
@@ -101,7 +108,7 @@ def check_certs(mail_domain):
       return ""
     else:
       new_names = extract_names_from_openssl_output(filename)
-      new_names = set(public_suffix_list.get_public_suffix(n) for n in new_names)
+      new_names = set(public_suffix_list().get_public_suffix(n) for n in new_names)
       names.update(new_names)
   if len(names) >= 1:
     # Hack: Just pick an arbitrary suffix for now. Do something cleverer later.
@@ -159,6 +166,7 @@ def collect(mail_domain):
   Store the output in a directory with the same name as mail_domain to make
   subsequent analysis faster.
   """
+  import dns.resolver
   print "Checking domain %s" % mail_domain
   mkdirp(os.path.join(CERTS_OBSERVED, mail_domain))
   answers = dns.resolver.query(mail_domain, 'MX')
@@ -170,6 +178,7 @@ if __name__ == '__main__':
   """Consume a target list of domains and output a configuration file for those domains."""
   if len(sys.argv) < 2:
     print("Usage: CheckSTARTTLS.py list-of-domains.txt > output.json")
+    sys.exit(1)
 
   config = collections.defaultdict(dict)
 